@@ -1,35 +1,95 @@
+import copy
+import time as _time
 import types
+from hashlib import md5
+from email.utils import parsedate_tz, mktime_tz
 from django.conf import settings
-from django.http import Http404, HttpResponseForbidden
+from django.http import Http404, HttpResponseForbidden, HttpResponseNotModified
+from django.utils.http import http_date
 from google.appengine.ext import db
 from google.appengine.api import users
 from google.appengine.api import memcache
 from .models import TransitApp, Agency
 from .utils.httpbasicauth import authenticate_request
 from .utils.progressuuid import is_progress_uuid_valid
-from .utils.view import method_not_allowed
-from .utils.memcache import key_for_view_function, key_for_request
+from .utils.generation import KINDS, generations_key, last_modified as generations_last_modified
+from .utils.view import method_not_allowed, bad_request, fields_parameter
+from .utils.memcache import key_for_view_function, key_for_request, local_view_cache, local_key, count_view_cache_lookup, set_with_staleness, get_with_staleness, is_fresh, acquire_refresh_lock, release_refresh_lock, response_to_record, response_from_record
+
+def _clone_response(response):
+    """Return a copy of the response that the caller can change (say, by setting headers or cookies) without changing the original."""
+    clone = copy.copy(response)
+    clone._headers = response._headers.copy()
+    clone.cookies = copy.deepcopy(response.cookies)
+    if response._is_string:
+        clone._container = list(response._container)
+    return clone
+
+def _cached_view_response(view_function, memcache_key, generation, time, stale_time, namespace, render):
+    """Return the response cached under memcache_key, first from this instance's memory, then from memcache. Failing both, render() it and cache it.
+    
+    Once a cached response goes stale, or was rendered at other data generations than the given ones, 
+    one request renders it again while the others get the stale copy."""
+    local = local_view_cache.get(local_key(memcache_key, namespace))
+    if (local is not None) and (local[0] == generation):
+        count_view_cache_lookup(view_function, "local_hits")
+        return _clone_response(local[1])
+    
+    record, fresh_until = get_with_staleness(memcache_key, namespace = namespace)
+    cached_generation, response = response_from_record(record) if record is not None else (None, None)
+    holds_refresh_lock = False
+    if response is not None:
+        if (cached_generation == generation) and is_fresh(fresh_until):
+            count_view_cache_lookup(view_function, "memcache_hits")
+            _remember_locally(memcache_key, namespace, generation, response, fresh_until)
+            return response
+        holds_refresh_lock = acquire_refresh_lock(memcache_key, namespace = namespace)
+        if not holds_refresh_lock:
+            # Someone else is already rendering a fresh copy.
+            count_view_cache_lookup(view_function, "stale_hits")
+            return response
+        
+    count_view_cache_lookup(view_function, "misses")
+    try:
+        response = render()
+        if not settings.RUNNING_APP_ENGINE_LOCAL_SERVER:
+            set_with_staleness(memcache_key, response_to_record(response, generation), time = time, stale_time = stale_time, namespace = namespace)
+            _remember_locally(memcache_key, namespace, generation, response, (_time.time() + time) if time else None)
+    finally:
+        if holds_refresh_lock:
+            release_refresh_lock(memcache_key, namespace = namespace)
+    return response
+
+def _remember_locally(memcache_key, namespace, generation, response, fresh_until):
+    """Keep a copy of the response (rendered at the given data generations) in this instance's memory, for no longer than it stays fresh."""
+    if settings.RUNNING_APP_ENGINE_LOCAL_SERVER:
+        return
+    local_time = settings.LOCAL_VIEW_CACHE_SECONDS
+    if fresh_until is not None:
+        local_time = min(local_time, fresh_until - _time.time())
+    if local_time > 0:
+        local_view_cache.set(local_key(memcache_key, namespace), (generation, _clone_response(response)), local_time)
 
 def memcache_view_response(*args, **kwargs):
-    """Memcache the entire response object of the view. 
+    """Memcache the response of the view. 
     Do so unconditionally, regardless of any parameters sent to the view.
+    Each instance also keeps recently used responses in its own memory, for up to LOCAL_VIEW_CACHE_SECONDS.
     
     Optional named parameters:
-        time = <memcache expiration time in seconds>
+        time = <seconds the cached response stays fresh>
+        stale_time = <seconds a stale response may still be served while one request renders a new one>
         namespace = <memcache namespace>
+        kinds = <the kinds of entity the view reads; when their generations move on, the cached response goes stale. By default, all of them>
     """
     time = kwargs.get('time', 0)
+    stale_time = kwargs.get('stale_time', settings.MEMCACHE_STALE_SECONDS)
     namespace = kwargs.get('namespace', None)
+    kinds = kwargs.get('kinds', KINDS)
     
     def decorator(view_function):
         def wrapper(request, *wrapped_args, **wrapped_kwargs):
             memcache_key = key_for_view_function(view_function)
-            response = memcache.get(memcache_key, namespace = namespace)
-            if response is None:
-                response = view_function(request, *wrapped_args, **wrapped_kwargs)
-                if not settings.RUNNING_APP_ENGINE_LOCAL_SERVER:
-                    memcache.set(memcache_key, response, time = time, namespace = namespace)
-            return response
+            return _cached_view_response(view_function, memcache_key, generations_key(kinds), time, stale_time, namespace, lambda: view_function(request, *wrapped_args, **wrapped_kwargs))
         wrapper.__name__ = view_function.__name__
         wrapper.__module__ = view_function.__module__
         return wrapper        
@@ -45,25 +105,25 @@ def memcache_view_response(*args, **kwargs):
     return decorator
     
 def memcache_parameterized_view_response(*args, **kwargs):
-    """Memcache the entire response object of the view. 
+    """Memcache the response of the view. 
     Do so conditionally, taking into account the URL, request method, and parameters in GET or POST.
+    Each instance also keeps recently used responses in its own memory, for up to LOCAL_VIEW_CACHE_SECONDS.
     
     Optional named parameters:
-        time = <memcache expiration time in seconds>
+        time = <seconds the cached response stays fresh>
+        stale_time = <seconds a stale response may still be served while one request renders a new one>
         namespace = <memcache namespace>
+        kinds = <the kinds of entity the view reads; when their generations move on, the cached response goes stale. By default, all of them>
     """
     time = kwargs.get('time', 0)
+    stale_time = kwargs.get('stale_time', settings.MEMCACHE_STALE_SECONDS)
     namespace = kwargs.get('namespace', None)
+    kinds = kwargs.get('kinds', KINDS)
     
     def decorator(view_function):
         def wrapper(request, *wrapped_args, **wrapped_kwargs):
             memcache_key = key_for_request(request)
-            response = memcache.get(memcache_key, namespace = namespace)          
-            if response is None:
-                response = view_function(request, *wrapped_args, **wrapped_kwargs)
-                if not settings.RUNNING_APP_ENGINE_LOCAL_SERVER:                
-                    memcache.set(memcache_key, response, time = time, namespace = namespace)
-            return response
+            return _cached_view_response(view_function, memcache_key, generations_key(kinds), time, stale_time, namespace, lambda: view_function(request, *wrapped_args, **wrapped_kwargs))
         wrapper.__name__ = view_function.__name__
         wrapper.__module__ = view_function.__module__
         return wrapper
@@ -78,6 +138,70 @@ def memcache_parameterized_view_response(*args, **kwargs):
     # function to decorate.
     return decorator
 
+def _is_not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return (if_none_match.strip() == '*') or (etag in [candidate.strip().replace('W/', '', 1) for candidate in if_none_match.split(',')])
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and (last_modified is not None):
+        parsed = parsedate_tz(if_modified_since)
+        return (parsed is not None) and (last_modified <= mktime_tz(parsed))
+    return False
+    
+def _set_conditional_headers(response, etag, last_modified, max_age, for_admin_user):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # Admins see hidden apps; don't let shared caches hand their copy to anyone else.
+    response['Cache-Control'] = "%smax-age=%d" % ("private, " if for_admin_user else "", max_age)
+
+def conditional_view_response(*args, **kwargs):
+    """Answer conditional GETs of the view (If-None-Match, If-Modified-Since) with 304 Not Modified when we can.
+    
+    The ETag depends on the request and the current data generations (see utils/generation.py), and
+    Last-Modified is the time those generations last moved, so a 304 costs no datastore or template 
+    work. Put this before any decorator that touches the datastore.
+    
+    Optional named parameters:
+        time = <max-age to send clients, in seconds>
+        kinds = <the kinds of entity the view reads; the ETag and Last-Modified follow their generations. By default, all of them>
+    """
+    time = kwargs.get('time', 0)
+    kinds = kwargs.get('kinds', KINDS)
+    
+    def decorator(view_function):
+        def wrapper(request, *wrapped_args, **wrapped_kwargs):
+            for_admin_user = users.is_current_user_admin()
+            etag = '"%s"' % md5("%s-%s" % (generations_key(kinds), key_for_request(request, for_admin_user = for_admin_user))).hexdigest()
+            if request.META.get('HTTP_IF_NONE_MATCH'):
+                # The ETag settles it; there's no need to look up modification times.
+                last_modified = None
+            else:
+                last_modified = generations_last_modified(kinds)
+            if _is_not_modified(request, etag, last_modified):
+                response = HttpResponseNotModified()
+                _set_conditional_headers(response, etag, last_modified, time, for_admin_user)
+                return response
+            response = view_function(request, *wrapped_args, **wrapped_kwargs)
+            if response.status_code == 200:
+                if last_modified is None:
+                    last_modified = generations_last_modified(kinds)
+                _set_conditional_headers(response, etag, last_modified, time, for_admin_user)
+            return response
+        wrapper.__name__ = view_function.__name__
+        wrapper.__module__ = view_function.__module__
+        return wrapper
+        
+    # Was conditional_view_response called with no parameters? If so,
+    # python runtime directly hands us the function to decorate.
+    if (len(args) == 1) and (type(args[0]) is types.FunctionType):
+        return decorator(args[0])
+        
+    # conditional_view_response was called WITH parameters. This means
+    # that we must return a function that will _in turn_ take the
+    # function to decorate.
+    return decorator
+
 def _requires_method(view_function, method):
     def wrapper(request, *args, **kwargs):
         if request.method != method:
@@ -136,6 +260,20 @@ def requires_valid_agency_key_encoded(view_function):
     wrapper.__module__ = view_function.__module__
     return wrapper
 
+def requires_valid_json_fields(valid_fields):
+    """Pass the view the fields named by the request's fields= parameter (or None, for all), as the fields keyword argument."""
+    def decorator(view_function):
+        def wrapper(request, *args, **kwargs):
+            try:
+                fields = fields_parameter(request, valid_fields)
+            except ValueError, error:
+                return bad_request('fields parameter lists %s' % str(error))
+            return view_function(request, fields = fields, *args, **kwargs)
+        wrapper.__name__ = view_function.__name__
+        wrapper.__module__ = view_function.__module__
+        return wrapper
+    return decorator
+
 def requires_google_admin_login(view_function):
     def wrapper(request, *args, **kwargs):
         if not users.is_current_user_admin():
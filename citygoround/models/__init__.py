@@ -1,7 +1,12 @@
 from .agency import Agency
 from .feed import FeedReference
 from .petition import PetitionModel
-from .stats import TransitAppStats
+from .migration import Migration
+from .sharded_counter import CounterShard
 from .named_stat import NamedStat
-from .transitapp import TransitApp, TransitAppLocation, TransitAppFormProgress
+from .geocell_histogram import GeocellHistogram, GeocellHistogramShard
+from .entity_count import EntityCount
+from .support_index import AgencySupportIndex
+from .transitapp import TransitApp, TransitAppLocation, TransitAppFormProgress, AppliedRatingVotes
+from .gallery_layout import GalleryLayout
 from .imageblob import ImageBlob
@@ -3,13 +3,21 @@ from google.appengine.ext import db
 from google.appengine.api import memcache
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.utils import simplejson as json
 from geo.geomodel import GeoModel
 from ..utils.slug import slugify
-from ..utils.datastore import key_and_entity, normalize_to_key, normalize_to_keys, unique_entities, iter_uniquify
+from ..utils.datastore import key_and_entity, normalize_to_key, normalize_to_keys, unique_entities, iter_uniquify, count_all, unique_keys_in_order, get_in_chunks
 from ..utils.geohelpers import square_bounding_box_centered_at
 from ..utils.misc import uniquify
+from ..utils.catalogue import AgencyCatalogue
+from ..utils.generation import current_generation, bump_generation
+from .geocell_histogram import GeocellHistogram
+from .entity_count import EntityCount
 import cgi
 
+# The process-local agency catalogue.
+_catalogue = None
+
 class Agency(GeoModel):
     # properties straight out of the NTD import
     ntd_id                = db.StringProperty()
@@ -56,10 +64,49 @@ class Agency(GeoModel):
         if "location" in kwargs:
             self.update_location()
         self.update_slugs()
+        # Remember whether the EntityCounts currently count us as public, so put() and delete() can adjust them.
+        self._counted_public = self.is_public if kwargs.get('_from_entity') else None
         
     def __str__(self):
         return "%s in %s, %s (%s)" % (self.name, self.city, self.state, self.country)
         
+    def put(self, *args, **kwargs):
+        key = super(Agency, self).put(*args, **kwargs)
+        if self._counted_public is None:
+            EntityCount.adjust({EntityCount.AGENCIES: 1, EntityCount.PUBLIC_AGENCIES: int(self.is_public)})
+        else:
+            EntityCount.adjust({EntityCount.PUBLIC_AGENCIES: int(self.is_public) - int(self._counted_public)})
+        self._counted_public = self.is_public
+        bump_generation("Agency")
+        return key
+        
+    def delete(self, *args, **kwargs):
+        super(Agency, self).delete(*args, **kwargs)
+        if self._counted_public is not None:
+            EntityCount.adjust({EntityCount.AGENCIES: -1, EntityCount.PUBLIC_AGENCIES: -int(self._counted_public)})
+            self._counted_public = None
+        bump_generation("Agency")
+        
+    @staticmethod
+    def recount():
+        """Return a dictionary of EntityCount name -> count of agencies, counted from scratch."""
+        return {
+            EntityCount.AGENCIES: count_all(Agency.all(keys_only = True)),
+            EntityCount.PUBLIC_AGENCIES: count_all(Agency.all(keys_only = True).filter("date_opened !=", None)),
+        }
+        
+    @staticmethod
+    def catalogue():
+        """Return a read-only, in-memory AgencyCatalogue of every agency.
+        
+        The catalogue is shared by all requests in this process, and rebuilt when
+        the Agency generation moves on (see utils/generation.py)."""
+        global _catalogue
+        version = current_generation("Agency")
+        if (_catalogue is None) or (_catalogue.version != version):
+            _catalogue = AgencyCatalogue(version, Agency.all())
+        return _catalogue
+        
     def update_slugs(self):
         self.nameslug = slugify(self.name)
         self.cityslug = slugify(self.city)
@@ -67,36 +114,49 @@ class Agency(GeoModel):
         self.countryslug = slugify(self.country)
         self.urlslug = "%s/%s/%s/%s"%(self.countryslug,self.stateslug,self.cityslug,self.nameslug)
     
-    def to_jsonable(self):
-        return {
-            'ntd_id':self.ntd_id,
-            'gtfs_data_exchange_id':self.gtfs_data_exchange_id,
-            'date_opened':self.date_opened.isoformat(" ") if self.date_opened else None,
-            'passenger_miles':self.passenger_miles,
-            'is_public':self.is_public,
-            'name': cgi.escape(self.name),
-            'short_name': cgi.escape(self.short_name) if self.short_name else None,
-            'city': cgi.escape(self.city),
-            'urlslug': self.urlslug,
-            'state': cgi.escape(self.state),
-            'details_url': self.details_url,
-            'key_encoded': str(self.key()),
-            'has_real_time_data': self.has_real_time_data,
-            'latitude':(self.location.lat if self.location else None),
-            'longitude':(self.location.lon if self.location else None),
-            'executive':cgi.escape(self.executive) if self.executive else None,
-            'executive_email':cgi.escape(self.executive_email) if self.executive_email else None,
-            'agency_url':cgi.escape(self.agency_url) if self.agency_url else None,
-        }
+    # How to compute each field of to_jsonable(), so that we can compute just some of them.
+    JSONABLE_FIELDS = {
+        'ntd_id': lambda agency: agency.ntd_id,
+        'gtfs_data_exchange_id': lambda agency: agency.gtfs_data_exchange_id,
+        'date_opened': lambda agency: agency.date_opened.isoformat(" ") if agency.date_opened else None,
+        'passenger_miles': lambda agency: agency.passenger_miles,
+        'is_public': lambda agency: agency.is_public,
+        'name': lambda agency: cgi.escape(agency.name),
+        'short_name': lambda agency: cgi.escape(agency.short_name) if agency.short_name else None,
+        'city': lambda agency: cgi.escape(agency.city),
+        'urlslug': lambda agency: agency.urlslug,
+        'state': lambda agency: cgi.escape(agency.state),
+        'details_url': lambda agency: agency.details_url,
+        'key_encoded': lambda agency: str(agency.key()),
+        'has_real_time_data': lambda agency: agency.has_real_time_data,
+        'latitude': lambda agency: agency.location.lat if agency.location else None,
+        'longitude': lambda agency: agency.location.lon if agency.location else None,
+        'executive': lambda agency: cgi.escape(agency.executive) if agency.executive else None,
+        'executive_email': lambda agency: cgi.escape(agency.executive_email) if agency.executive_email else None,
+        'agency_url': lambda agency: cgi.escape(agency.agency_url) if agency.agency_url else None,
+    }
+    JSONABLE_FIELD_NAMES = frozenset(JSONABLE_FIELDS.keys())
+    
+    def to_jsonable(self, fields = None):
+        """Return a jsonable dictionary of the agency, with just the given fields (all of them, if None)."""
+        return dict([(field, Agency.JSONABLE_FIELDS[field](self)) for field in (fields or Agency.JSONABLE_FIELDS)])
+
+    def to_json(self, fields = None):
+        """Return the agency's JSON encoding. (List pages and APIs encode catalogue AgencyRecords instead, whose encodings are computed once per catalogue; an entity may be newer than its record.)"""
+        return json.dumps(self.to_jsonable(fields))
+        
+    @staticmethod
+    def json_fragments(agencies, fields = None):
+        """Return a list of the JSON encodings of the given agencies (or AgencyRecords), with just the given fields."""
+        return [agency.to_json(fields) for agency in agencies]
+
+    @staticmethod
+    def fetch_all_agencies_as_json_fragments(fields = None):
+        return Agency.json_fragments(Agency.catalogue().records, fields)
 
     @staticmethod
     def fetch_all_agencies_as_jsonable():
-        memcache_key = "all-agencies-as-jsonable"
-        all_as_jsonable = memcache.get(memcache_key)
-        if all_as_jsonable is None:
-            all_as_jsonable = [agency.to_jsonable() for agency in Agency.all()]
-            memcache.set(memcache_key, all_as_jsonable, time = settings.MEMCACHE_DEFAULT_SECONDS)
-        return all_as_jsonable
+        return [record.jsonable for record in Agency.catalogue().records]
 
     @property
     def details_url(self):
@@ -108,10 +168,11 @@ class Agency(GeoModel):
 
     @staticmethod
     def fetch_agencies_near(latitude, longitude, query = None, max_results = 50, bbox_side_in_miles = settings.BBOX_SIDE_IN_MILES):
+        """Return agencies near the given point. Without a query, these are AgencyRecords from the catalogue; with one, they are entities."""
         bounding_box = square_bounding_box_centered_at(latitude, longitude, bbox_side_in_miles)
         if query is None:
-            query = Agency.all()
-        return Agency.bounding_box_fetch(query, bounding_box, max_results = max_results)        
+            return Agency.catalogue().in_box(bounding_box, max_results = max_results)
+        return Agency.bounding_box_fetch(query, bounding_box, max_results = max_results, cost_function = GeocellHistogram.cost_function_for(Agency))
         
     @property
     def has_real_time_data(self):
@@ -124,44 +185,18 @@ class Agency(GeoModel):
 
     @staticmethod    
     def get_state_list():
-        #factoring this out since we want all states all the time
-        #and because we want to memcache this
-        #todo: add other countries (return dict where value includes proper url)
-        mem_result = memcache.get('all_states')
-        if not mem_result:
-            states = uniquify([(a.countryslug,a.stateslug) for a in Agency.all()])
-            states.sort(key=lambda x:x[1])
-            mc_added = memcache.add('all_states', states, settings.MEMCACHE_DEFAULT_SECONDS)
-        else:
-            states = mem_result
-
-        return states
+        """Return a list of (countryslug, stateslug) tuples for every state with an agency, sorted by state."""
+        return Agency.catalogue().state_list
         
     @staticmethod    
     def get_country_list():
-        #factoring this out since we want all states all the time
-        #and because we want to memcache this
-        #todo: add other countries (return dict where value includes proper url)
-        mem_result = memcache.get('all_countries')
-        if not mem_result:
-            countries = uniquify([a.countryslug for a in Agency.all()])
-            countries.sort()
-            mc_added = memcache.add('all_countries', countries, settings.MEMCACHE_DEFAULT_SECONDS)
-        else:
-            countries = mem_result
-
-        return countries
+        """Return a sorted list of countryslugs for every country with an agency."""
+        return Agency.catalogue().country_list
     
     @staticmethod
     def fetch_for_slugs(countryslug = None, stateslug = None, cityslug = None):
-        agency_query = Agency.all()        
-        if cityslug:
-            agency_query = agency_query.filter('cityslug =', cityslug)            
-        if stateslug:
-            agency_query = agency_query.filter('stateslug =', stateslug)            
-        if countryslug:
-            agency_query = agency_query.filter('countryslug =',countryslug)            
-        return [agency for agency in agency_query]
+        """Return a list of AgencyRecords from the catalogue that match all of the given slugs."""
+        return Agency.catalogue().for_slugs(countryslug, stateslug, cityslug)
     
     @staticmethod
     def fetch_explicitly_supported_for_transit_app(transit_app):
@@ -195,6 +230,21 @@ class Agency(GeoModel):
         """Return a list of Agency entities, by default unique, that at least one transit application in the transit_apps list supports."""
         return [agency for agency in Agency.iter_for_transit_apps(transit_apps, uniquify)]
 
+    @staticmethod
+    def keys_for_transit_apps(transit_apps):
+        """Return a list of the unique keys of Agencies that at least one of the transit apps supports: explicitly first, then public ones, from the catalogue."""
+        agency_keys = []
+        for transit_app in transit_apps:
+            agency_keys.extend(transit_app.explicitly_supported_agency_keys)
+        if any([transit_app.supports_all_public_agencies for transit_app in transit_apps]):
+            agency_keys.extend([record.key() for record in Agency.catalogue().records if record.is_public])
+        return unique_keys_in_order(agency_keys)
+
+    @staticmethod
+    def fetch_by_keys(agency_keys):
+        """Return a list of the Agencies with the given keys that still exist."""
+        return get_in_chunks(Agency, agency_keys)
+
     @staticmethod
     def iter_for_transit_apps(transit_apps, uniquify = True):
         """Return an iterator over Agency entities, by default unique, that at least one transit application in the transit_apps list supports."""
@@ -0,0 +1,55 @@
+from google.appengine.ext import db
+
+#
+# Materialized counts of agencies and apps.
+#
+# Counting with a query scans an index every time (and count() stops at 1000), so
+# the pages that show these numbers read them from EntityCount entities instead,
+# one per count, keyed by name. Agency and TransitApp put() and delete() adjust
+# the counts as entities come and go; a periodic reconciliation recounts them from
+# scratch, to fix any drift (say, from db.put() of many entities at once).
+#
+
+class EntityCount(db.Model):
+    AGENCIES = "agencies"
+    PUBLIC_AGENCIES = "public-agencies"
+    VISIBLE_TRANSIT_APPS = "visible-transit-apps"
+
+    value = db.IntegerProperty(default = 0, indexed = False)
+
+    @staticmethod
+    def name_for_category(category):
+        return "visible-transit-apps-in-category-%s" % category
+
+    @staticmethod
+    def get_values(names):
+        """Return a dictionary of name -> count for the given names, with a single batch get."""
+        counts = EntityCount.get_by_key_name(names)
+        return dict([(name, count.value if count else 0) for name, count in zip(names, counts)])
+
+    @staticmethod
+    def get_value(name):
+        return EntityCount.get_values([name])[name]
+
+    @staticmethod
+    def adjust(deltas):
+        """Add each delta in the dictionary of name -> delta to its count."""
+        for name, delta in deltas.iteritems():
+            if delta:
+                db.run_in_transaction(EntityCount._adjust_in_transaction, name, delta)
+
+    @staticmethod
+    def _adjust_in_transaction(name, delta):
+        count = EntityCount.get_by_key_name(name)
+        if count is None:
+            count = EntityCount(key_name = name)
+        count.value += delta
+        count.put()
+
+    @staticmethod
+    def reconcile(values):
+        """Overwrite the counts with the given dictionary of name -> count, recounted from scratch. Counts it doesn't mention go to zero."""
+        values = dict(values)
+        for key in EntityCount.all(keys_only = True):
+            values.setdefault(key.name(), 0)
+        db.put([EntityCount(key_name = name, value = value) for name, value in values.iteritems()])
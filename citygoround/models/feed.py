@@ -4,6 +4,7 @@ from django.core.urlresolvers import reverse
 from geo.geomodel import GeoModel
 from ..utils.slug import slugify
 from ..utils.datastore import key_and_entity, normalize_to_key, normalize_to_keys, unique_entities
+from ..utils.generation import bump_generation
 
 class FeedReference(db.Model):
     """feed reference models a GTFS Data Exchange entity"""
@@ -32,4 +33,13 @@ class FeedReference(db.Model):
     
     def __str__(self):
         return "%s (%s)" % (self.name, self.url)    
+        
+    def put(self, *args, **kwargs):
+        key = super(FeedReference, self).put(*args, **kwargs)
+        bump_generation("FeedReference")
+        return key
+        
+    def delete(self, *args, **kwargs):
+        super(FeedReference, self).delete(*args, **kwargs)
+        bump_generation("FeedReference")
     
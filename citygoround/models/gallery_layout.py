@@ -0,0 +1,98 @@
+import pickle
+from google.appengine.ext import db
+from ..utils.misc import chunk_sequence
+from ..utils.generation import current_generation
+from .transitapp import TransitApp
+
+#
+# The app gallery's layout, worked out ahead of time.
+#
+# Laying out the gallery means walking every app in rating order, to pick out the
+# featured apps and sort the rest into categories. Instead of doing that for each
+# page view, a background task does it once per TransitApp generation and stores
+# the result: just the keys of the apps in each section. The gallery page then only
+# needs one batch get of those apps. A layout built before the current generation
+# is stale; the gallery goes on using it while a fresh one is built.
+#
+
+class GalleryLayout(db.Model):
+    KEY_NAME = "gallery"
+    NUM_RECENT_APPS = 3
+    NUM_FEATURED_APPS = 3
+    CATEGORIES = ["Public Transit", "Biking", "Walking", "Driving"]
+
+    generation = db.IntegerProperty(indexed = False) # the TransitApp generation the layout was built from
+    recent_keys = db.ListProperty(db.Key, indexed = False)
+    featured_keys = db.ListProperty(db.Key, indexed = False)
+    categorized_keys_pickle = db.BlobProperty() # dictionary of category -> list of app keys, in rating order, pickled.
+    updated = db.DateTimeProperty(auto_now = True)
+
+    def __init__(self, *args, **kwargs):
+        super(GalleryLayout, self).__init__(*args, **kwargs)
+        self._categorized_keys = None
+
+    @property
+    def categorized_keys(self):
+        if self._categorized_keys is None:
+            self._categorized_keys = pickle.loads(self.categorized_keys_pickle) if self.categorized_keys_pickle else {}
+        return self._categorized_keys
+
+    @property
+    def is_current(self):
+        return self.generation == current_generation("TransitApp")
+
+    @staticmethod
+    def get_layout():
+        """Return the stored layout (current or not), or None if there isn't one yet."""
+        return GalleryLayout.get_by_key_name(GalleryLayout.KEY_NAME)
+
+    @staticmethod
+    def build():
+        """Lay out the gallery from scratch, and store the layout. Returns the new layout."""
+        # Anything that changes while we work bumps the generation past this, leaving the layout stale.
+        generation = current_generation("TransitApp")
+        recent_keys = [transit_app.key() for transit_app in TransitApp.all_by_most_recently_added().fetch(GalleryLayout.NUM_RECENT_APPS)]
+        recent_key_set = set(recent_keys)
+        featured_keys = []
+        categorized_keys = dict([(category, []) for category in GalleryLayout.CATEGORIES])
+
+        for transit_app in TransitApp.all_sorted_by_rating().run(batch_size = 100):
+            key = transit_app.key()
+            # if it's recently added, don't show it again
+            if key in recent_key_set:
+                continue
+            # if it's featured, don't show it again
+            if transit_app.is_featured and len(featured_keys) < GalleryLayout.NUM_FEATURED_APPS:
+                featured_keys.append(key)
+                continue
+            for category in transit_app.categories:
+                if category in categorized_keys:
+                    categorized_keys[category].append(key)
+
+        layout = GalleryLayout(
+            key_name = GalleryLayout.KEY_NAME,
+            generation = generation,
+            recent_keys = recent_keys,
+            featured_keys = featured_keys,
+            categorized_keys_pickle = pickle.dumps(categorized_keys, pickle.HIGHEST_PROTOCOL),
+        )
+        layout.put()
+        return layout
+
+    def fetch_transit_apps(self):
+        """Return a (recent apps, featured apps, dictionary of category -> apps) tuple, fetched with a batch get. Apps deleted or hidden since the layout was built are left out."""
+        all_keys = set(self.recent_keys)
+        all_keys.update(self.featured_keys)
+        for keys in self.categorized_keys.itervalues():
+            all_keys.update(keys)
+        all_keys = list(all_keys)
+        transit_apps = {}
+        for keys_chunk in chunk_sequence(all_keys, 100):
+            for key, transit_app in zip(keys_chunk, TransitApp.get(keys_chunk)):
+                if (transit_app is not None) and not transit_app.is_hidden:
+                    transit_apps[key] = transit_app
+
+        def apps_for_keys(keys):
+            return [transit_apps[key] for key in keys if key in transit_apps]
+        categorized_apps = dict([(category, apps_for_keys(keys)) for category, keys in self.categorized_keys.iteritems()])
+        return (apps_for_keys(self.recent_keys), apps_for_keys(self.featured_keys), categorized_apps)
@@ -0,0 +1,208 @@
+import time
+import pickle
+from uuid import uuid4
+from google.appengine.ext import db
+from google.appengine.api.labs import taskqueue
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from geo import geocell
+from geo.geomodel import default_cost_function
+from ..utils.datastore import MAX_IN_FILTER_VALUES
+
+#
+# How many located entities of a kind fall in each geocell, used to plan bounding box searches.
+#
+# The geo library picks the set of cells for a bounding box search with a cost function,
+# and the default one knows nothing about our data: it searches the highest-resolution
+# set of at most 16 cells, whether that box holds one agency or a thousand. With a
+# histogram of entity counts per geocell, cost_function_for() can weigh the number of
+# queries a cell set takes against how many entities those cells will make us fetch
+# (and then throw away, if they're outside the box). A cron job rebuilds the histograms.
+#
+# A histogram's counts are split into one GeocellHistogramShard per top-level geocell
+# (so that no one entity outgrows the datastore's size limit), children of the
+# GeocellHistogram itself. A rebuild counts a batch of entities per task, carrying on
+# from the previous batch's cursor, and writes each batch's counts into a fresh set of
+# shards in the same transaction that queues the next task; the last batch switches
+# the histogram over to the new shards.
+#
+
+# Histograms loaded by this process, keyed by kind name, as (load time, histogram) tuples.
+_loaded_histograms = {}
+
+class GeocellHistogram(db.Model):
+    # Histograms only go this deep; counts for smaller cells are estimated from their ancestor.
+    MAX_RESOLUTION = 8
+
+    # The relative cost of each datastore query, and of fetching each entity.
+    QUERY_COST = 1.0
+    ENTITY_COST = 0.01
+
+    # Unordered bounding box searches use a single IN query, which can't take any more cells than this.
+    MAX_CELLS = MAX_IN_FILTER_VALUES
+
+    entity_count = db.IntegerProperty(default = 0)
+    build_id = db.StringProperty(indexed = False) # which GeocellHistogramShards hold the counts
+    updated = db.DateTimeProperty(auto_now = True)
+
+    def __init__(self, *args, **kwargs):
+        super(GeocellHistogram, self).__init__(*args, **kwargs)
+        self._counts = None
+
+    @property
+    def counts(self):
+        """A dictionary of geocell -> entity count, read from the shards with one batch get."""
+        if self._counts is None:
+            self._counts = {}
+            for shard in GeocellHistogramShard.get_for_build(self.key().name(), self.build_id):
+                if shard is not None:
+                    self._counts.update(shard.counts)
+        return self._counts
+
+    def expected_count(self, cell):
+        """Return the number of entities in the given geocell (or, for cells smaller than MAX_RESOLUTION, an estimate)."""
+        resolution = len(cell)
+        if resolution <= GeocellHistogram.MAX_RESOLUTION:
+            return self.counts.get(cell, 0)
+        # Assume entities are spread evenly across the descendants of the deepest cell we know about.
+        ancestor_count = self.counts.get(cell[:GeocellHistogram.MAX_RESOLUTION], 0)
+        return float(ancestor_count) / pow(16, resolution - GeocellHistogram.MAX_RESOLUTION)
+
+    def cost(self, num_cells, resolution, cells = None, **kwargs):
+        """A geocell cost function: the cost of querying the given cells, given how many entities they hold."""
+        if num_cells > GeocellHistogram.MAX_CELLS:
+            return 1e10000
+        if cells is None:
+            return default_cost_function(num_cells, resolution)
+        expected_entities = sum([self.expected_count(cell) for cell in cells])
+        return (GeocellHistogram.QUERY_COST * num_cells) + (GeocellHistogram.ENTITY_COST * expected_entities)
+
+    @staticmethod
+    def get_for_kind(model_class):
+        """Return the (possibly process-cached) histogram for the given GeoModel class, or None if there isn't one yet."""
+        kind = model_class.kind()
+        now = time.time()
+        loaded = _loaded_histograms.get(kind)
+        if (loaded is None) or (now - loaded[0] > settings.GEOCELL_HISTOGRAM_CHECK_SECONDS):
+            loaded = _loaded_histograms[kind] = (now, GeocellHistogram.get_by_key_name(kind))
+        return loaded[1]
+
+    @staticmethod
+    def cost_function_for(model_class):
+        """Return a cost function for bounding box searches on the given GeoModel class."""
+        histogram = GeocellHistogram.get_for_kind(model_class)
+        if histogram is None:
+            return default_cost_function
+        return histogram.cost
+
+    @staticmethod
+    def start_rebuild(model_class):
+        """Queue up a task to recount the entities of the given GeoModel class in each geocell, a batch at a time."""
+        GeocellHistogram._queue_rebuild_task(model_class.kind(), uuid4().hex, None, 0)
+
+    @staticmethod
+    def rebuild(model_class):
+        """Recount the entities of the given GeoModel class in each geocell, in this request, and store the histogram. Returns the new histogram."""
+        kind = model_class.kind()
+        build_id, cursor, entity_count = uuid4().hex, None, 0
+        while True:
+            cursor, entity_count = GeocellHistogram.rebuild_batch(kind, build_id, cursor, entity_count, in_task = False)
+            if cursor is None:
+                break
+        return GeocellHistogram.get_for_kind(model_class)
+
+    @staticmethod
+    def rebuild_batch(kind, build_id, cursor, entity_count, in_task = True):
+        """Count the next GEOCELL_HISTOGRAM_BATCH_SIZE entities of the kind into the shards of the given build. 
+        
+        Returns the (cursor, entity count) to carry on from, or (None, entity count) once the histogram has switched to the new build.
+        In a task, the next batch is queued up in the same transaction that saves this one's counts."""
+        query = db.class_for_kind(kind).all()
+        if cursor is not None:
+            query.with_cursor(cursor)
+        entities = query.fetch(settings.GEOCELL_HISTOGRAM_BATCH_SIZE)
+        next_cursor = query.cursor() if len(entities) == settings.GEOCELL_HISTOGRAM_BATCH_SIZE else None
+
+        counts = {}
+        for entity in entities:
+            for cell in entity.location_geocells:
+                if len(cell) <= GeocellHistogram.MAX_RESOLUTION:
+                    counts[cell] = counts.get(cell, 0) + 1
+        entity_count += len(entities)
+
+        def save_batch():
+            GeocellHistogramShard.add_counts(kind, build_id, counts)
+            if next_cursor is not None:
+                if in_task:
+                    GeocellHistogram._queue_rebuild_task(kind, build_id, next_cursor, entity_count, transactional = True)
+                return
+            histogram = GeocellHistogram.get_by_key_name(kind)
+            old_build_id = histogram.build_id if histogram is not None else None
+            histogram = GeocellHistogram(key_name = kind, entity_count = entity_count, build_id = build_id)
+            histogram.put()
+            if old_build_id is not None:
+                db.delete(GeocellHistogramShard.keys_for_build(kind, old_build_id))
+        db.run_in_transaction(save_batch)
+
+        if next_cursor is None:
+            _loaded_histograms.pop(kind, None)
+        return (next_cursor, entity_count)
+
+    @staticmethod
+    def _queue_rebuild_task(kind, build_id, cursor, entity_count, transactional = False):
+        params = {"kind": kind, "build_id": build_id, "entity_count": entity_count}
+        if cursor is not None:
+            params["cursor"] = cursor
+        task = taskqueue.Task(url = reverse("taskqueue_rebuild_geocell_histogram"), params = params)
+        task.add(queue_name = "geocell-histogram-queue", transactional = transactional)
+
+
+class GeocellHistogramShard(db.Model):
+    """The counts for the geocells under one top-level geocell, in one build of a GeocellHistogram (its parent)."""
+    counts_pickle = db.BlobProperty() # dictionary of geocell -> entity count, pickled.
+
+    def __init__(self, *args, **kwargs):
+        super(GeocellHistogramShard, self).__init__(*args, **kwargs)
+        self._counts = None
+
+    @property
+    def counts(self):
+        if self._counts is None:
+            self._counts = pickle.loads(self.counts_pickle) if self.counts_pickle else {}
+        return self._counts
+
+    @staticmethod
+    def key_for(kind, build_id, prefix):
+        return db.Key.from_path("GeocellHistogram", kind, "GeocellHistogramShard", "%s-%s" % (build_id, prefix))
+
+    @staticmethod
+    def keys_for_build(kind, build_id):
+        return [GeocellHistogramShard.key_for(kind, build_id, prefix) for prefix in geocell.children("")]
+
+    @staticmethod
+    def get_for_build(kind, build_id):
+        """Return the build's shards (None for top-level cells without any entities), with one batch get."""
+        if build_id is None:
+            return []
+        return GeocellHistogramShard.get(GeocellHistogramShard.keys_for_build(kind, build_id))
+
+    @staticmethod
+    def add_counts(kind, build_id, counts):
+        """Add the dictionary of geocell -> count to the build's shards. All of a kind's shards are in one entity group, so this can run in a transaction."""
+        counts_by_prefix = {}
+        for cell, count in counts.iteritems():
+            counts_by_prefix.setdefault(cell[0], {})[cell] = count
+        if not counts_by_prefix:
+            return
+        prefixes = counts_by_prefix.keys()
+        keys = [GeocellHistogramShard.key_for(kind, build_id, prefix) for prefix in prefixes]
+        shards = []
+        for prefix, key, shard in zip(prefixes, keys, GeocellHistogramShard.get(keys)):
+            if shard is None:
+                shard = GeocellHistogramShard(key_name = key.name(), parent = key.parent())
+            shard_counts = shard.counts
+            for cell, count in counts_by_prefix[prefix].iteritems():
+                shard_counts[cell] = shard_counts.get(cell, 0) + count
+            shard.counts_pickle = pickle.dumps(shard_counts, pickle.HIGHEST_PROTOCOL)
+            shards.append(shard)
+        db.put(shards)
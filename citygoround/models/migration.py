@@ -0,0 +1,40 @@
+import time
+from google.appengine.ext import db
+
+#
+# One-off data migrations.
+#
+# Code that depends on a migrated schema (say, a newly denormalized property that
+# queries filter on) checks Migration.is_done() first, and falls back to the old way
+# until the migration, usually a chain of tasks, marks itself done.
+#
+
+# Names of the migrations this process has seen done (they never come undone), and
+# when it last found each of the others not done yet: name -> time.
+_done_names = set()
+_checked_not_done = {}
+
+class Migration(db.Model):
+    # Keyed by the migration's name.
+    done = db.DateTimeProperty(auto_now_add = True)
+
+    # How long a process trusts a "not done yet" answer.
+    CHECK_SECONDS = 60
+
+    @staticmethod
+    def is_done(name):
+        if name in _done_names:
+            return True
+        now = time.time()
+        if now - _checked_not_done.get(name, 0) < Migration.CHECK_SECONDS:
+            return False
+        if Migration.get_by_key_name(name) is not None:
+            _done_names.add(name)
+            return True
+        _checked_not_done[name] = now
+        return False
+
+    @staticmethod
+    def mark_done(name):
+        Migration.get_or_insert(name)
+        _done_names.add(name)
@@ -1,38 +1,57 @@
 from google.appengine.ext import db
+from .sharded_counter import CounterShard
+
+# Names of the stats this process has made sure are seeded.
+_seeded_names = set()
 
 class NamedStat(db.Model):
-    # low contention model -- don't bother with sharding
+    # Stats now live in sharded counters (see sharded_counter.py); a NamedStat entity
+    # is only read to seed the counter of the same name, once.
     name  = db.StringProperty()
     value = db.FloatProperty()
     
     @staticmethod
-    def get_stat(name):
-        # A "singleton" datastore entry for now
-        stats = NamedStat.all().filter("name =",name).get()
-        if stats is None:
-            stats = NamedStat(name=name, value=0.0)
-            try:
-                stats.put()
-            except db.TimeoutException:
-                stats.put()
-        return stats
-            
+    def _ensure_seeded(name):
+        """Seed the named stat's counter from the NamedStat entity of the same name (if any), unless that's been done already."""
+        if name in _seeded_names:
+            return
+        if not CounterShard.is_seeded(name):
+            legacy_stat = NamedStat.all().filter("name =", name).get()
+            CounterShard.seed(name, legacy_stat.value if legacy_stat is not None else 0.0)
+        _seeded_names.add(name)
+    
     @staticmethod
     def get_value(name):
-        return NamedStat.get_stat(name).value
+        """Return the named stat's value, which may lag increments by up to COUNTER_CACHE_SECONDS."""
+        NamedStat._ensure_seeded(name)
+        return CounterShard.get_value(name)
+        
+    @staticmethod
+    def set_value(name, value):
+        """Overwrite the named stat's value. Not safe to use while it is being incremented."""
+        CounterShard.set_value(name, value)
+        _seeded_names.add(name)
         
     @staticmethod
-    def set_value(name,value):
-        stats = NamedStat.get_stat(name)
-        stats.value = value
-        stats.put()
+    def increment(name, delta = 1.0):
+        """Add delta to the named stat. 
         
+        Return its approximate new value: get_value() (which may lag other increments by up to 
+        COUNTER_CACHE_SECONDS) plus delta. A sharded counter can't cheaply give an exact total."""
+        value = NamedStat.get_value(name)
+        CounterShard.increment(name, delta)
+        return value + delta
+
+    @staticmethod
+    def increment_in_transaction(name, delta = 1.0):
+        """Add delta to the named stat as part of the caller's own (cross-group) transaction. 
+        
+        Queries can't run in a transaction, so call get_value() (which seeds the stat) first, outside it."""
+        CounterShard.increment_in_transaction(name, delta)
+
     @staticmethod
-    def increment(name):
-        stats = NamedStat.get_stat(name)
-        stats.value = stats.value + 1.0
-        try:
-            stats.put()
-        except db.TimeoutException:
-            stats.put()
-        return stats.value
+    def all_stats():
+        """Return a list of {"name": name, "value": value} dictionaries for every stat, sorted by name."""
+        names = set(CounterShard.all_names())
+        names.update([legacy_stat.name for legacy_stat in NamedStat.all()])
+        return [{"name": name, "value": NamedStat.get_value(name)} for name in sorted(names)]
@@ -0,0 +1,106 @@
+import random
+from django.conf import settings
+from google.appengine.ext import db
+from google.appengine.api import memcache
+
+#
+# Sharded counters.
+#
+# A counter kept in a single entity can only be updated so many times a second,
+# and without a transaction concurrent updates overwrite each other. Instead, each
+# named counter is spread over COUNTER_SHARD_COUNT CounterShard entities (each its
+# own entity group); an increment transactionally updates one shard at random, and
+# the value is the sum of all of them, memcached for COUNTER_CACHE_SECONDS.
+#
+# A counter's starting value (say, carried over from an older, unsharded stat) goes
+# in a seed shard of its own, which increments never touch, and which is only ever
+# created, never overwritten; so seeding is safe at any time, and happens only once.
+#
+# COUNTER_SHARD_COUNT may be raised at any time, but never lowered: shards past
+# the count would no longer be read.
+#
+
+class CounterShard(db.Model):
+    name  = db.StringProperty()
+    value = db.FloatProperty(default = 0.0, indexed = False)
+
+    @staticmethod
+    def _key_names(name):
+        return ["%s-%d" % (name, index) for index in range(settings.COUNTER_SHARD_COUNT)]
+
+    @staticmethod
+    def _seed_key_name(name):
+        return "%s-seed" % name
+
+    @staticmethod
+    def _memcache_key(name):
+        return "counter-%s" % name
+
+    @staticmethod
+    def increment(name, delta = 1.0):
+        """Add delta (which may be negative, or fractional) to the named counter."""
+        if not delta:
+            return
+        key_name = random.choice(CounterShard._key_names(name))
+        db.run_in_transaction(CounterShard._increment_in_transaction, name, key_name, float(delta))
+
+    @staticmethod
+    def increment_in_transaction(name, delta = 1.0):
+        """Like increment(), but as part of the caller's own (cross-group) transaction, so that it's applied if and only if that commits."""
+        if not delta:
+            return
+        CounterShard._increment_in_transaction(name, random.choice(CounterShard._key_names(name)), float(delta))
+
+    @staticmethod
+    def _increment_in_transaction(name, key_name, delta):
+        shard = CounterShard.get_by_key_name(key_name)
+        if shard is None:
+            shard = CounterShard(key_name = key_name, name = name)
+        shard.value += delta
+        shard.put()
+
+    @staticmethod
+    def get_value(name, missing = 0.0):
+        """Return the value of the named counter, which may lag increments by up to COUNTER_CACHE_SECONDS. Return missing if there's no such counter."""
+        value = memcache.get(CounterShard._memcache_key(name))
+        if value is None:
+            key_names = CounterShard._key_names(name) + [CounterShard._seed_key_name(name)]
+            shards = [shard for shard in CounterShard.get_by_key_name(key_names) if shard is not None]
+            if not shards:
+                return missing
+            value = sum([shard.value for shard in shards])
+            memcache.set(CounterShard._memcache_key(name), value, time = settings.COUNTER_CACHE_SECONDS)
+        return value
+
+    @staticmethod
+    def is_seeded(name):
+        return CounterShard.get_by_key_name(CounterShard._seed_key_name(name)) is not None
+
+    @staticmethod
+    def seed(name, value):
+        """Add value to the named counter, unless it has been seeded already. Safe to use while it is being incremented. Return True if it was seeded now."""
+        is_seeded_now = db.run_in_transaction(CounterShard._seed_in_transaction, name, float(value))
+        if is_seeded_now:
+            memcache.delete(CounterShard._memcache_key(name))
+        return is_seeded_now
+
+    @staticmethod
+    def _seed_in_transaction(name, value):
+        key_name = CounterShard._seed_key_name(name)
+        if CounterShard.get_by_key_name(key_name) is not None:
+            return False
+        CounterShard(key_name = key_name, name = name, value = value).put()
+        return True
+
+    @staticmethod
+    def set_value(name, value):
+        """Overwrite the named counter's value (and seed it). Not safe to use while it is being incremented; for tests and repairs."""
+        shards = [CounterShard(key_name = CounterShard._seed_key_name(name), name = name, value = float(value))]
+        shards.extend([CounterShard(key_name = key_name, name = name, value = 0.0) for key_name in CounterShard._key_names(name)])
+        db.put(shards)
+        memcache.delete(CounterShard._memcache_key(name))
+
+    @staticmethod
+    def all_names():
+        """Return a sorted list of the names of all counters. Reads every shard; for admin pages."""
+        return sorted(set([shard.name for shard in CounterShard.all()]))
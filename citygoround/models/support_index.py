@@ -0,0 +1,135 @@
+from google.appengine.ext import db
+from ..utils.datastore import normalize_to_key, normalize_to_keys
+from ..utils.misc import chunk_sequence
+
+#
+# An inverted index from agencies to the transit apps that support them.
+#
+# Answering "which apps support this agency?" straight from TransitApp costs two
+# queries per agency (explicit support, plus the "all public agencies" flag), which
+# adds up quickly when you want an answer for every agency at once.
+#
+# Instead we keep one AgencySupportIndex entity per explicitly supported agency,
+# holding the keys of the apps that explicitly support it, along with a single
+# extra entity that holds the keys of all apps flagged as supporting all public
+# agencies. TransitApp.put() and TransitApp.delete() keep the index current, each
+# index entity being updated in a transaction of its own (many apps share the public
+# agencies entity). Writes that bypass TransitApp.put() (like db.put() of several apps)
+# leave the index behind, so a daily cron job rebuild()s it from scratch.
+#
+
+class AgencySupportIndex(db.Model):
+    PUBLIC_AGENCIES_KEY_NAME = "all-public-agencies"
+
+    transit_app_keys            = db.ListProperty(db.Key, indexed = False)
+    visible_transit_app_keys    = db.ListProperty(db.Key, indexed = False)
+
+    def transit_app_keys_for(self, visible_only = True):
+        return self.visible_transit_app_keys if visible_only else self.transit_app_keys
+
+    @staticmethod
+    def key_name_for_agency(agency_or_key):
+        return "agency-%s" % str(normalize_to_key(agency_or_key))
+
+    @staticmethod
+    def get_for_agency(agency_or_key):
+        return AgencySupportIndex.get_by_key_name(AgencySupportIndex.key_name_for_agency(agency_or_key))
+
+    @staticmethod
+    def get_for_public_agencies():
+        return AgencySupportIndex.get_by_key_name(AgencySupportIndex.PUBLIC_AGENCIES_KEY_NAME)
+
+    @staticmethod
+    def transit_app_keys_for_agency(agency_or_key, is_public, visible_only = True):
+        """Return a tuple of (explicitly supporting app keys, public-support app keys) for the agency, using a single batch get."""
+        key_names = [AgencySupportIndex.key_name_for_agency(agency_or_key)]
+        if is_public:
+            key_names.append(AgencySupportIndex.PUBLIC_AGENCIES_KEY_NAME)
+        indexes = AgencySupportIndex.get_by_key_name(key_names)
+        keys = [index.transit_app_keys_for(visible_only) if index else [] for index in indexes]
+        if not is_public:
+            keys.append([])
+        return (keys[0], keys[1])
+
+    @staticmethod
+    def transit_app_keys_for_agencies(agency_keys, any_public, visible_only = True):
+        """Return a list of the keys of apps that support any of the given agencies (explicitly first, then by supporting all public agencies), read with batch gets. May contain duplicates."""
+        key_names = [AgencySupportIndex.key_name_for_agency(key) for key in agency_keys]
+        if any_public:
+            key_names.append(AgencySupportIndex.PUBLIC_AGENCIES_KEY_NAME)
+        transit_app_keys = []
+        for key_names_chunk in chunk_sequence(key_names, 100):
+            for index in AgencySupportIndex.get_by_key_name(key_names_chunk):
+                if index is not None:
+                    transit_app_keys.extend(index.transit_app_keys_for(visible_only))
+        return transit_app_keys
+
+    @staticmethod
+    def reindex_transit_app(transit_app_key, old_agency_keys, old_supports_public, new_agency_keys, new_supports_public, is_visible):
+        """Move a transit app from its previously indexed agencies to its current ones."""
+        old_key_names = [AgencySupportIndex.key_name_for_agency(key) for key in normalize_to_keys(old_agency_keys)]
+        new_key_names = [AgencySupportIndex.key_name_for_agency(key) for key in normalize_to_keys(new_agency_keys)]
+        if old_supports_public:
+            old_key_names.append(AgencySupportIndex.PUBLIC_AGENCIES_KEY_NAME)
+        if new_supports_public:
+            new_key_names.append(AgencySupportIndex.PUBLIC_AGENCIES_KEY_NAME)
+
+        new_key_names = set(new_key_names)
+        for key_name in set(old_key_names) | new_key_names:
+            db.run_in_transaction(AgencySupportIndex._reindex_in_transaction, key_name, transit_app_key, key_name in new_key_names, is_visible)
+
+    @staticmethod
+    def _reindex_in_transaction(key_name, transit_app_key, is_supported, is_visible):
+        index = AgencySupportIndex.get_by_key_name(key_name)
+        if index is None:
+            if not is_supported:
+                return
+            index = AgencySupportIndex(key_name = key_name)
+        index.transit_app_keys = [key for key in index.transit_app_keys if key != transit_app_key]
+        index.visible_transit_app_keys = [key for key in index.visible_transit_app_keys if key != transit_app_key]
+        if is_supported:
+            index.transit_app_keys.append(transit_app_key)
+            if is_visible:
+                index.visible_transit_app_keys.append(transit_app_key)
+        index.put()
+
+    @staticmethod
+    def unindex_transit_app(transit_app_key, old_agency_keys, old_supports_public):
+        """Remove a (deleted) transit app from the index."""
+        AgencySupportIndex.reindex_transit_app(transit_app_key, old_agency_keys, old_supports_public, [], False, False)
+
+    @staticmethod
+    def remove_agencies(agencies_or_keys):
+        """Drop the index entries for agencies that are being deleted."""
+        keys = [db.Key.from_path("AgencySupportIndex", AgencySupportIndex.key_name_for_agency(agency_or_key)) for agency_or_key in agencies_or_keys]
+        for keys_chunk in chunk_sequence(keys, 100):
+            db.delete(keys_chunk)
+
+    @staticmethod
+    def remove_agency(agency_or_key):
+        AgencySupportIndex.remove_agencies([agency_or_key])
+
+    @staticmethod
+    def rebuild(transit_apps):
+        """Recompute the entire index from the given transit apps (which should include hidden ones). Returns the number of apps indexed."""
+        indexes = {}
+        transit_app_count = 0
+        for transit_app in transit_apps:
+            transit_app_count += 1
+            key_names = set([AgencySupportIndex.key_name_for_agency(key) for key in transit_app.explicitly_supported_agency_keys])
+            if transit_app.supports_all_public_agencies:
+                key_names.add(AgencySupportIndex.PUBLIC_AGENCIES_KEY_NAME)
+            for key_name in key_names:
+                index = indexes.get(key_name)
+                if index is None:
+                    index = indexes[key_name] = AgencySupportIndex(key_name = key_name)
+                index.transit_app_keys.append(transit_app.key())
+                if not transit_app.is_hidden:
+                    index.visible_transit_app_keys.append(transit_app.key())
+
+        stale_keys = [key for key in AgencySupportIndex.all(keys_only = True) if key.name() not in indexes]
+        for stale_keys_chunk in chunk_sequence(stale_keys, 100):
+            db.delete(stale_keys_chunk)
+        for indexes_chunk in chunk_sequence(indexes.values(), 100):
+            db.put(indexes_chunk)
+        return transit_app_count
@@ -4,17 +4,22 @@ from decimal import Decimal
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.utils.safestring import SafeString
+from django.utils import simplejson as json
 from google.appengine.ext import db
+from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
+from geo import geocell, geotypes
 from geo.geomodel import GeoModel
 from .agency import Agency
 from .imageblob import ImageBlob
 from ..properties import DecimalProperty
 from ..utils.slug import slugify
-from ..utils.datastore import key_and_entity, normalize_to_key, normalize_to_keys, unique_entities, iter_uniquify
+from ..utils.datastore import key_and_entity, normalize_to_key, normalize_to_keys, unique_entities, iter_uniquify, unique_keys_in_order, get_in_chunks
 from ..utils.places import CityInfo
 from ..utils.geohelpers import square_bounding_box_centered_at
-from ..utils.misc import key_for_value
-from ..models import NamedStat
+from ..utils.misc import key_for_value, chunk_sequence
+from ..utils.generation import bump_generation, generations_key
+from ..models import NamedStat, AgencySupportIndex, GeocellHistogram, EntityCount, Migration
 import cgi
 
 
@@ -72,6 +77,10 @@ import cgi
 # agencies, including public ones, rather than maintaining a flag. But I think that could get
 # problematic in other ways...)
 #
+# To keep agency -> app lookups cheap, put() and delete() also maintain an
+# AgencySupportIndex (see support_index.py) that maps each agency to the apps
+# that support it.
+#
 
 class TransitApp(db.Model):
     PLATFORMS = { 
@@ -164,39 +173,127 @@ class TransitApp(db.Model):
     def __init__(self, *args, **kwargs):
         super(TransitApp, self).__init__(*args, **kwargs)
         self.slug = slugify(self.title)
+        # Remember what the AgencySupportIndex currently says about us, so put() only touches it when something changed.
+        self._indexed_support = self._support_state() if kwargs.get('_from_entity') else None
+        # Likewise for the EntityCounts.
+        self._counted_state = self._count_state() if kwargs.get('_from_entity') else None
     
     def __str__(self):
         return "%s (%s)" % (self.title, self.url)
+        
+    def _support_state(self):
+        return (frozenset(self.explicitly_supported_agency_keys), bool(self.supports_all_public_agencies), bool(self.is_hidden))
+        
+    def _count_state(self):
+        return (not self.is_hidden, frozenset(self.categories))
+        
+    @staticmethod
+    def _count_deltas(old_count_state, new_count_state):
+        """Return a dictionary of EntityCount name -> delta, for an app going from one count state to another (either may be None, for no app)."""
+        deltas = {}
+        for count_state, sign in ((old_count_state, -1), (new_count_state, 1)):
+            if count_state is not None:
+                is_visible, categories = count_state
+                if is_visible:
+                    deltas[EntityCount.VISIBLE_TRANSIT_APPS] = deltas.get(EntityCount.VISIBLE_TRANSIT_APPS, 0) + sign
+                    for category in categories:
+                        name = EntityCount.name_for_category(category)
+                        deltas[name] = deltas.get(name, 0) + sign
+        return deltas
+        
+    def put(self, *args, **kwargs):
+        """Save the app. Pass bump_generation = False for changes (like a new rating) that needn't invalidate every cached page and API answer about apps."""
+        should_bump_generation = kwargs.pop('bump_generation', True)
+        key = super(TransitApp, self).put(*args, **kwargs)
+        support_state = self._support_state()
+        if support_state != self._indexed_support:
+            old_agency_keys, old_supports_public, old_is_hidden = self._indexed_support or ((), False, False)
+            new_agency_keys, new_supports_public, new_is_hidden = support_state
+            AgencySupportIndex.reindex_transit_app(key, old_agency_keys, old_supports_public, new_agency_keys, new_supports_public, not new_is_hidden)
+            if old_is_hidden != new_is_hidden:
+                TransitAppLocation.set_hidden_for_transit_app(key, new_is_hidden)
+            self._indexed_support = support_state
+        count_state = self._count_state()
+        if count_state != self._counted_state:
+            EntityCount.adjust(TransitApp._count_deltas(self._counted_state, count_state))
+            self._counted_state = count_state
+        if should_bump_generation:
+            bump_generation("TransitApp")
+        return key
+        
+    def delete(self, *args, **kwargs):
+        key = self.key()
+        super(TransitApp, self).delete(*args, **kwargs)
+        if self._indexed_support is not None:
+            old_agency_keys, old_supports_public, old_is_hidden = self._indexed_support
+            AgencySupportIndex.unindex_transit_app(key, old_agency_keys, old_supports_public)
+            self._indexed_support = None
+        if self._counted_state is not None:
+            EntityCount.adjust(TransitApp._count_deltas(self._counted_state, None))
+            self._counted_state = None
+        AppliedRatingVotes.delete_for_transit_app(key)
+        bump_generation("TransitApp")
+    
+    # How to compute each field of to_jsonable(), so that we can compute just some of them.
+    JSONABLE_FIELDS = {
+        "title": lambda transit_app: cgi.escape(transit_app.title),
+        "slug": lambda transit_app: transit_app.slug,
+        "description": lambda transit_app: cgi.escape(transit_app.description),
+        "rating": lambda transit_app: transit_app.average_rating,
+        "rating_count": lambda transit_app: transit_app.rating_count,
+        "url": lambda transit_app: str(transit_app.url),
+        "price": lambda transit_app: str(transit_app.price),
+        "is_free": lambda transit_app: transit_app.is_free,
+        "author_name": lambda transit_app: cgi.escape(str(transit_app.author_name)), # DO NOT INCLUDE AUTHOR EMAIL.
+        "long_description": lambda transit_app: cgi.escape(transit_app.long_description),
+        "tags": lambda transit_app: [cgi.escape(tag) for tag in transit_app.tags], # NOTE davepeck: while editing code near here, I filed CGR Bug 117 about this line of code.
+        "platforms": lambda transit_app: [cgi.escape(platform) for platform in transit_app.platforms], # NOTE davepeck: while editing code near here, I filed CGR Bug 117 about this line of code.
+        "is_featured": lambda transit_app: transit_app.is_featured,
+        "details_url": lambda transit_app: transit_app.details_url,
+        "bayesian_average": lambda transit_app: transit_app.bayesian_average,
+        "average_rating_out_of_80": lambda transit_app: transit_app.average_rating_out_of_80,
+        "categories": lambda transit_app: [category for category in transit_app.categories], # Note that bug 117 doesn't apply here -- I don't escape this.
+        "default_300w_screen_shot_url": lambda transit_app: transit_app.default_300w_screen_shot_url,
+        "default_145w_screen_shot_url": lambda transit_app: transit_app.default_145w_screen_shot_url,
+        "default_180sq_screen_shot_url": lambda transit_app: transit_app.default_180sq_screen_shot_url,
+        "default_80sq_screen_shot_url": lambda transit_app: transit_app.default_80sq_screen_shot_url,
+    }
     
-    def to_jsonable(self, include_visibility = False):
-        jsonable = {
-            "title": cgi.escape(self.title),
-            "slug": self.slug,
-            "description": cgi.escape(self.description),
-            "rating": self.average_rating,
-            "rating_count": self.rating_count,
-            "url": str(self.url),
-            "price": str(self.price),
-            "is_free": self.is_free,
-            "author_name": cgi.escape(str(self.author_name)), # DO NOT INCLUDE AUTHOR EMAIL.
-            "long_description": cgi.escape(self.long_description),
-            "tags": [cgi.escape(tag) for tag in self.tags], # NOTE davepeck: while editing code near here, I filed CGR Bug 117 about this line of code.
-            "platforms": [cgi.escape(platform) for platform in self.platforms], # NOTE davepeck: while editing code near here, I filed CGR Bug 117 about this line of code.
-            "is_featured": self.is_featured,
-            "details_url": self.details_url,
-            "bayesian_average": self.bayesian_average,
-            "average_rating_out_of_80": self.average_rating_out_of_80,
-            "categories": [category for category in self.categories], # Note that bug 117 doesn't apply here -- I don't escape this.
-            "default_300w_screen_shot_url": self.default_300w_screen_shot_url,
-            "default_145w_screen_shot_url": self.default_145w_screen_shot_url,
-            "default_180sq_screen_shot_url": self.default_180sq_screen_shot_url,
-            "default_80sq_screen_shot_url": self.default_80sq_screen_shot_url,
-        }
-        
-        if include_visibility:
+    # Fields clients may ask for; is_hidden is only ever included along with the visibility.
+    JSONABLE_FIELD_NAMES = frozenset(JSONABLE_FIELDS.keys() + ["is_hidden"])
+    
+    def to_jsonable(self, include_visibility = False, fields = None):
+        """Return a jsonable dictionary of the app, with just the given fields (all of them, if None)."""
+        jsonable = dict([(field, TransitApp.JSONABLE_FIELDS[field](self)) for field in (fields or TransitApp.JSONABLE_FIELDS) if field in TransitApp.JSONABLE_FIELDS])
+        
+        if include_visibility and ((fields is None) or ("is_hidden" in fields)):
             jsonable["is_hidden"] = self.is_hidden
         
         return jsonable
+        
+    @staticmethod
+    def iter_json_fragments(transit_apps, fields = None, include_visibility = False, chunk_size = 100):
+        """Like json_fragments(), but works through the transit apps (say, a query) a chunk at a time."""
+        for transit_apps_chunk in chunk_sequence(transit_apps, chunk_size):
+            for fragment in TransitApp.json_fragments(transit_apps_chunk, fields, include_visibility = include_visibility):
+                yield fragment
+        
+    @staticmethod
+    def json_fragments(transit_apps, fields = None, include_visibility = False):
+        """Return a list of the JSON encodings of the given transit apps' to_jsonable(), with just the given fields.
+        
+        Encodings are memcached per app, date_last_updated (which every put() changes) and fields."""
+        transit_apps = list(transit_apps)
+        fields_key = ",".join(fields) if fields is not None else None
+        memcache_keys = ["transit-app-json-%s-%s-%r-%s" % (transit_app.key(), transit_app.date_last_updated.isoformat() if transit_app.date_last_updated else None, include_visibility, fields_key) for transit_app in transit_apps]
+        fragments = memcache.get_multi(memcache_keys)
+        missing_fragments = {}
+        for memcache_key, transit_app in zip(memcache_keys, transit_apps):
+            if memcache_key not in fragments:
+                fragments[memcache_key] = missing_fragments[memcache_key] = json.dumps(transit_app.to_jsonable(include_visibility = include_visibility, fields = fields))
+        if missing_fragments:
+            memcache.set_multi(missing_fragments, time = settings.MEMCACHE_API_SECONDS)
+        return [fragments[memcache_key] for memcache_key in memcache_keys]
 
     @staticmethod
     def query_all(visible_only = True):
@@ -359,14 +456,13 @@ class TransitApp(db.Model):
         
     @staticmethod
     def iter_for_agency(agency_or_key, uniquify = True, visible_only = True):
-        """Return an iterator over TransitApp entities, by default unique, that support the given agency."""
+        """Return an iterator over TransitApp entities, by default unique, that support the given agency. Reads the AgencySupportIndex rather than querying."""
         seen_set = set()
         agency_key, agency = key_and_entity(agency_or_key, Agency)
-        for transit_app_with_explicit_support in iter_uniquify(TransitApp.query_all(visible_only = visible_only).filter('explicitly_supported_agency_keys =', agency_key), seen_set, uniquify):
-            yield transit_app_with_explicit_support        
-        if agency.is_public:
-            for transit_app_with_public_support in iter_uniquify(TransitApp.all_supporting_public_agencies(visible_only = visible_only), seen_set, uniquify):
-                yield transit_app_with_public_support
+        explicit_keys, public_keys = AgencySupportIndex.transit_app_keys_for_agency(agency_key, agency.is_public, visible_only = visible_only)
+        transit_apps = TransitApp.get(explicit_keys + public_keys)
+        for transit_app in iter_uniquify([transit_app for transit_app in transit_apps if transit_app is not None and not (visible_only and transit_app.is_hidden)], seen_set, uniquify):
+            yield transit_app
 
     @staticmethod
     def fetch_for_agencies(agencies_or_keys, uniquify = True, visible_only = True):
@@ -375,11 +471,56 @@ class TransitApp(db.Model):
         
     @staticmethod
     def iter_for_agencies(agencies_or_keys, uniquify = True, visible_only = True):
-        """Return an iterator over TransitApp entities, by default unique, that support at least one of the given agencies."""
-        seen_set = set()
-        for agency_or_key in agencies_or_keys:
-            for transit_app in iter_uniquify(TransitApp.iter_for_agency(agency_or_key, uniquify = False, visible_only = visible_only), seen_set, uniquify):
+        """Return an iterator over TransitApp entities, by default unique, that support at least one of the given agencies.
+        
+        When uniquifying, the supporting apps are read from the AgencySupportIndex with batch gets, rather than queried."""
+        if not uniquify:
+            # Without uniquify, callers expect one result per supported agency, so walk them one at a time.
+            for agency_or_key in agencies_or_keys:
+                for transit_app in TransitApp.iter_for_agency(agency_or_key, uniquify = False, visible_only = visible_only):
+                    yield transit_app
+            return
+            
+        transit_app_keys = TransitApp.keys_for_agencies(agencies_or_keys, visible_only = visible_only)
+        for transit_app_keys_chunk in chunk_sequence(transit_app_keys, 100):
+            for transit_app in TransitApp.fetch_by_keys(transit_app_keys_chunk, visible_only = visible_only):
                 yield transit_app
+
+    @staticmethod
+    def keys_for_agency(agency_or_key, visible_only = True):
+        """Return a list of the unique keys of TransitApps that support the given agency, read from the AgencySupportIndex."""
+        agency_key, agency = key_and_entity(agency_or_key, Agency)
+        explicit_keys, public_keys = AgencySupportIndex.transit_app_keys_for_agency(agency_key, agency.is_public, visible_only = visible_only)
+        return unique_keys_in_order(explicit_keys + public_keys)
+
+    @staticmethod
+    def keys_for_agencies(agencies_or_keys, visible_only = True):
+        """Return a list of the unique keys of TransitApps that support at least one of the given agencies, read from the AgencySupportIndex."""
+        agency_keys, any_public = TransitApp._agency_keys_and_any_public(agencies_or_keys)
+        return unique_keys_in_order(AgencySupportIndex.transit_app_keys_for_agencies(agency_keys, any_public, visible_only = visible_only))
+
+    @staticmethod
+    def fetch_by_keys(transit_app_keys, visible_only = True):
+        """Return a list of the TransitApps with the given keys that still exist and, by default, are visible."""
+        # The index's visible keys are a denormalized copy, so double-check against the apps themselves.
+        return [transit_app for transit_app in get_in_chunks(TransitApp, transit_app_keys) if not (visible_only and transit_app.is_hidden)]
+                
+    @staticmethod
+    def _agency_keys_and_any_public(agencies_or_keys):
+        """Return the unique agency keys (in order) and whether any of the agencies is public. Bare keys are resolved with one batch get."""
+        agencies_or_keys = list(agencies_or_keys)
+        agency_keys = []
+        seen_set = set()
+        for agency_key in normalize_to_keys(agencies_or_keys):
+            if agency_key not in seen_set:
+                seen_set.add(agency_key)
+                agency_keys.append(agency_key)
+        agencies = [agency_or_key for agency_or_key in agencies_or_keys if not isinstance(agency_or_key, db.Key)]
+        bare_keys = [agency_or_key for agency_or_key in agencies_or_keys if isinstance(agency_or_key, db.Key)]
+        any_public = any(agency.is_public for agency in agencies)
+        if bare_keys and not any_public:
+            any_public = any(agency.is_public for agency in Agency.get(bare_keys) if agency is not None)
+        return (agency_keys, any_public)
         
     def get_supported_location_list(self):
         list = self.explicitly_supported_city_details + self.explicitly_supported_countries
@@ -410,7 +551,7 @@ class TransitApp(db.Model):
             raise Exception("You must pass in a CityInfo object.")
         self.explicitly_supported_city_slugs.append(city_info.name_slug)
         self.explicitly_supported_city_details.append(city_info.important_details)
-        return TransitAppLocation(transit_app = self.key(), city_slug = city_info.name_slug, city_details = city_info.important_details, location = db.GeoPt(city_info.latitude, city_info.longitude))
+        return TransitAppLocation(transit_app = self.key(), is_hidden = bool(self.is_hidden), city_slug = city_info.name_slug, city_details = city_info.important_details, location = db.GeoPt(city_info.latitude, city_info.longitude))
         
     def add_explicitly_supported_city_info_lazy(self, city_info):
         """Helper to set up relations for city information. Returns a function that will create a corresponding transit app location. You must put() that."""
@@ -418,7 +559,7 @@ class TransitApp(db.Model):
             raise Exception("You must pass in a CityInfo object.")
         self.explicitly_supported_city_slugs.append(city_info.name_slug)
         self.explicitly_supported_city_details.append(city_info.important_details)
-        return lambda: TransitAppLocation(transit_app = self.key(), city_slug = city_info.name_slug, city_details = city_info.important_details, location = db.GeoPt(city_info.latitude, city_info.longitude))
+        return lambda: TransitAppLocation(transit_app = self.key(), is_hidden = bool(self.is_hidden), city_slug = city_info.name_slug, city_details = city_info.important_details, location = db.GeoPt(city_info.latitude, city_info.longitude))
         
     def add_explicitly_supported_city_info_immediate(self, city_info):
         """Helper to set up relations for city information. Immediately adds the TransitAppLocation object to the data store."""
@@ -470,13 +611,15 @@ class TransitApp(db.Model):
         return self.rating_count
     
     def refresh_bayesian_average(self, all_rating_sum=None, all_rating_count=None):
-        all_rating_sum = all_rating_sum or NamedStat.get_stat( "all_rating_sum" )
-        all_rating_count = all_rating_count or NamedStat.get_stat( "all_rating_count" )
+        if all_rating_sum is None:
+            all_rating_sum = NamedStat.get_value( "all_rating_sum" )
+        if all_rating_count is None:
+            all_rating_count = NamedStat.get_value( "all_rating_count" )
         
-        Cm = all_rating_sum.value
+        Cm = all_rating_sum
         sumx = self.rating_sum
         n = self.rating_count
-        C = all_rating_count.value
+        C = all_rating_count
         
         if (n+C)>0:
             bayesian_average = (Cm + sumx)/float(n+C)
@@ -517,8 +660,29 @@ class TransitApp(db.Model):
 
     @staticmethod
     def fetch_transit_apps_near(latitude, longitude, max_results = 500, bbox_side_in_miles = settings.BBOX_SIDE_IN_MILES, visible_only = True):
-        raw_transit_apps = [transit_app_location.transit_app for transit_app_location in TransitAppLocation.fetch_transit_app_locations_near(latitude, longitude, query = None, max_results = max_results, bbox_side_in_miles = bbox_side_in_miles)]
-        return [transit_app for transit_app in raw_transit_apps if not (visible_only and transit_app.is_hidden)]
+        query = None
+        if visible_only:
+            if Migration.is_done(TransitAppLocation.IS_HIDDEN_MIGRATION):
+                query = TransitAppLocation.all().filter('is_hidden =', False)
+            else:
+                # Older locations have no is_hidden flag to filter on until the backfill is done; the apps get checked below either way.
+                TransitAppLocation.start_is_hidden_backfill()
+        transit_app_locations = TransitAppLocation.fetch_transit_app_locations_near(latitude, longitude, query = query, max_results = max_results, bbox_side_in_miles = bbox_side_in_miles)
+        
+        # Dereference the locations' transit apps with batch gets, rather than one get per location (and per duplicate app).
+        transit_app_keys = []
+        seen_keys = set()
+        for transit_app_location in transit_app_locations:
+            transit_app_key = TransitAppLocation.transit_app.get_value_for_datastore(transit_app_location)
+            if transit_app_key not in seen_keys:
+                seen_keys.add(transit_app_key)
+                transit_app_keys.append(transit_app_key)
+        raw_transit_apps = []
+        for transit_app_keys_chunk in chunk_sequence(transit_app_keys, 100):
+            raw_transit_apps.extend(TransitApp.get(transit_app_keys_chunk))
+        
+        # The locations' is_hidden flags are a denormalized copy, so double-check against the apps themselves.
+        return [transit_app for transit_app in raw_transit_apps if (transit_app is not None) and not (visible_only and transit_app.is_hidden)]
     
     @staticmethod
     def iter_for_location_and_country_code(latitude, longitude, country_code, bbox_side_in_miles = settings.BBOX_SIDE_IN_MILES, uniquify = True, visible_only = True):
@@ -528,7 +692,7 @@ class TransitApp(db.Model):
         agencies_nearby = Agency.fetch_agencies_near(latitude, longitude, bbox_side_in_miles = bbox_side_in_miles)
         
         #    (And then, what transit apps support those agencies?)
-        transit_apps_for_agencies = TransitApp.fetch_for_agencies(agencies_nearby, uniquify = False, visible_only = visible_only)
+        transit_apps_for_agencies = TransitApp.fetch_for_agencies(agencies_nearby, visible_only = visible_only)
         for transit_app in iter_uniquify(transit_apps_for_agencies, seen_set, uniquify):
             yield transit_app
         
@@ -550,17 +714,64 @@ class TransitApp(db.Model):
     @staticmethod
     def fetch_for_location_and_country_code(latitude, longitude, country_code, bbox_side_in_miles = settings.BBOX_SIDE_IN_MILES, uniquify = True, visible_only = True):
         return [transit_app for transit_app in TransitApp.iter_for_location_and_country_code(latitude, longitude, country_code, uniquify = uniquify, bbox_side_in_miles = bbox_side_in_miles, visible_only = visible_only)]
+
+    @staticmethod
+    def keys_for_geocell_and_country_code(cell, country_code, visible_only = True):
+        """Return the keys of the transit apps found by a location search from the center of the given geocell.
+        
+        The keys are memcached per (cell, country code), so that every search from inside the same cell shares one answer."""
+        memcache_key = "transit-app-keys-for-geocell-%s-%s-%s-%r" % (generations_key(("Agency", "TransitApp")), cell, country_code, visible_only)
+        transit_app_keys = memcache.get(memcache_key)
+        if transit_app_keys is None:
+            box = geocell.compute_box(cell)
+            latitude = (box.north + box.south) / 2.0
+            longitude = (box.east + box.west) / 2.0
+            transit_app_keys = [transit_app.key() for transit_app in TransitApp.iter_for_location_and_country_code(latitude, longitude, country_code, visible_only = visible_only)]
+            memcache.set(memcache_key, transit_app_keys, time = settings.MEMCACHE_API_SECONDS)
+        return transit_app_keys
+        
+    @staticmethod
+    def fetch_for_geocell_and_country_code(latitude, longitude, country_code, resolution = settings.APPS_SEARCH_GEOCELL_RESOLUTION, visible_only = True):
+        """Like fetch_for_location_and_country_code(), but searches from the center of the geocell containing lat/lon, and caches the answer.
+        
+        Apps added since the answer was cached won't show up until it expires; apps since deleted or hidden are left out."""
+        cell = geocell.compute(geotypes.Point(latitude, longitude), resolution)
+        transit_app_keys = TransitApp.keys_for_geocell_and_country_code(cell, country_code, visible_only = visible_only)
+        transit_apps = []
+        for transit_app_keys_chunk in chunk_sequence(transit_app_keys, 100):
+            transit_apps.extend(TransitApp.get(transit_app_keys_chunk))
+        return [transit_app for transit_app in transit_apps if (transit_app is not None) and not (visible_only and transit_app.is_hidden)]
             
     @staticmethod
     def count_apps_in_category(category, visible_only = True):
+        if visible_only:
+            return EntityCount.get_value(EntityCount.name_for_category(category))
         return TransitApp.query_all(visible_only = visible_only).filter("categories =", category).count()
         
+    @staticmethod
+    def recount():
+        """Return a dictionary of EntityCount name -> count of visible transit apps (overall and per category), counted from scratch."""
+        counts = dict([(EntityCount.name_for_category(category), 0) for category in TransitApp.CATEGORIES.values()])
+        counts[EntityCount.VISIBLE_TRANSIT_APPS] = 0
+        for transit_app in TransitApp.query_all(visible_only = True).run(batch_size = 100):
+            for name, delta in TransitApp._count_deltas(None, transit_app._count_state()).iteritems():
+                counts[name] = counts.get(name, 0) + delta
+        return counts
+        
     @staticmethod
     def agency_app_counts(visible_only = True):
-        #TODO: this always runs so slowly it times out
+        """Return a dictionary of encoded agency key -> number of supporting transit apps, read from the AgencySupportIndex."""
+        public_index = AgencySupportIndex.get_for_public_agencies()
+        public_keys = set(public_index.transit_app_keys_for(visible_only)) if public_index else set()
+        explicit_keys = {}
+        for index in AgencySupportIndex.all():
+            explicit_keys[index.key().name()] = index.transit_app_keys_for(visible_only)
         ret = {}
         for agency in Agency.all():
-            ret[str(agency.key())] = len(list(TransitApp.iter_for_agency(agency, visible_only = visible_only)))
+            supporting_keys = set(explicit_keys.get(AgencySupportIndex.key_name_for_agency(agency), []))
+            if agency.is_public:
+                supporting_keys |= public_keys
+            ret[str(agency.key())] = len(supporting_keys)
         return ret
 
 
@@ -569,6 +780,10 @@ class TransitAppLocation(GeoModel):
     transit_app = db.ReferenceProperty(TransitApp, collection_name = "explicitly_supported_locations")
     city_slug = db.StringProperty()
     city_details = db.StringProperty()
+    is_hidden = db.BooleanProperty(default = False) # denormalized from transit_app, so that searches can leave out hidden apps
+    
+    # Marks locations saved before is_hidden existed as having been given it. See backfill_is_hidden_batch().
+    IS_HIDDEN_MIGRATION = "transit-app-location-is-hidden"
     
     def __init__(self, *args, **kwargs):
         super(TransitAppLocation, self).__init__(*args, **kwargs)
@@ -582,7 +797,58 @@ class TransitAppLocation(GeoModel):
         bounding_box = square_bounding_box_centered_at(latitude, longitude, bbox_side_in_miles)
         if query is None:
             query = TransitAppLocation.all()
-        return TransitAppLocation.bounding_box_fetch(query, bounding_box, max_results = max_results)
+        return TransitAppLocation.bounding_box_fetch(query, bounding_box, max_results = max_results, cost_function = GeocellHistogram.cost_function_for(TransitAppLocation))
+
+    @staticmethod
+    def set_hidden_for_transit_app(transit_app_or_key, is_hidden):
+        """Copy a transit app's is_hidden flag to all of its locations. TransitApp.put() calls this for you."""
+        changed = [transit_app_location for transit_app_location in TransitAppLocation.all().filter('transit_app =', normalize_to_key(transit_app_or_key)) if transit_app_location.is_hidden != is_hidden]
+        for transit_app_location in changed:
+            transit_app_location.is_hidden = is_hidden
+        for changed_chunk in chunk_sequence(changed, 100):
+            db.put(changed_chunk)
+
+    @staticmethod
+    def start_is_hidden_backfill():
+        """Queue up the first task of the is_hidden backfill, unless this process already has (or anyone has, lately)."""
+        global _is_hidden_backfill_started
+        if _is_hidden_backfill_started:
+            return
+        _is_hidden_backfill_started = True
+        task = taskqueue.Task(
+            url = reverse("taskqueue_backfill_location_is_hidden"),
+            name = "backfill-%s" % TransitAppLocation.IS_HIDDEN_MIGRATION,
+        )
+        try:
+            task.add(queue_name = "migration-queue")
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    @staticmethod
+    def backfill_is_hidden_batch(cursor = None):
+        """Copy their apps' is_hidden flags to the next MIGRATION_BATCH_SIZE locations. Returns the cursor to carry on from, or None (having marked the migration done) after the last batch."""
+        query = TransitAppLocation.all()
+        if cursor is not None:
+            query.with_cursor(cursor)
+        transit_app_locations = query.fetch(settings.MIGRATION_BATCH_SIZE)
+        next_cursor = query.cursor() if len(transit_app_locations) == settings.MIGRATION_BATCH_SIZE else None
+        
+        transit_app_keys = list(set([TransitAppLocation.transit_app.get_value_for_datastore(transit_app_location) for transit_app_location in transit_app_locations]))
+        hidden_keys = set()
+        for transit_app_keys_chunk in chunk_sequence(transit_app_keys, 100):
+            hidden_keys.update([transit_app.key() for transit_app in TransitApp.get(transit_app_keys_chunk) if (transit_app is not None) and transit_app.is_hidden])
+        for transit_app_location in transit_app_locations:
+            transit_app_location.is_hidden = TransitAppLocation.transit_app.get_value_for_datastore(transit_app_location) in hidden_keys
+        # Every location is saved, so that even those whose flag was already right get it stored (and indexed).
+        for transit_app_locations_chunk in chunk_sequence(transit_app_locations, 100):
+            db.put(transit_app_locations_chunk)
+        
+        if next_cursor is None:
+            Migration.mark_done(TransitAppLocation.IS_HIDDEN_MIGRATION)
+        return next_cursor
+
+# Whether this process has queued up the is_hidden backfill.
+_is_hidden_backfill_started = False
 
 
 class TransitAppFormProgress(db.Model):
@@ -600,4 +866,27 @@ class TransitAppFormProgress(db.Model):
     @staticmethod
     def get_with_uuid(uuid):
         return TransitAppFormProgress.all().filter('progress_uuid =', uuid).get()
-    
\ No newline at end of file
+    
+
+
+class AppliedRatingVotes(db.Model):
+    """The names of the queued rating votes most recently folded into a transit app (its parent), so that 
+    votes leased again after a failure aren't counted twice. See fold_rating_votes() in utils/ratings.py."""
+    task_names = db.StringListProperty(indexed = False)
+    
+    KEY_NAME = "applied"
+    
+    @staticmethod
+    def get_for_transit_app(transit_app_key):
+        applied_votes = AppliedRatingVotes.get_by_key_name(AppliedRatingVotes.KEY_NAME, parent = transit_app_key)
+        if applied_votes is None:
+            applied_votes = AppliedRatingVotes(key_name = AppliedRatingVotes.KEY_NAME, parent = transit_app_key)
+        return applied_votes
+    
+    @staticmethod
+    def delete_for_transit_app(transit_app_key):
+        db.delete(db.Key.from_path("AppliedRatingVotes", AppliedRatingVotes.KEY_NAME, parent = transit_app_key))
+    
+    def remember(self, task_names):
+        """Note that the named votes were applied. Only the last RATING_VOTE_APPLIED_NAMES_KEPT names are kept: their tasks are deleted right after, or leased again within minutes."""
+        self.task_names = (self.task_names + list(task_names))[-settings.RATING_VOTE_APPLIED_NAMES_KEPT:]
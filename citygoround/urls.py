@@ -22,6 +22,8 @@ urlpatterns += patterns(
     url(r'^admin/memcache-statistics/json/$', 'admin_memcache_statistics_json', name='admin_memcache_statistics_json'),
     url(r'^admin/clear-memcache/$', 'admin_clear_memcache', name='admin_clear_memcache'),
     url(r'^admin/all-transit-apps.csv$', 'admin_apps_csv', name='admin_apps_csv'),
+    url(r'^admin/geocell-histograms/rebuild/$', 'admin_rebuild_geocell_histograms', name='admin_rebuild_geocell_histograms'),
+    url(r'^admin/entity-counts/reconcile/$', 'admin_reconcile_entity_counts', name='admin_reconcile_entity_counts'),
 )
 
 
@@ -60,6 +62,7 @@ urlpatterns += patterns(
     url(r'^admin/agencies/add/$', 'edit_agency', name='admin_agencies_add'),
     url(r'^admin/agencies/update-locations/$', 'admin_agencies_update_locations', name='admin_agencies_update_locations'),
     url(r'^admin/agencies/appcounts/$', 'agency_app_counts', name='agency_app_counts'),
+    url(r'^admin/agencies/appcounts/rebuild/$', 'rebuild_agency_support_index', name='rebuild_agency_support_index'),
     url(r'^admin/agencies/makepublic/$', 'make_everything_public', name='make_everything_public'),
 )
 
@@ -86,6 +89,7 @@ urlpatterns += patterns(
     url(r'^admin/apps/delete/(?P<transit_app_slug>[\w-]+)/$', 'admin_apps_delete', name='admin_apps_delete'),
     url(r'^admin/apps/hide-unhide/(?P<transit_app_slug>[\w-]+)/$', 'admin_apps_hide_unhide', name='admin_apps_hide_unhide'),
     url(r'^admin/apps/bayes/refresh/$', 'refresh_all_bayesian_averages', name='refresh_all_bayesian_averages'),
+    url(r'^admin/apps/ratings/fold/$', 'admin_apps_fold_rating_votes', name='admin_apps_fold_rating_votes'),
     url(r'^admin/apps/update-schema/$', 'admin_apps_update_schema', name='admin_apps_update_schema'),
 )
 
@@ -109,5 +113,8 @@ urlpatterns += patterns(
     'citygoround.views.taskqueue',
     url(r'^admin/taskqueue/screen-shot-resize/', 'taskqueue_screen_shot_resize', name = 'taskqueue_screen_shot_resize'),
     url(r'^admin/taskqueue/notify-new-app/', 'taskqueue_notify_new_app', name = 'taskqueue_notify_new_app'),
+    url(r'^admin/taskqueue/rebuild-gallery-layout/', 'taskqueue_rebuild_gallery_layout', name = 'taskqueue_rebuild_gallery_layout'),
+    url(r'^admin/taskqueue/rebuild-geocell-histogram/', 'taskqueue_rebuild_geocell_histogram', name = 'taskqueue_rebuild_geocell_histogram'),
+    url(r'^admin/taskqueue/backfill-location-is-hidden/', 'taskqueue_backfill_location_is_hidden', name = 'taskqueue_backfill_location_is_hidden'),
 )
     
@@ -0,0 +1,173 @@
+import math
+import gzip
+from StringIO import StringIO
+from django.utils import simplejson as json
+
+#
+# The agency catalogue is small (hundreds of rows) and rarely changes, yet nearly
+# every page and API call asks something of it. An AgencyCatalogue is an immutable,
+# in-memory snapshot of all agencies, indexed for the lookups we do most often:
+# by slugs, and by location. Each snapshot is versioned by the Agency generation it was built at.
+#
+
+class AgencyRecord(object):
+    """A compact, read-only copy of an Agency entity.
+
+    Offers the subset of the Agency interface that list pages and the API use."""
+    __slots__ = (
+        '_key', 'name', 'short_name', 'city', 'state', 'country',
+        'nameslug', 'cityslug', 'stateslug', 'countryslug', 'urlslug',
+        'latitude', 'longitude', 'date_opened', 'private', 'passenger_miles',
+        'executive', 'twitter', 'agency_url', 'has_real_time_data', 'details_url',
+        'jsonable', '_json',
+    )
+
+    def __init__(self, agency):
+        self._key = agency.key()
+        self.name = agency.name
+        self.short_name = agency.short_name
+        self.city = agency.city
+        self.state = agency.state
+        self.country = agency.country
+        self.nameslug = agency.nameslug
+        self.cityslug = agency.cityslug
+        self.stateslug = agency.stateslug
+        self.countryslug = agency.countryslug
+        self.urlslug = agency.urlslug
+        self.latitude = agency.location.lat if agency.location else None
+        self.longitude = agency.location.lon if agency.location else None
+        self.date_opened = agency.date_opened
+        self.private = agency.private
+        self.passenger_miles = agency.passenger_miles
+        self.executive = agency.executive
+        self.twitter = agency.twitter
+        self.agency_url = agency.agency_url
+        self.has_real_time_data = agency.has_real_time_data
+        self.details_url = agency.details_url
+        self.jsonable = agency.to_jsonable()
+        self._json = None
+
+    def __str__(self):
+        return "%s in %s, %s (%s)" % (self.name, self.city, self.state, self.country)
+
+    def key(self):
+        return self._key
+
+    @property
+    def is_public(self):
+        return (self.date_opened != None)
+
+    def to_jsonable(self, fields = None):
+        if fields is None:
+            return self.jsonable
+        return dict([(field, self.jsonable[field]) for field in fields])
+
+    def to_json(self, fields = None):
+        """Return the record's JSON encoding (of just the given fields). The encoding of all fields is computed once per catalogue; 
+        others aren't kept, since clients could ask for any number of combinations."""
+        if fields is not None:
+            return json.dumps(self.to_jsonable(fields))
+        if self._json is None:
+            self._json = json.dumps(self.jsonable)
+        return self._json
+
+
+def _gzip(bytes):
+    buffer = StringIO()
+    # A fixed mtime keeps the output (and so ETags downstream) the same for the same input.
+    gzip_file = gzip.GzipFile(fileobj = buffer, mode = 'wb', mtime = 0)
+    gzip_file.write(bytes)
+    gzip_file.close()
+    return buffer.getvalue()
+
+
+class AgencyCatalogue(object):
+    GRID_CELL_DEGREES = 1.0
+
+    def __init__(self, version, agencies):
+        self.version = version
+        self.records = [AgencyRecord(agency) for agency in agencies]
+
+        self._grid = {}
+        self._slug_index = {}
+        self._urlslug_index = {}
+        for record in self.records:
+            if (record.latitude is not None) and (record.longitude is not None):
+                self._grid.setdefault(self._grid_cell(record.latitude, record.longitude), []).append(record)
+            # Index under every combination of slugs, so that any filter is a single lookup.
+            for countryslug in (None, record.countryslug):
+                for stateslug in (None, record.stateslug):
+                    for cityslug in (None, record.cityslug):
+                        self._slug_index.setdefault((countryslug, stateslug, cityslug), []).append(record)
+            self._urlslug_index[record.urlslug] = record
+
+        self.state_list = sorted(set([(record.countryslug, record.stateslug) for record in self.records]), key = lambda x: x[1])
+        self.country_list = sorted(set([record.countryslug for record in self.records]))
+
+        # Encodings of every field of the whole catalogue, built along with it.
+        self._columns_json = self._encode_columns(None)
+        self._columns_gzip = _gzip(self._columns_json)
+
+    def __len__(self):
+        return len(self.records)
+
+    def to_columns(self, fields = None):
+        """Return a jsonable, columnar version of the records' to_jsonable(): one list of values per field.
+        
+        String fields that repeat a lot (like state) are stored as indexes into a table of their distinct values:
+            {"count": <number of records>, "columns": {field: [value or table index, ...]}, "tables": {field: [distinct value, ...]}}"""
+        jsonables = [record.to_jsonable(fields) for record in self.records]
+        field_names = sorted(fields or (jsonables[0].keys() if jsonables else []))
+        columns = {}
+        tables = {}
+        for field in field_names:
+            column = [jsonable[field] for jsonable in jsonables]
+            if all([isinstance(value, basestring) for value in column]) and (len(set(column)) * 2 <= len(column)):
+                table = sorted(set(column))
+                table_index = dict([(value, i) for i, value in enumerate(table)])
+                column = [table_index[value] for value in column]
+                tables[field] = table
+            columns[field] = column
+        return {"count": len(jsonables), "columns": columns, "tables": tables}
+
+    def to_columns_json(self, fields = None):
+        """Return the JSON encoding of to_columns(). That of all fields was built with the catalogue; others are encoded each time."""
+        if fields is None:
+            return self._columns_json
+        return self._encode_columns(fields)
+
+    def to_columns_gzip(self, fields = None):
+        """Return the gzipped to_columns_json(), for clients that can't ask for compression themselves."""
+        if fields is None:
+            return self._columns_gzip
+        return _gzip(self._encode_columns(fields))
+
+    def _encode_columns(self, fields):
+        return json.dumps(self.to_columns(fields), separators = (',', ':'))
+
+    @staticmethod
+    def _grid_index(degrees):
+        return int(math.floor(degrees / AgencyCatalogue.GRID_CELL_DEGREES))
+
+    @staticmethod
+    def _grid_cell(latitude, longitude):
+        return (AgencyCatalogue._grid_index(latitude), AgencyCatalogue._grid_index(longitude))
+
+    def for_slugs(self, countryslug = None, stateslug = None, cityslug = None):
+        """Return a list of records matching all of the given (non-empty) slugs."""
+        return list(self._slug_index.get((countryslug or None, stateslug or None, cityslug or None), []))
+
+    def for_urlslug(self, urlslug):
+        return self._urlslug_index.get(urlslug)
+
+    def in_box(self, bbox, max_results = 50):
+        """Return up to max_results records inside the given geotypes.Box."""
+        found = []
+        for row in range(self._grid_index(bbox.south), self._grid_index(bbox.north) + 1):
+            for column in range(self._grid_index(bbox.west), self._grid_index(bbox.east) + 1):
+                for record in self._grid.get((row, column), ()):
+                    if (bbox.south <= record.latitude <= bbox.north) and (bbox.west <= record.longitude <= bbox.east):
+                        found.append(record)
+                        if len(found) >= max_results:
+                            return found
+        return found
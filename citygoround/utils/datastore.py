@@ -1,5 +1,8 @@
 from google.appengine.ext import db
 
+# The datastore runs one sub-query per value of an IN filter, and caps how many it will run.
+MAX_IN_FILTER_VALUES = 30
+
 def iter_uniquify(entities, seen_set, uniquify = True):
     """Return an iterator that walks over the given entities, by default removing duplicates."""
     if uniquify:
@@ -11,20 +14,27 @@ def iter_uniquify(entities, seen_set, uniquify = True):
         for entity in entities:
             yield entity
 
+def count_all(query, batch_size = 1000):
+    """Count every result of the (preferably keys-only) query. Unlike query.count(), doesn't stop at 1000."""
+    count = 0
+    for result in query.run(batch_size = batch_size):
+        count += 1
+    return count
+
 def key_and_entity(entity_or_key, entity_class):
-    """Given an entity or key, return both the entity and its key."""
-    if isinstance(entity_or_key, db.Model):
-        return (entity_or_key.key(), entity_or_key)
+    """Given an entity (or anything with a key() method, like an AgencyRecord) or key, return both the entity and its key."""
+    if isinstance(entity_or_key, db.Key):
+        return (entity_or_key, entity_class.get(entity_or_key))
     else:
-        return (entity_or_key, entity_class.get([entity_or_key]))
+        return (entity_or_key.key(), entity_or_key)
 
 def normalize_to_key(entity_or_key):
-    """Given an entity or key, return the key."""
-    return entity_or_key.key() if isinstance(entity_or_key, db.Model) else entity_or_key
+    """Given an entity (or anything with a key() method) or key, return the key."""
+    return entity_or_key if isinstance(entity_or_key, db.Key) else entity_or_key.key()
 
 def normalize_to_keys(entities_or_keys):
-    """Given a list of entities or keys, return a list of keys."""
-    return [eok.key() if isinstance(eok, db.Model) else eok for eok in entities_or_keys]
+    """Given a list of entities (or anything with a key() method) or keys, return a list of keys."""
+    return [eok if isinstance(eok, db.Key) else eok.key() for eok in entities_or_keys]
 
 def serialize_entities(entities):
     """Given a list of datastore entities, or a single entity, return a string (or list of strings) 
@@ -50,6 +60,23 @@ def deserialize_entities(data):
     else:
         return [db.model_from_protobuf(entity_pb.EntityProto(x)) for x in data]
 
+def unique_keys_in_order(keys):
+    """Return a list of the given keys without duplicates, in the order they first appear."""
+    seen_set = set()
+    unique = []
+    for key in keys:
+        if key not in seen_set:
+            seen_set.add(key)
+            unique.append(key)
+    return unique
+
+def get_in_chunks(model_class, keys, chunk_size = 100):
+    """Return a list of the entities with the given keys, batch got a chunk at a time, leaving out any that no longer exist."""
+    entities = []
+    for i in range(0, len(keys), chunk_size):
+        entities.extend([entity for entity in model_class.get(keys[i : i + chunk_size]) if entity is not None])
+    return entities
+
 def unique_keys(keys):
     unique = {}
     for key in keys:
@@ -0,0 +1,25 @@
+from google.appengine.api.labs import taskqueue
+from django.core.urlresolvers import reverse
+from .generation import current_generation
+from ..models import GalleryLayout
+
+def kick_off_gallery_layout_rebuild(generation):
+    """Queue up a task to rebuild the gallery layout for the given TransitApp generation (at most one per generation)."""
+    task = taskqueue.Task(
+        url = reverse("taskqueue_rebuild_gallery_layout"),
+        name = "rebuild-gallery-layout-%s" % generation,
+    )
+    try:
+        task.add(queue_name = "gallery-layout-queue")
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # Someone beat us to it.
+        pass
+
+def gallery_layout():
+    """Return the gallery layout to render from: the stored one, even if it's stale (in which case a rebuild is queued up), or a new one if there is none."""
+    layout = GalleryLayout.get_layout()
+    if layout is None:
+        return GalleryLayout.build()
+    if not layout.is_current:
+        kick_off_gallery_layout_rebuild(current_generation("TransitApp"))
+    return layout
@@ -0,0 +1,79 @@
+import math
+import time as _time
+from django.conf import settings
+from google.appengine.api import memcache
+
+#
+# Generation counters.
+#
+# Every kind of entity that cached pages and API answers are built from has a
+# generation number in memcache, which goes up whenever an entity of that kind
+# changes. Cache keys include the current generations, so a single increment
+# invalidates every dependent entry (even those, like searches, whose keys we
+# could never enumerate); the old entries simply expire unread. Cached views
+# instead store the generations they were rendered at alongside the response,
+# and treat an entry whose generations have moved on as stale (see
+# utils/memcache.py). Either way, depend only on the kinds you actually read.
+#
+# Generations start out at the current time in milliseconds, so that a counter
+# evicted from memcache never comes back at a number that older keys used.
+#
+# Each bump also records when it happened, so that conditional GETs can answer
+# If-Modified-Since from the same events that change their ETags; any edit or
+# delete moves it, whether or not it touches an entity's own timestamps.
+#
+
+KINDS = ("Agency", "TransitApp", "FeedReference")
+
+# This instance's copies of the generations: kind -> (checked at, generation)
+_local_generations = {}
+
+def _memcache_key(kind):
+    return "generation-%s" % kind
+
+def _modified_memcache_key(kind):
+    return "generation-modified-%s" % kind
+
+def _initial_generation():
+    return int(_time.time() * 1000)
+
+def current_generation(kind):
+    """Return the current generation of the given kind. Each instance looks it up at most every GENERATION_CHECK_SECONDS."""
+    now = _time.time()
+    checked_at, generation = _local_generations.get(kind, (0, None))
+    if (generation is None) or (now - checked_at > settings.GENERATION_CHECK_SECONDS):
+        generation = memcache.get(_memcache_key(kind))
+        if generation is None:
+            memcache.add(_memcache_key(kind), _initial_generation())
+            generation = memcache.get(_memcache_key(kind)) or _initial_generation()
+        _local_generations[kind] = (now, generation)
+    return generation
+
+def bump_generation(kind):
+    """Invalidate everything cached from entities of the given kind. Call this after db.put() or db.delete() of them; their put() and delete() call it for you."""
+    generation = memcache.incr(_memcache_key(kind), initial_value = _initial_generation())
+    if generation is None:
+        # Memcache is unavailable; at least this instance will notice.
+        generation = _initial_generation()
+    _local_generations[kind] = (_time.time(), generation)
+    memcache.set(_modified_memcache_key(kind), _time.time())
+    return generation
+
+def last_modified(kinds = KINDS):
+    """Return the time, in whole seconds since the epoch (rounded up), that entities of the given kinds last changed.
+    
+    Return None while that second is still under way, since another change could come within it and go unnoticed."""
+    memcache_keys = [_modified_memcache_key(kind) for kind in kinds]
+    modified = memcache.get_multi(memcache_keys)
+    now = _time.time()
+    for memcache_key in memcache_keys:
+        if memcache_key not in modified:
+            # Evicted, or never bumped: the safe assumption is that it changed just now.
+            memcache.add(memcache_key, now)
+            modified[memcache_key] = now
+    last = int(math.ceil(max(modified.values())))
+    return last if last <= now else None
+
+def generations_key(kinds = KINDS):
+    """Return a string of the current generations of the given kinds, to fold into cache keys."""
+    return "-".join(["%s.%s" % (kind, current_generation(kind)) for kind in kinds])
@@ -0,0 +1,45 @@
+import time
+from collections import OrderedDict
+
+#
+# A cache that lives in this process's memory, in front of memcache.
+#
+# Reading from it costs no RPC and no unpickling, but each instance has its own
+# copy, which clearing memcache doesn't reach. So entries should only live for a
+# short while; the clear_* helpers in utils/memcache.py also clear this
+# instance's copy.
+#
+
+class LocalCache(object):
+    """A size-bounded, least-recently-used cache whose entries expire after their own TTL."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (expires_at, value), least recently used first.
+
+    def get(self, key):
+        """Return the value for the given key, or None if there isn't one (or it has expired)."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            return None
+        self._entries[key] = entry
+        return value
+
+    def set(self, key, value, time_to_live):
+        """Remember value for at most time_to_live seconds, forgetting the least recently used entry if we're full."""
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + time_to_live, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last = False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,6 +1,164 @@
+import time as _time
+import zlib
+import marshal
 import logging
+from uuid import uuid4
+from django.conf import settings
+from django.http import HttpResponse
 from google.appengine.api import users
 from google.appengine.api import memcache
+from .localcache import LocalCache
+
+# This instance's copies of recently used view responses. See the view caching decorators.
+local_view_cache = LocalCache(settings.LOCAL_VIEW_CACHE_MAX_ENTRIES)
+
+# How this instance's view caches have fared: view name -> {"local_hits": n, "memcache_hits": n, "stale_hits": n, "misses": n}
+_view_cache_statistics = {}
+
+def count_view_cache_lookup(view_function, outcome):
+    """Record the outcome ("local_hits", "memcache_hits", "stale_hits" or "misses") of looking up a cached response for the view."""
+    view_name = "%s.%s" % (view_function.__module__, view_function.__name__)
+    statistics = _view_cache_statistics.get(view_name)
+    if statistics is None:
+        statistics = _view_cache_statistics[view_name] = {"local_hits": 0, "memcache_hits": 0, "stale_hits": 0, "misses": 0}
+    statistics[outcome] += 1
+
+def view_cache_statistics():
+    """Return a copy of this instance's view cache statistics, keyed by view name."""
+    return dict([(view_name, dict(statistics)) for view_name, statistics in _view_cache_statistics.iteritems()])
+
+def local_key(memcache_key, namespace = None):
+    return (namespace, memcache_key)
+
+#
+# Values that go stale before they expire.
+#
+# When a popular cached value simply expires, every request that wants it at that moment
+# recomputes it. Instead, we store values in an envelope of (fresh until, stale until, value),
+# and keep them in memcache until they're stale. Once a value is stale, the first request
+# to take the refresh lock recomputes it, while everyone else keeps using the stale copy.
+#
+
+def set_with_staleness(key, value, time = 0, stale_time = 0, namespace = None):
+    """Cache value under key. It is fresh for time seconds (forever, if 0), then stale (but still available) for stale_time more.
+    
+    String values too big for a single memcache item are split across several."""
+    if time:
+        now = _time.time()
+        fresh_until, stale_until = now + time, now + time + stale_time
+        # Memcache reads a large expiration time as an absolute unix time.
+        memcache_time = int(stale_until) + 1
+    else:
+        fresh_until, stale_until = None, None
+        memcache_time = 0
+    if isinstance(value, str) and (len(value) > settings.MEMCACHE_CHUNK_BYTES):
+        value = _set_chunks(key, value, memcache_time, namespace)
+    memcache.set(key, (fresh_until, stale_until, value), time = memcache_time, namespace = namespace)
+
+def get_with_staleness(key, namespace = None):
+    """Return a (value, fresh until) tuple for the value cached under key with set_with_staleness(). 
+    
+    The value is None if there is none; fresh until is None if the value never goes stale, and in the past if it is stale."""
+    envelope = memcache.get(key, namespace = namespace)
+    if not (isinstance(envelope, tuple) and len(envelope) == 3):
+        return (None, None)
+    fresh_until, stale_until, value = envelope
+    if isinstance(value, ChunkedValue):
+        value = _get_chunks(key, value, namespace)
+        if value is None:
+            return (None, None)
+    return (value, fresh_until)
+
+def is_fresh(fresh_until):
+    return (fresh_until is None) or (fresh_until > _time.time())
+
+def mark_stale(key, namespace = None):
+    """Make the value cached under key stale, so that the next request for it recomputes it (without making everyone else wait)."""
+    client = memcache.Client()
+    envelope = client.gets(key, namespace = namespace)
+    if not (isinstance(envelope, tuple) and len(envelope) == 3):
+        return
+    fresh_until, stale_until, value = envelope
+    if stale_until is None:
+        stale_until = _time.time() + settings.MEMCACHE_STALE_SECONDS
+    # If someone else wrote a new value since we looked, it's fresher than ours; leave it alone.
+    client.cas(key, (0, stale_until, value), time = int(stale_until) + 1, namespace = namespace)
+
+def acquire_refresh_lock(key, namespace = None):
+    """Return True if we may recompute the stale value under key; only one request at a time may."""
+    return memcache.add("refresh-lock-%s" % key, True, time = settings.MEMCACHE_REFRESH_LOCK_SECONDS, namespace = namespace)
+
+def release_refresh_lock(key, namespace = None):
+    memcache.delete("refresh-lock-%s" % key, namespace = namespace)
+
+class ChunkedValue(object):
+    """Stands in for a string value that was stored in several pieces, under keys of its own."""
+    def __init__(self, token, count):
+        self.token = token
+        self.count = count
+        
+    def chunk_keys(self, key):
+        # The token keeps readers from mixing up pieces of different values stored under the same key.
+        return ["%s-chunk-%s-%d" % (key, self.token, i) for i in range(self.count)]
+
+def _set_chunks(key, value, memcache_time, namespace):
+    chunk_size = settings.MEMCACHE_CHUNK_BYTES
+    chunked_value = ChunkedValue(uuid4().hex, (len(value) + chunk_size - 1) // chunk_size)
+    chunks = dict([(chunk_key, value[i * chunk_size : (i + 1) * chunk_size]) for i, chunk_key in enumerate(chunked_value.chunk_keys(key))])
+    memcache.set_multi(chunks, time = memcache_time, namespace = namespace)
+    return chunked_value
+
+def _get_chunks(key, chunked_value, namespace):
+    """Return the string value stored in pieces, or None if any of the pieces have gone missing."""
+    chunk_keys = chunked_value.chunk_keys(key)
+    chunks = memcache.get_multi(chunk_keys, namespace = namespace)
+    if len(chunks) != len(chunk_keys):
+        return None
+    return "".join([chunks[chunk_key] for chunk_key in chunk_keys])
+
+#
+# Cached responses.
+#
+# Rather than pickling whole HttpResponse objects (cookies and all), we cache a compact
+# record of just what's needed to rebuild one: the status, content type, a few headers,
+# and the body, compressed if it's large.
+#
+# Response keys don't include data generations (see utils/generation.py). Instead, each
+# record notes the generations it was rendered at; when they've moved on, the record is
+# treated as stale, so that one request renders a new copy while the rest are served the
+# old one, rather than every request missing at once after each edit.
+#
+
+CACHED_RESPONSE_HEADERS = ("Cache-Control", "Content-Disposition", "Content-Language", "ETag", "Expires", "Last-Modified", "Vary")
+
+# Content types that are compressed already.
+COMPRESSED_CONTENT_TYPES = ("application/x-gzip", "application/zip", "image/png", "image/jpeg")
+
+def response_to_record(response, generation = None):
+    """Return a compact string record of the response, rendered at the given data generation (a generations_key() string), for caching."""
+    body = response.content
+    is_compressed = (len(body) > settings.CACHED_RESPONSE_COMPRESS_BYTES) and not response["Content-Type"].startswith(COMPRESSED_CONTENT_TYPES)
+    if is_compressed:
+        body = zlib.compress(body)
+    headers = [(header, response[header]) for header in CACHED_RESPONSE_HEADERS if response.has_header(header)]
+    return marshal.dumps((generation, response.status_code, response["Content-Type"], headers, is_compressed, body))
+
+def response_from_record(record):
+    """Return a (generation, HttpResponse) tuple rebuilt from a record made by response_to_record(), or (None, None) if it isn't one."""
+    try:
+        generation, status_code, content_type, headers, is_compressed, body = marshal.loads(record)
+    except (TypeError, ValueError, EOFError):
+        return (None, None)
+    if is_compressed:
+        body = zlib.decompress(body)
+    response = HttpResponse(content = body, content_type = content_type, status = status_code)
+    for header, value in headers:
+        response[header] = value
+    return (generation, response)
+
+def _mark_stale(memcache_key):
+    mark_stale(memcache_key)
+    local_view_cache.delete(local_key(memcache_key))
 
 def key_for_view_function(view_function, for_admin_user = None):
     if for_admin_user is None:
@@ -25,22 +183,22 @@ def key_for_request(request, for_admin_user = None):
     return key
 
 def clear_for_view_function(view_function):    
-    memcache.delete(key_for_view_function(view_function, for_admin_user = False))
-    memcache.delete(key_for_view_function(view_function, for_admin_user = True))
+    _mark_stale(key_for_view_function(view_function, for_admin_user = False))
+    _mark_stale(key_for_view_function(view_function, for_admin_user = True))
 
 def clear_for_request(request):
-    memcache.delete(key_for_request(request, for_admin_user = False))
-    memcache.delete(key_for_request(request, for_admin_user = True))
+    _mark_stale(key_for_request(request, for_admin_user = False))
+    _mark_stale(key_for_request(request, for_admin_user = True))
 
 def clear_app_gallery():
     from ..views.app import gallery as _gallery
-    memcache.delete(key_for_view_function(_gallery, for_admin_user = False))
-    memcache.delete(key_for_view_function(_gallery, for_admin_user = True))
+    _mark_stale(key_for_view_function(_gallery, for_admin_user = False))
+    _mark_stale(key_for_view_function(_gallery, for_admin_user = True))
 
 def clear_api_apps_all():
     from ..views.api import api_apps_all as _api_apps_all
-    memcache.delete(key_for_view_function(_api_apps_all, for_admin_user = False))
-    memcache.delete(key_for_view_function(_api_apps_all, for_admin_user = True))
+    _mark_stale(key_for_view_function(_api_apps_all, for_admin_user = False))
+    _mark_stale(key_for_view_function(_api_apps_all, for_admin_user = True))
 
 def clear_all_apps():
     clear_app_gallery()
@@ -0,0 +1,60 @@
+from django.conf import settings
+from google.appengine.ext import db
+
+#
+# Paging through API results.
+#
+# Clients ask for a page with ?limit=n, and for the page after it with the opaque
+# ?cursor=... that came back with the previous page. Datastore queries page with
+# datastore cursors. Results we already hold in memory (records from the agency
+# catalogue) or know the keys of (apps from the AgencySupportIndex) page in key order,
+# with the key of the last item as the cursor; for the latter, fetch just the page's
+# entities. Either way, a page doesn't shift when entities are added or removed before it.
+#
+
+class InvalidPageParameters(Exception):
+    pass
+
+def is_paginated(request):
+    return ('limit' in request.GET) or ('cursor' in request.GET)
+
+def page_parameters(request):
+    """Return the (limit, cursor) the request asks for. Raise InvalidPageParameters if they don't make sense."""
+    try:
+        limit = int(request.GET.get('limit', settings.API_DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise InvalidPageParameters('limit parameter must be an integer')
+    if not (0 < limit <= settings.API_MAX_PAGE_SIZE):
+        raise InvalidPageParameters('limit parameter must be between 1 and %d' % settings.API_MAX_PAGE_SIZE)
+    return (limit, request.GET.get('cursor') or None)
+
+def paginate_query(query, limit, cursor = None):
+    """Return a (list of entities, next cursor) tuple for a page of the query. The next cursor is None after the last page."""
+    try:
+        if cursor is not None:
+            query.with_cursor(cursor)
+        entities = query.fetch(limit)
+    except (db.Error, ValueError):
+        raise InvalidPageParameters('cursor parameter is not valid')
+    next_cursor = query.cursor() if len(entities) == limit else None
+    return (entities, next_cursor)
+
+def paginate_by_key(items, limit, cursor = None):
+    """Return a (list of items, next cursor) tuple for a page of the in-memory items (anything with a key(), like AgencyRecords), taken in key order."""
+    return _paginate_in_key_order(items, lambda item: item.key(), limit, cursor)
+
+def paginate_keys(keys, limit, cursor = None):
+    """Return a (list of keys, next cursor) tuple for a page of the given (unique) datastore keys, taken in key order. Batch get just the page's entities."""
+    return _paginate_in_key_order(keys, lambda key: key, limit, cursor)
+
+def _paginate_in_key_order(items, item_key, limit, cursor):
+    items = sorted(items, key = item_key)
+    if cursor is not None:
+        try:
+            after_key = db.Key(cursor)
+        except db.Error:
+            raise InvalidPageParameters('cursor parameter is not valid')
+        items = [item for item in items if item_key(item) > after_key]
+    page = items[:limit]
+    next_cursor = str(item_key(page[-1])) if len(items) > limit else None
+    return (page, next_cursor)
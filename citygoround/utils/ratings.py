@@ -1,5 +1,36 @@
-from .memcache import clear_all_apps
-from ..models import NamedStat
+import time
+import logging
+from django.conf import settings
+from google.appengine.ext import db
+from google.appengine.api.labs import taskqueue
+from .generation import bump_generation
+from ..models import NamedStat, TransitApp, AppliedRatingVotes
+
+#
+# Rating votes.
+#
+# A vote doesn't write anything itself: it's appended to the rating-vote-queue pull
+# queue, and every minute or so fold_rating_votes() leases the waiting votes, adds
+# them up per app, and folds the totals into each app's rating_sum and rating_count
+# (and the site-wide all_rating_sum and all_rating_count stats) at once, refreshing
+# the bayesian averages of just the apps that got votes.
+#
+# Each app's votes are applied in a cross-group transaction of its own, which also
+# records the votes' task names with the app (see AppliedRatingVotes) and adds them
+# to the site-wide stats; the votes are removed from the queue right after it commits.
+# Should that removal fail, or the lease run out first, the votes are leased again
+# later, and recognized by name; so every vote counts exactly once. Transactions
+# are per app, rather than per batch, because a transaction spans only a handful of
+# entity groups, and so that contention on one popular app doesn't hold up the rest.
+#
+# The other apps' averages drift as the site-wide stats change; a daily
+# refresh_bayesian_averages() brings them up to date.
+#
+
+RATING_VOTE_QUEUE_NAME = "rating-vote-queue"
+
+# Folding an app's votes touches the app's entity group and a shard each of the two site-wide stats.
+FOLD_TRANSACTION_OPTIONS = db.create_transaction_options(xg = True)
 
 def rating_key_for_app(transit_app):
     return "rating-%s" % transit_app.slug
@@ -12,43 +43,150 @@ def set_user_rating_for_app(request, transit_app, rating):
     key = rating_key_for_app(transit_app)
     return request.set_session(key, rating)
 
-def adjust_rating_for_app(transit_app, old_rating, new_rating):
-    # Remember the original integer rating for the app
-    original_rating = transit_app.average_rating_integer
-    
-    # Determine what to adjust the app by
+def rating_deltas(old_rating, new_rating):
+    """Return the (rating sum delta, rating count delta) of a user changing their rating from old_rating to new_rating (either may be None)."""
     if old_rating is not None:
         if new_rating is not None:
-            rating_delta = new_rating - old_rating
-            count_delta = 0
+            return (new_rating - old_rating, 0)
         else:
-            rating_delta = -old_rating
-            count_delta = -1
+            return (-old_rating, -1)
     else:
-        rating_delta = new_rating if new_rating is not None else 0
-        count_delta = 1
+        return (new_rating if new_rating is not None else 0, 1)
+
+def is_significant_rating_change(original_rating, final_rating):
+    # We invalidate cached apps pages and APIs (and clients' copies of them) if this was
+    # a first rating, or if the overall rating changed by enough. Otherwise, we'll wait
+    # for our memcache expiry time to arrive.
+    return (original_rating == 0) or (abs(original_rating - final_rating) >= 5)
+
+def enqueue_rating_vote(transit_app, old_rating, new_rating):
+    """Queue up a user's change of rating, for fold_rating_votes() to apply. 
     
-    # Set side-wide rating average for use in creating sorting metric using bayesian average
-    all_rating_sum = NamedStat.get_stat( "all_rating_sum" )
-    all_rating_sum.value = all_rating_sum.value + rating_delta
-    all_rating_sum.put()
+    The vote is also applied to transit_app's rating_sum and rating_count (but not saved), so that callers can show its effect."""
+    rating_delta, count_delta = rating_deltas(old_rating, new_rating)
+    if (rating_delta == 0) and (count_delta == 0):
+        return
+    task = taskqueue.Task(
+        payload = "%s %d %d" % (transit_app.key(), rating_delta, count_delta),
+        method = "PULL",
+    )
+    task.add(queue_name = RATING_VOTE_QUEUE_NAME)
+    transit_app.rating_sum += rating_delta
+    transit_app.rating_count += count_delta
+
+def _fold_votes_into_app(key, votes, all_rating_sum, all_rating_count):
+    """Apply the (task name, rating delta, count delta) votes to the app with the given key, skipping any that were applied before.
     
-    all_rating_count = NamedStat.get_stat( "all_rating_count" )
-    all_rating_count.value = all_rating_count.value + count_delta
-    all_rating_count.put()
+    Run in a cross-group transaction. Return the app's (original rating, final rating), or None if it has been deleted."""
+    transit_app = TransitApp.get(key)
+    if transit_app is None:
+        # Deleted since the votes were cast.
+        return None
+    original_rating = transit_app.average_rating_integer
+    applied_votes = AppliedRatingVotes.get_for_transit_app(key)
+    applied_task_names = set(applied_votes.task_names)
+    new_votes = [vote for vote in votes if vote[0] not in applied_task_names]
+    if not new_votes:
+        return (original_rating, original_rating)
     
-    # Fix the app's raw rating info
+    rating_delta = sum([vote_rating_delta for task_name, vote_rating_delta, vote_count_delta in new_votes])
+    count_delta = sum([vote_count_delta for task_name, vote_rating_delta, vote_count_delta in new_votes])
     transit_app.rating_sum += rating_delta
     transit_app.rating_count += count_delta
+    transit_app.refresh_bayesian_average(all_rating_sum, all_rating_count)
+    transit_app.put(bump_generation = False)
+    applied_votes.remember([task_name for task_name, vote_rating_delta, vote_count_delta in new_votes])
+    applied_votes.put()
+    
+    # Set side-wide rating average for use in creating sorting metric using bayesian average
+    NamedStat.increment_in_transaction("all_rating_sum", rating_delta)
+    NamedStat.increment_in_transaction("all_rating_count", count_delta)
+    return (original_rating, transit_app.average_rating_integer)
+
+def fold_rating_votes():
+    """Apply the queued rating votes, RATING_VOTE_BATCH_SIZE at a time, until there are none left. Return how many votes were leased.
+    
+    Safe to run again after a failure part way through: votes that were already applied are recognized, and not counted twice."""
+    queue = taskqueue.Queue(RATING_VOTE_QUEUE_NAME)
+    vote_count = 0
+    should_bump_generation = False
+    while True:
+        tasks = queue.lease_tasks(settings.RATING_VOTE_LEASE_SECONDS, settings.RATING_VOTE_BATCH_SIZE)
+        if not tasks:
+            break
+        
+        # Group the votes by app
+        votes_by_app = {}
+        malformed_tasks = []
+        for task in tasks:
+            try:
+                key_encoded, rating_delta, count_delta = task.payload.split()
+                key, rating_delta, count_delta = db.Key(key_encoded), int(rating_delta), int(count_delta)
+            except (ValueError, db.Error):
+                logging.error("Dropping malformed rating vote: %r" % task.payload)
+                malformed_tasks.append(task)
+                continue
+            votes_by_app.setdefault(key, []).append((task, rating_delta, count_delta))
+        if malformed_tasks:
+            queue.delete_tasks(malformed_tasks)
+        
+        # The bayesian averages only need the site-wide stats roughly, so take them as of 
+        # now plus this batch. (This also seeds the stats, which can't be done in a transaction.)
+        all_rating_sum = NamedStat.get_value("all_rating_sum") + sum([sum([vote[1] for vote in votes]) for votes in votes_by_app.itervalues()])
+        all_rating_count = NamedStat.get_value("all_rating_count") + sum([sum([vote[2] for vote in votes]) for votes in votes_by_app.itervalues()])
+        
+        for key, votes in votes_by_app.iteritems():
+            named_votes = [(task.name, rating_delta, count_delta) for task, rating_delta, count_delta in votes]
+            ratings = db.run_in_transaction_options(FOLD_TRANSACTION_OPTIONS, _fold_votes_into_app, key, named_votes, all_rating_sum, all_rating_count)
+            queue.delete_tasks([task for task, rating_delta, count_delta in votes])
+            if (ratings is not None) and is_significant_rating_change(*ratings):
+                should_bump_generation = True
+        
+        vote_count += len(tasks)
+        if len(tasks) < settings.RATING_VOTE_BATCH_SIZE:
+            break
+    
+    if should_bump_generation:
+        bump_generation("TransitApp")
+    return vote_count
+
+def has_bayesian_average_moved(old_average, new_average):
+    if (old_average is None) or (new_average is None):
+        return old_average != new_average
+    return abs(new_average - old_average) > settings.BAYESIAN_AVERAGE_EPSILON
+
+def refresh_bayesian_averages(cursor = None, dry_run = False):
+    """Recompute every app's bayesian average against the current site-wide stats, saving (in batches) only those that moved by more than BAYESIAN_AVERAGE_EPSILON.
+    
+    Starts at cursor, if given, and stops after BAYESIAN_REFRESH_SECONDS. Returns an (apps examined, apps changed, 
+    next cursor) tuple; the next cursor is None once every app has been examined. With dry_run, nothing is saved."""
+    started_at = time.time()
+    all_rating_sum = NamedStat.get_value("all_rating_sum")
+    all_rating_count = NamedStat.get_value("all_rating_count")
+    
+    examined_count, changed_count = 0, 0
+    query = TransitApp.query_all(visible_only = False)
+    while True:
+        if cursor is not None:
+            query.with_cursor(cursor)
+        transit_apps = query.fetch(settings.BAYESIAN_REFRESH_BATCH_SIZE)
+        cursor = query.cursor() if len(transit_apps) == settings.BAYESIAN_REFRESH_BATCH_SIZE else None
+        
+        changed_apps = []
+        for transit_app in transit_apps:
+            old_average = transit_app.bayesian_average
+            transit_app.refresh_bayesian_average(all_rating_sum, all_rating_count)
+            if has_bayesian_average_moved(old_average, transit_app.bayesian_average):
+                changed_apps.append(transit_app)
+        if changed_apps and not dry_run:
+            # Only the ratings changed, so TransitApp.put()'s bookkeeping has nothing to do.
+            db.put(changed_apps)
+        examined_count += len(transit_apps)
+        changed_count += len(changed_apps)
+        
+        if (cursor is None) or (time.time() - started_at > settings.BAYESIAN_REFRESH_SECONDS):
+            break
     
-    # Refresh the app's bayesian average
-    transit_app.refresh_bayesian_average(all_rating_sum, all_rating_count)    
-    transit_app.put()
-    
-    # Now see if we should clear the memcache for the app gallery and apps APIs.
-    # we _will_ if this was a first rating, or if the overall rating changed by
-    # enough. Otherwise, we'll wait for our memcache expiry time to arrive.
-    final_rating = transit_app.average_rating_integer
-    if (original_rating == 0) or (abs(original_rating - final_rating) >= 5):
-        clear_all_apps()
-    
\ No newline at end of file
+    if changed_count and not dry_run:
+        bump_generation("TransitApp")
+    return (examined_count, changed_count, cursor)
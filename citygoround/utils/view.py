@@ -1,9 +1,12 @@
+import csv
 import django
+from StringIO import StringIO
 from django.conf import settings
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
 from django.utils import simplejson as json
 from django.http import HttpResponseRedirect, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed
+from .pagination import is_paginated, page_parameters, paginate_by_key, paginate_keys, InvalidPageParameters
 
 def render_to_response(request, template_name, dictionary={}, **kwargs):
     """
@@ -42,11 +45,76 @@ def bad_request(message = ''):
 def method_not_allowed(message = ''):
     return HttpResponseNotAllowed(message)
     
-def render_to_json(jsonable):
+def _json_mimetype():
     # For sanity's sake, when debugging use text/x-json...
     # ...but in production, the one true JSON mimetype is application/json. 
     # Ask IANA if you don't believe me.
-    return HttpResponse(json.dumps(jsonable), mimetype = 'text/x-json' if settings.DEBUG else 'application/json' )
+    return 'text/x-json' if settings.DEBUG else 'application/json'
+
+def render_to_json(jsonable):
+    return HttpResponse(json.dumps(jsonable), mimetype = _json_mimetype())
+
+def render_json_encoded(encoded):
+    """Render an already-encoded JSON value."""
+    return HttpResponse(encoded, mimetype = _json_mimetype())
+
+def render_gzip(bytes, filename):
+    response = HttpResponse(bytes, mimetype = 'application/x-gzip')
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
+def render_json_fragments(fragments):
+    """Render a JSON list from already-encoded items (which may come from an iterator), without decoding them again."""
+    return HttpResponse("[%s]" % ", ".join(fragments), mimetype = _json_mimetype())
+
+def render_json_page(fragments, cursor):
+    """Render a page of already-encoded items as {"results": [...], "cursor": <cursor for the next page, or null>}."""
+    return HttpResponse('{"results": [%s], "cursor": %s}' % (", ".join(fragments), json.dumps(cursor)), mimetype = _json_mimetype())
+
+def render_json_for_keyed_items(request, items, json_fragments, fields = None):
+    """Render in-memory items (each with a key()) as a JSON list; or, if the request asks for a page of them (see utils/pagination.py), render that page.
+    
+    json_fragments(items, fields) turns a list of items into a list of their JSON encodings, with just the given fields."""
+    if not is_paginated(request):
+        return render_json_fragments(json_fragments(list(items), fields))
+    try:
+        limit, cursor = page_parameters(request)
+        items, next_cursor = paginate_by_key(items, limit, cursor)
+    except InvalidPageParameters, error:
+        return bad_request(str(error))
+    return render_json_page(json_fragments(items, fields), next_cursor)
+
+def render_json_for_keys(request, keys, fetch_by_keys, json_fragments, fields = None):
+    """Like render_json_for_keyed_items(), but given just the (unique) keys of the entities, so that a page only gets its own.
+    
+    fetch_by_keys(keys) returns a list of the entities with the given keys, leaving out any that shouldn't be shown;
+    so a page may hold fewer than limit entities, and still be followed by another."""
+    if not is_paginated(request):
+        return render_json_fragments(json_fragments(fetch_by_keys(keys), fields))
+    try:
+        limit, cursor = page_parameters(request)
+        keys, next_cursor = paginate_keys(keys, limit, cursor)
+    except InvalidPageParameters, error:
+        return bad_request(str(error))
+    return render_json_page(json_fragments(fetch_by_keys(keys), fields), next_cursor)
+
+def fields_parameter(request, valid_fields):
+    """Return a sorted tuple of the fields named by the request's comma-separated fields= parameter, or None if it names none.
+    
+    Raise ValueError if it names a field that isn't in valid_fields."""
+    fields = sorted(set([field.strip() for field in request.GET.get('fields', '').split(',') if field.strip()]))
+    if not fields:
+        return None
+    unknown_fields = [field for field in fields if field not in valid_fields]
+    if unknown_fields:
+        raise ValueError('unknown fields: %s' % ', '.join(unknown_fields))
+    return tuple(fields)
+
+def render_csv_rows(rows):
+    """Render the CSV encoding of the given rows (lists of strings), which may come from an iterator."""
+    buffer = StringIO()
+    csv.writer(buffer).writerows(rows)
+    return render_csv(buffer.getvalue())
 
 def render_text(text):
     return HttpResponse(text, mimetype = 'text/plain')
@@ -1,22 +1,22 @@
 import time
 import logging
  
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.conf import settings
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
 from google.appengine.api import users
  
-from ..decorators import memcache_parameterized_view_response
+from ..decorators import memcache_parameterized_view_response, conditional_view_response
 from ..forms import AgencyForm
-from ..models import Agency, FeedReference, TransitApp
-from ..utils.view import render_to_response, redirect_to, not_implemented, bad_request, render_to_json
+from ..models import Agency, FeedReference, TransitApp, AgencySupportIndex
+from ..utils.view import render_to_response, redirect_to, not_implemented, bad_request, render_to_json, render_json_fragments, render_csv_rows, render_json_for_keyed_items
+from ..utils.pagination import is_paginated
 from ..utils.misc import uniquify, chunk_sequence
 from ..utils.geocode import geocode_name
+from ..utils.generation import bump_generation
  
-from StringIO import StringIO
-import csv
 
 def edit_agency(request, agency_id=None):
     if agency_id is not None:
@@ -89,6 +89,11 @@ def edit_agency(request, agency_id=None):
 def agency_app_counts(request):
     return render_to_json( TransitApp.agency_app_counts() )
 
+def rebuild_agency_support_index(request):
+    """Recompute the agency -> transit app index from scratch. Only needed if it ever gets out of sync."""
+    transit_app_count = AgencySupportIndex.rebuild(TransitApp.query_all(visible_only = False))
+    return HttpResponse("Rebuilt the agency support index from %d transit apps." % transit_app_count)
+
 def safe_str(item):
     """it's like applying str() but it won't cause ascii encoding problems down the line"""
 
@@ -97,7 +102,18 @@ def safe_str(item):
     else:
         return str(item)
 
-@memcache_parameterized_view_response(time = settings.MEMCACHE_PAGE_SECONDS)  
+def iter_agency_csv_rows(agencies):
+    """Yield a header row, then a row per agency, of the agencies' to_jsonable() values. Yield nothing if there are no agencies."""
+    header = None
+    for agency in agencies:
+        jsonable = agency.to_jsonable()
+        if header is None:
+            header = jsonable.keys()
+            yield header
+        yield [safe_str(jsonable[header_col]) for header_col in header]
+
+@conditional_view_response(time = settings.MEMCACHE_PAGE_SECONDS, kinds = ("Agency", "TransitApp", "FeedReference"))
+@memcache_parameterized_view_response(time = settings.MEMCACHE_PAGE_SECONDS, kinds = ("Agency", "TransitApp", "FeedReference"))
 def agencies(request, countryslug='', stateslug='', cityslug='', nameslug=''):        
     # TODO davepeck: I just looked at this code -- we _really_ need to clean this stuff up
     # and rationalize it with our API. I think this code is doing 'far too much dude'
@@ -105,7 +121,10 @@ def agencies(request, countryslug='', stateslug='', cityslug='', nameslug=''):
     #for a single agency:
     if nameslug:
         urlslug = '/'.join([countryslug,stateslug,cityslug,nameslug])
-        agency = Agency.all().filter('urlslug =', urlslug).get()
+        agency_record = Agency.catalogue().for_urlslug(urlslug)
+        agency = Agency.get(agency_record.key()) if agency_record else None
+        if agency is None:
+            raise Http404
         
         feeds = FeedReference.all().filter('gtfs_data_exchange_id IN', agency.gtfs_data_exchange_id)
         apps = TransitApp.iter_for_agency(agency)
@@ -119,35 +138,15 @@ def agencies(request, countryslug='', stateslug='', cityslug='', nameslug=''):
         return render_to_response( request, "agency.html", template_vars)
     
     #return a filtered agency list
-    agency_list = Agency.fetch_for_slugs(countryslug, stateslug, cityslug)
-
     if request.GET.get( 'format' ) == 'json':
-        jsonable_list = []
-        
-        for agency in agency_list:
-            jsonable_list.append( agency.to_jsonable() )
-        
-        return render_to_json(jsonable_list)
+        if is_paginated(request):
+            return render_json_for_keyed_items(request, Agency.fetch_for_slugs(countryslug, stateslug, cityslug), Agency.json_fragments)
+        return render_json_fragments(agency.to_json() for agency in Agency.fetch_for_slugs(countryslug, stateslug, cityslug))
         
     if request.GET.get( 'format' ) == 'csv':
-        jsonable_list = []
-        
-        for agency in agency_list:
-            jsonable_list.append( agency.to_jsonable() )
-        
-        if len(jsonable_list) > 0:
-            csv_buffer = StringIO()
-            csv_writer = csv.writer( csv_buffer )
-            
-            header = jsonable_list[0].keys()
-            csv_writer.writerow( header )
-            
-            for item in jsonable_list:
-                csv_writer.writerow( [safe_str(item[header_col]) for header_col in header] )
-                        
-            return HttpResponse( content=csv_buffer.getvalue(), mimetype="text/csv" )
-        else:
-            return HttpResponse( content="", mimetype="text/csv")
+        return render_csv_rows(iter_agency_csv_rows(Agency.fetch_for_slugs(countryslug, stateslug, cityslug)))
+
+    agency_list = Agency.fetch_for_slugs(countryslug, stateslug, cityslug)
 
     public_filter = request.GET.get('public','all')
     public_count = no_public_count = 0
@@ -160,19 +159,17 @@ def agencies(request, countryslug='', stateslug='', cityslug='', nameslug=''):
         location['country'] = countryslug
     location_string = cityslug or stateslug or countryslug
     
-    #TODO: clean this up -- better form not to set new properties on defined model objects
-    enhanced_list = [];
+    shown_list = []
     for a in agency_list:
-        
         if a.date_opened:
             public_count += 1
             if public_filter == 'no_public':
-                a.hide = True
+                continue
         else:
             no_public_count += 1
             if public_filter == 'public':
-                a.hide = True
-        enhanced_list.append(a)  #listify now so we dont have to do it again for count(), etc
+                continue
+        shown_list.append(a)
 
 
     if countryslug:
@@ -181,7 +178,7 @@ def agencies(request, countryslug='', stateslug='', cityslug='', nameslug=''):
         page_title = "List of Public Transit Agencies on City-Go-Round"    
     
     template_vars = {
-        'agencies': agency_list,
+        'agencies': shown_list,
         'location' : location,
         'location_string' : location_string,
         'public_count' : public_count,
@@ -233,12 +230,15 @@ def admin_agencies_update_locations(request):
         agency.update_location()
     for agencies_chunk in chunk_sequence(agencies, 100):        
         db.put(agencies_chunk)
+    bump_generation("Agency")
     return render_to_response(request, "admin/agencies-update-locations-finished.html")
 
 def delete_all_agencies(request):
     keys = [key for key in Agency.all(keys_only=True)]
     for keys_chunk in chunk_sequence(keys, 100):
         db.delete(keys_chunk)
+    AgencySupportIndex.remove_agencies(keys)
+    bump_generation("Agency")
     return render_to_response(request, "admin/agencies-deleteall-finished.html")
     
 def delete_agency(request,  agency_id):
@@ -249,12 +249,14 @@ def delete_agency(request,  agency_id):
     for explicit_app in explicit_apps:
         explicit_app.remove_explicitly_supported_agency(agency)
     
-    # Save the apps.
-    for explicit_app_chunk in chunk_sequence(explicit_apps, 10):
-        db.put(explicit_app_chunk)
+    # Save the apps (one at a time, so that put() moves them in the support index).
+    for explicit_app in explicit_apps:
+        explicit_app.put(bump_generation = False)
+    bump_generation("TransitApp")
 
-    # Now, delete the agency.
+    # Now, delete the agency (and its entry in the support index).
     agency.delete()
+    AgencySupportIndex.remove_agency(agency)
     
     return redirect_to("admin_agencies_list")
     
@@ -7,23 +7,50 @@ from django.conf import settings
 from google.appengine.ext import db
 
 from ..models import Agency, TransitApp
-from ..utils.view import render_to_response, redirect_to, not_implemented, bad_request, method_not_allowed, render_to_json
+from ..utils.view import render_to_response, redirect_to, not_implemented, bad_request, method_not_allowed, render_to_json, render_json_fragments, render_json_page, render_json_for_keyed_items, render_json_for_keys, render_json_encoded, render_gzip
+from ..utils.pagination import is_paginated, page_parameters, paginate_query, InvalidPageParameters
 from ..utils.slug import slugify
 from ..utils.geohelpers import are_latitude_and_longitude_valid
-from ..decorators import requires_valid_transit_app_slug, requires_valid_agency_key_encoded, requires_GET, memcache_view_response, memcache_parameterized_view_response
+from ..decorators import requires_valid_transit_app_slug, requires_valid_agency_key_encoded, requires_GET, memcache_view_response, memcache_parameterized_view_response, conditional_view_response, requires_valid_json_fields
 
 @requires_GET
-@memcache_view_response(time = settings.MEMCACHE_API_SECONDS)
-def api_agencies_all(request):
+@conditional_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency",))
+@memcache_parameterized_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency",))
+@requires_valid_json_fields(Agency.JSONABLE_FIELD_NAMES)
+def api_agencies_all(request, fields):
     """
         Return a list of all agencies.
         Called via GET only.
+        
+        parameters:
+            limit, cursor   (optional; see below)
+            fields          (optional; comma-separated names of the to_jsonable fields to include. By default, all of them)
+            format          (optional; "json", the default, "columns" or "columns.gz")
+        returns:
+            a json list of agencies (using to_jsonable); or, if limit or cursor
+            is given, a json object {"results": [at most limit agencies], "cursor": <for the next page, or null>}.
+            
+            With format=columns, a json object with one list of values per field 
+            (see AgencyCatalogue.to_columns); format=columns.gz gzips that.
     """    
-    return render_to_json([agency.to_jsonable() for agency in Agency.all()])
+    format = request.GET.get('format', 'json')
+    if format not in ['json', 'columns', 'columns.gz']:
+        return bad_request('format parameter must be "json", "columns" or "columns.gz"')
+    if format != 'json':
+        if is_paginated(request):
+            return bad_request('limit and cursor parameters only apply to the json format')
+        if format == 'columns':
+            return render_json_encoded(Agency.catalogue().to_columns_json(fields))
+        return render_gzip(Agency.catalogue().to_columns_gzip(fields), "agencies.json.gz")
+    if is_paginated(request):
+        return render_json_for_keyed_items(request, Agency.catalogue().records, Agency.json_fragments, fields)
+    return render_json_fragments(Agency.fetch_all_agencies_as_json_fragments(fields))
     
 @requires_GET
-@memcache_parameterized_view_response(time = settings.MEMCACHE_API_SECONDS)
-def api_agencies_search(request):
+@conditional_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency",))
+@memcache_parameterized_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency",))
+@requires_valid_json_fields(Agency.JSONABLE_FIELD_NAMES)
+def api_agencies_search(request, fields):
     """
         Return a list of agencies that match the search criterion.
         Called via GET only.
@@ -32,6 +59,7 @@ def api_agencies_search(request):
             type        ["location", "city", "state", "all"]
             lat,lon     (if location)
             city/state  (if city/state. If city, you must also include state)
+            limit, cursor, fields   (optional; as for api_agencies_all)
         returns:
             a json list of agencies (using to_jsonable)         
     """
@@ -52,39 +80,56 @@ def api_agencies_search(request):
         
         agencies_iter = Agency.fetch_agencies_near(latitude, longitude,bbox_side_in_miles=settings.NEARBY_AGENCIES_BBOX_SIDE_IN_MILES)
     else:
-        agencies_iter = Agency.all()
+        cityslug = None
+        stateslug = None
                 
         if search_type == 'city':
             city = request.GET.get('city', None)
             if not city:
                 return bad_request('city parameter must be supplied')
             # Use slugs rather than raw city name to ensure matches regardless of caps, etc.
-            agencies_iter = agencies_iter.filter('cityslug =', slugify(city))
+            cityslug = slugify(city)
         
         if search_type == 'city' or search_type == 'state':
             state = request.GET.get('state', None)
             if not state:
                 return bad_request('state parameter must be supplied')
             # Use slugs rather than raw city name to ensure matches regardless of caps, etc.        
-            agencies_iter = agencies_iter.filter('stateslug =', slugify(state))
+            stateslug = slugify(state)
+            
+        agencies_iter = Agency.fetch_for_slugs(stateslug = stateslug, cityslug = cityslug)
     
-    return render_to_json([agency.to_jsonable() for agency in agencies_iter])
+    return render_json_for_keyed_items(request, agencies_iter, Agency.json_fragments, fields)
 
 @requires_GET
+@conditional_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("TransitApp",))
+@requires_valid_json_fields(TransitApp.JSONABLE_FIELD_NAMES)
 # Can't use the memcache decorator here because of the private
 # (well, as private as open source APIs get) visible_only flag.
-def api_apps_all(request):
+def api_apps_all(request, fields):
     """
         Return a list of all transit apps.
         Called via GET only.
+        
+        parameters:
+            limit, cursor, fields   (optional; as for api_agencies_all)
     """
     visible_only_param = request.GET.get('visible_only', 'yes')
     visible_only = not (visible_only_param.lower() == 'no')
-    return render_to_json([transit_app.to_jsonable(include_visibility = not visible_only) for transit_app in TransitApp.query_all(visible_only = visible_only)])
+    if is_paginated(request):
+        try:
+            limit, cursor = page_parameters(request)
+            transit_apps, next_cursor = paginate_query(TransitApp.query_all(visible_only = visible_only), limit, cursor)
+        except InvalidPageParameters, error:
+            return bad_request(str(error))
+        return render_json_page(TransitApp.json_fragments(transit_apps, fields, include_visibility = not visible_only), next_cursor)
+    transit_apps = TransitApp.query_all(visible_only = visible_only).run(batch_size = 100)
+    return render_json_fragments(TransitApp.iter_json_fragments(transit_apps, fields, include_visibility = not visible_only))
 
 @requires_GET
-@memcache_parameterized_view_response(time = settings.MEMCACHE_API_SECONDS)
-def api_apps_search(request):
+@conditional_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency", "TransitApp"))
+@requires_valid_json_fields(TransitApp.JSONABLE_FIELD_NAMES)
+def api_apps_search(request, fields):
     """
         Return a list of transit apps that match the search criterion.
         Called via GET only.
@@ -112,35 +157,41 @@ def api_apps_search(request):
     if len(country_code) != 2:
         return bad_request('country parameter must be two characters')
     
-    # Query, sort by rating, and render JSON!
-    transit_apps = list(TransitApp.iter_for_location_and_country_code(latitude, longitude, country_code))
+    # Query (the results are cached per geocell and country), sort by rating, and render JSON!
+    transit_apps = TransitApp.fetch_for_geocell_and_country_code(latitude, longitude, country_code)
     transit_apps.sort(key=lambda x:x.bayesian_average,reverse=True)
     
-    return render_to_json([transit_app.to_jsonable() for transit_app in transit_apps])
+    return render_json_fragments(TransitApp.json_fragments(transit_apps, fields))
 
 @requires_GET
-@memcache_parameterized_view_response(time = settings.MEMCACHE_API_SECONDS)
+@conditional_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency", "TransitApp"))
+@memcache_parameterized_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency", "TransitApp"))
 @requires_valid_agency_key_encoded
-def api_apps_for_agency(request, agency):
+@requires_valid_json_fields(TransitApp.JSONABLE_FIELD_NAMES)
+def api_apps_for_agency(request, agency, fields):
     """
         Return a list of transit apps that support the given agency.
         Called via GET only.
     """    
-    return render_to_json([transit_app.to_jsonable() for transit_app in TransitApp.iter_for_agency(agency)])
+    return render_json_for_keys(request, TransitApp.keys_for_agency(agency), TransitApp.fetch_by_keys, TransitApp.json_fragments, fields)
     
 @requires_GET
+@conditional_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency", "TransitApp"))
 @requires_valid_transit_app_slug
-@memcache_parameterized_view_response(time = settings.MEMCACHE_API_SECONDS)
-def api_agencies_for_app(request, transit_app):
+@memcache_parameterized_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency", "TransitApp"))
+@requires_valid_json_fields(Agency.JSONABLE_FIELD_NAMES)
+def api_agencies_for_app(request, transit_app, fields):
     """
         Return a list of agencies that support the given transit app.
         Called via GET only.
     """
-    return render_to_json([agency.to_jsonable() for agency in Agency.iter_for_transit_app(transit_app)])
+    return render_json_for_keys(request, Agency.keys_for_transit_apps([transit_app]), Agency.fetch_by_keys, Agency.json_fragments, fields)
 
 @requires_GET
-@memcache_parameterized_view_response(time = settings.MEMCACHE_API_SECONDS)
-def api_apps_for_agencies(request):
+@conditional_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency", "TransitApp"))
+@memcache_parameterized_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency", "TransitApp"))
+@requires_valid_json_fields(TransitApp.JSONABLE_FIELD_NAMES)
+def api_apps_for_agencies(request, fields):
     """
         Return a list of transit apps that support the given agency.
         Called via GET only.
@@ -169,11 +220,13 @@ def api_apps_for_agencies(request):
         return bad_request('At least one invalid agency key.')
 
     # Send off the apps!
-    return render_to_json([transit_app.to_jsonable() for transit_app in TransitApp.iter_for_agencies(agencies)])
+    return render_json_for_keys(request, TransitApp.keys_for_agencies(agencies), TransitApp.fetch_by_keys, TransitApp.json_fragments, fields)
 
 @requires_GET
-@memcache_parameterized_view_response(time = settings.MEMCACHE_API_SECONDS)
-def api_agencies_for_apps(request):
+@conditional_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency", "TransitApp"))
+@memcache_parameterized_view_response(time = settings.MEMCACHE_API_SECONDS, kinds = ("Agency", "TransitApp"))
+@requires_valid_json_fields(Agency.JSONABLE_FIELD_NAMES)
+def api_agencies_for_apps(request, fields):
     """
         Return a list of agencies that support the given transit app.
         Called via GET only.
@@ -196,4 +249,4 @@ def api_agencies_for_apps(request):
         transit_apps.append(transit_app)
     
     # Send off the agencies
-    return render_to_json([agency.to_jsonable() for agency in Agency.iter_for_transit_apps(transit_apps)])
+    return render_json_for_keys(request, Agency.keys_for_transit_apps(transit_apps), Agency.fetch_by_keys, Agency.json_fragments, fields)
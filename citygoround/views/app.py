@@ -7,8 +7,10 @@ from datetime import datetime, timedelta, date
 
 from django.conf import settings
 from django.http import Http404
+from django.core.urlresolvers import reverse
 from google.appengine.ext import db
 from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
 
 from ..forms import NewAppGeneralInfoForm, NewAppAgencyForm, NewAppLocationForm, PetitionForm, EditAppGeneralInfoForm, EditAppLocationForm, EditAppAgencyForm, EditAppImagesForm
 from ..utils.view import render_to_response, redirect_to, not_implemented, render_image_response, redirect_to_url, method_not_allowed, render_to_json
@@ -16,11 +18,13 @@ from ..utils.prettyprint import pretty_print_price
 from ..utils.progressuuid import add_progress_uuid_to_session, remove_progress_uuid_from_session
 from ..utils.screenshot import kick_off_resizing_for_screen_shots, kick_off_resizing_for_screen_shot
 from ..utils.misc import chunk_sequence, pad_list, collapse_list
-from ..utils.ratings import get_user_rating_for_app, set_user_rating_for_app, adjust_rating_for_app
+from ..utils.ratings import get_user_rating_for_app, set_user_rating_for_app, enqueue_rating_vote, fold_rating_votes, refresh_bayesian_averages
 from ..utils.memcache import clear_all_apps
+from ..utils.generation import bump_generation
 from ..utils.mailer import kick_off_new_app_notification
+from ..utils.gallery import gallery_layout
 from ..decorators import requires_valid_transit_app_slug, requires_valid_progress_uuid, requires_POST, memcache_view_response, memcache_parameterized_view_response
-from ..models import Agency, TransitApp, TransitAppStats, TransitAppLocation, TransitAppFormProgress, FeedReference, NamedStat
+from ..models import Agency, TransitApp, TransitAppLocation, TransitAppFormProgress, FeedReference, NamedStat, EntityCount
 
 from django.http import HttpResponse, HttpResponseForbidden
 from django.utils import simplejson as json
@@ -34,41 +38,10 @@ def nearby(request):
     }    
     return render_to_response(request, 'app/nearby.html', template_vars)
 
-@memcache_view_response(time = settings.MEMCACHE_PAGE_SECONDS)
+@memcache_view_response(time = settings.MEMCACHE_PAGE_SECONDS, kinds = ("TransitApp",))
 def gallery(request):
-
-    def app_in_list(app, list):
-        for item in list:
-            if (app.slug == item.slug):
-                return True
-        return False
-        
-    NUM_RECENT_APPS = 3
-    NUM_FEATURED_APPS = 3
-    CATEGORIES = ["Public Transit", "Biking", "Walking", "Driving"]
-    
-    all_apps = TransitApp.fetch_all_sorted_by_rating()
-
-    recent_list = TransitApp.all_by_most_recently_added().fetch(NUM_RECENT_APPS)
-    featured_list = []
-    # make dict of category_name:[]
-    categorized_list = dict([(x,[]) for x in CATEGORIES])
-    
-    for app in all_apps:
-        # if it's recently added, don't show it again
-        if app_in_list(app, recent_list):
-            continue
-        
-        # if it's featured, don't show it again
-        if app.is_featured and len(featured_list) < NUM_FEATURED_APPS:
-            featured_list.append(app)
-            continue
-
-        # if an app is in a category, add it to that category's list and then
-        # break to prevent it from being added to any other category's list
-        for category in CATEGORIES:
-            if category in app.categories:
-                categorized_list[category].append( app )
+    recent_list, featured_list, categorized_list = gallery_layout().fetch_transit_apps()
+    counts = EntityCount.get_values([EntityCount.VISIBLE_TRANSIT_APPS, EntityCount.PUBLIC_AGENCIES])
                 
     template_vars = {
         'biking_apps':         categorized_list.get('Biking',[]),
@@ -77,8 +50,8 @@ def gallery(request):
         'transit_apps':        categorized_list.get('Public Transit',[]),
         'featured_apps':       featured_list, 
         'recently_added_apps': recent_list, 
-        'transit_app_count':   TransitApp.query_all().count(),
-        'public_feed_count':   Agency.all().filter("date_opened != ", None).count(),
+        'transit_app_count':   counts[EntityCount.VISIBLE_TRANSIT_APPS],
+        'public_feed_count':   counts[EntityCount.PUBLIC_AGENCIES],
         'show_redfin_links':   True,
     }
         
@@ -542,34 +515,52 @@ def app_rating_vote(request, transit_app):
     if (new_rating is not None) and ((new_rating < 0) or (new_rating > 5)):
         return bad_request("Invalid rating: out of range.")
 
-    # Update the rating
+    # Queue up the rating change; it'll be applied to the app shortly
     old_rating = get_user_rating_for_app(request, transit_app)
-    adjust_rating_for_app(transit_app, old_rating, new_rating)
+    enqueue_rating_vote(transit_app, old_rating, new_rating)
     set_user_rating_for_app(request, transit_app, new_rating)
 
     # Done!
     return render_to_json([transit_app.average_rating, transit_app.num_ratings])
     
 def refresh_all_bayesian_averages(request):
-    all_apps = TransitApp.query_all(visible_only = False)
+    """Refresh the apps' bayesian averages, picking up at the cursor parameter, if any.
     
-    all_rating_sum = NamedStat.get_stat( "all_rating_sum" )
-    all_rating_count = NamedStat.get_stat( "all_rating_count" )
+    If time runs out first, a task is queued to carry on from where this left off. With dry_run=1,
+    nothing is saved (or carried on); the response says how many apps would have changed."""
+    params = request.POST if request.method == "POST" else request.GET
+    cursor = params.get('cursor') or None
+    dry_run = bool(params.get('dry_run'))
     
-    for app in all_apps:
-        logging.info( "%s: old bayesian average %s"%(app.key().id(), app.bayesian_average) )
-        app.refresh_bayesian_average( all_rating_sum, all_rating_count )
-        app.put()
-        logging.info( "%s: new bayesian average %s"%(app.key().id(), app.bayesian_average) )
-        
-    return HttpResponse( "Should have worked alright. Check out the log." )
+    examined_count, changed_count, next_cursor = refresh_bayesian_averages(cursor, dry_run)
+    logging.info("Bayesian average refresh: %d apps examined, %d %s" % (examined_count, changed_count, "would change" if dry_run else "changed"))
+    if dry_run:
+        message = "%d of %d apps examined would change." % (changed_count, examined_count)
+        if next_cursor is not None:
+            message += " More apps remain; carry on with ?dry_run=1&cursor=%s" % next_cursor
+        return HttpResponse(message)
+    
+    if next_cursor is not None:
+        task = taskqueue.Task(
+            url = reverse("refresh_all_bayesian_averages"),
+            params = {"cursor": next_cursor},
+        )
+        task.add()
+    return HttpResponse("%d of %d apps examined changed.%s" % (changed_count, examined_count, " Queued a task to refresh the rest." if next_cursor is not None else ""))
+
+def admin_apps_fold_rating_votes(request):
+    vote_count = fold_rating_votes()
+    return HttpResponse("Applied %d rating votes." % vote_count)
     
 def admin_apps_update_schema(request):
     changed_apps = []
     new_families = []
+    hidden_app_keys = set()
 
     for transit_app in TransitApp.query_all(visible_only = False):    
         changed = False
+        if transit_app.is_hidden:
+            hidden_app_keys.add(transit_app.key())
         
         # Make sure that the app has appropriate dates
         if not transit_app.date_added:
@@ -620,13 +611,26 @@ def admin_apps_update_schema(request):
         if changed:
             changed_apps.append(transit_app)
     
+    # Locations carry a copy of their app's is_hidden flag.
+    changed_locations = []
+    for transit_app_location in TransitAppLocation.all():
+        is_hidden = TransitAppLocation.transit_app.get_value_for_datastore(transit_app_location) in hidden_app_keys
+        if transit_app_location.is_hidden != is_hidden:
+            transit_app_location.is_hidden = is_hidden
+            changed_locations.append(transit_app_location)
+    
     # Looks like we're done. Attempt to commit everything to our database.
-    for changed_app_chunk in chunk_sequence(changed_apps, 10):
-        db.put(changed_app_chunk)
+    # (One app at a time, so that put() keeps the support index and counts in step.)
+    for transit_app in changed_apps:
+        transit_app.put(bump_generation = False)
+    for changed_location_chunk in chunk_sequence(changed_locations, 100):
+        db.put(changed_location_chunk)
+    bump_generation("TransitApp")
     
     # Render some vaguely useful results
     template_vars = {
         "update_count": len(changed_apps),
         "family_count": len(new_families),
+        "location_update_count": len(changed_locations),
     }    
     return render_to_response(request, "admin/apps-update-schema-finished.html", template_vars)
@@ -5,6 +5,10 @@ from ..decorators import requires_POST
 from ..utils.view import render_to_json
 from ..utils.screenshot import create_and_store_screen_shot_blob_for_family
 from ..utils.mailer import send_to_contact
+from google.appengine.api.labs import taskqueue
+from django.core.urlresolvers import reverse
+from ..utils.memcache import clear_app_gallery
+from ..models import GalleryLayout, GeocellHistogram, TransitAppLocation
 
 from django.conf import settings
 
@@ -45,4 +49,41 @@ def taskqueue_notify_new_app(request):
     
     # Done. HTTP 200 is all AppEngine needs to be happy.   
     return render_to_json({"success": True})
-    
\ No newline at end of file
+
+def taskqueue_rebuild_gallery_layout(request):
+    GalleryLayout.build()
+    
+    # Pages rendered from the old layout were cached under the current generation; let them go.
+    clear_app_gallery()
+    
+    # Done. HTTP 200 is all AppEngine needs to be happy.
+    return render_to_json({"success": True})
+
+@requires_POST
+def taskqueue_rebuild_geocell_histogram(request):
+    try:
+        kind = request.POST['kind']
+        build_id = request.POST['build_id']
+        entity_count = int(request.POST['entity_count'])
+    except (KeyError, ValueError):
+        raise ValueError("Invalid geocell histogram rebuild task invocation.")
+    
+    # Count the next batch; it queues up the one after itself.
+    GeocellHistogram.rebuild_batch(kind, build_id, request.POST.get('cursor'), entity_count)
+    
+    # Done. HTTP 200 is all AppEngine needs to be happy.
+    return render_to_json({"success": True})
+
+@requires_POST
+def taskqueue_backfill_location_is_hidden(request):
+    # Do a batch, then queue up the next one, if any.
+    next_cursor = TransitAppLocation.backfill_is_hidden_batch(request.POST.get('cursor') or None)
+    if next_cursor is not None:
+        task = taskqueue.Task(
+            url = reverse("taskqueue_backfill_location_is_hidden"),
+            params = {"cursor": next_cursor},
+        )
+        task.add(queue_name = "migration-queue")
+    
+    # Done. HTTP 200 is all AppEngine needs to be happy.
+    return render_to_json({"success": True})
@@ -1,27 +1,26 @@
 import time
 import logging
-import csv
-import StringIO
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
 from ..forms import PetitionForm, AgencyForm, ContactForm
-from ..utils.view import render_to_response, redirect_to, not_implemented, render_to_json, render_csv
+from ..utils.view import render_to_response, redirect_to, not_implemented, render_to_json, render_csv_rows
 from ..utils.mailer import send_to_contact
-from ..models import FeedReference, Agency, NamedStat, TransitApp
+from ..utils.memcache import local_view_cache, view_cache_statistics
+from ..models import FeedReference, Agency, NamedStat, TransitApp, TransitAppLocation, GeocellHistogram, EntityCount
 from ..decorators import memcache_view_response, requires_GET, requires_POST
 from django.template.context import RequestContext
 from django.conf import settings
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect
 from google.appengine.api.users import create_login_url, create_logout_url
 
-@memcache_view_response(time = settings.MEMCACHE_PAGE_SECONDS)
+@memcache_view_response(time = settings.MEMCACHE_PAGE_SECONDS, kinds = ("Agency", "TransitApp"))
 def home(request):  
     template_vars = {
         'featured_apps': TransitApp.featured_by_most_recently_added().fetch(8),
         'petition_form': PetitionForm(),
         'no_getsatisfaction' : True,
-        'agency_count': Agency.all().count(),
+        'agency_count': EntityCount.get_value(EntityCount.AGENCIES),
         'closed_agencies': Agency.all().filter("date_opened =", None).filter("private =", False).order("-passenger_miles"),
         'open_agencies': Agency.all().filter("date_opened !=", None).order("-date_opened"),
         'show_redfin_links': True,
@@ -66,7 +65,7 @@ def admin_logout(request):
     return HttpResponseRedirect( create_logout_url("/") )
 
 def admin_home(request):
-    all_stats = NamedStat.all()
+    all_stats = NamedStat.all_stats()
     return render_to_response(request, 'admin/home.html', {'all_stats':all_stats})
     
 def admin_integrity_check(request):
@@ -161,29 +160,45 @@ def comment(request):
 
 def admin_memcache_statistics(request):
     stats = [(k, v) for k, v in memcache.get_stats().iteritems()]
+    view_stats = sorted(view_cache_statistics().iteritems())
     template_vars = {
         'memcache_statistics': stats,
+        'view_cache_statistics': view_stats,
     }
     return render_to_response(request, "admin/memcache-statistics.html", template_vars)
     
 @requires_GET
 def admin_memcache_statistics_json(request):
     stats = dict(memcache.get_stats())
+    stats['views'] = view_cache_statistics()
     return render_to_json(stats)
     
 @requires_POST
 def admin_clear_memcache(request):
     success = memcache.flush_all()
+    local_view_cache.clear()
     return render_to_json({"success": success})
 
+def admin_rebuild_geocell_histograms(request):
+    """Start recounting how many agencies and transit app locations fall in each geocell, in tasks. Run by cron."""
+    model_classes = (Agency, TransitAppLocation)
+    for model_class in model_classes:
+        GeocellHistogram.start_rebuild(model_class)
+    return HttpResponse("Queued geocell histogram rebuilds: %s" % ", ".join([model_class.kind() for model_class in model_classes]))
+
+def admin_reconcile_entity_counts(request):
+    """Recount agencies and transit apps from scratch, fixing any drift in the EntityCounts. Run by cron."""
+    counts = Agency.recount()
+    counts.update(TransitApp.recount())
+    EntityCount.reconcile(counts)
+    return HttpResponse("Reconciled entity counts: %s" % ", ".join(["%s = %d" % (name, value) for name, value in sorted(counts.iteritems())]))
+
 @requires_GET
 def admin_apps_csv(request):
-    string_io = StringIO.StringIO()
-    writer = csv.writer(string_io)
-    writer.writerow(["APP NAME", "APP AUTHOR", "AUTHOR EMAIL", "APP HOMEPAGE", "APP DESCRIPTION", "APP IS HIDDEN"])
-    for transit_app in TransitApp.query_all(visible_only = False):
-        writer.writerow([transit_app.title.encode('utf8'), transit_app.author_name.encode('utf8'), str(transit_app.author_email).encode('utf8'), str(transit_app.url).encode('utf8'), transit_app.description.encode('utf8'), repr(transit_app.is_hidden).encode('utf8')])
-    csv_output = string_io.getvalue()
-    string_io.close()
-    return render_csv(csv_output)
+    return render_csv_rows(_iter_apps_csv_rows(TransitApp.query_all(visible_only = False).run(batch_size = 100)))
+    
+def _iter_apps_csv_rows(transit_apps):
+    yield ["APP NAME", "APP AUTHOR", "AUTHOR EMAIL", "APP HOMEPAGE", "APP DESCRIPTION", "APP IS HIDDEN"]
+    for transit_app in transit_apps:
+        yield [transit_app.title.encode('utf8'), transit_app.author_name.encode('utf8'), str(transit_app.author_email).encode('utf8'), str(transit_app.url).encode('utf8'), transit_app.description.encode('utf8'), repr(transit_app.is_hidden).encode('utf8')]
 
@@ -0,0 +1,94 @@
+#!/usr/bin/python2.5
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batched geometry over whole candidate sets.
+
+Rather than filtering or measuring entities one at a time, these functions take
+parallel lists of latitudes and longitudes (see coordinates()) and process an
+entire candidate set in one call, hoisting per-call work such as the search
+center's trigonometry out of the per-point loop.
+"""
+
+import math
+from itertools import izip
+
+import geomath
+
+
+def coordinates(entities):
+  """Extracts the coordinates of the given located entities.
+
+  Args:
+    entities: A list of entities with a 'location' db.GeoPt or geotypes.Point.
+
+  Returns:
+    A (lats, lons) tuple of parallel lists of floats.
+  """
+  locations = [entity.location for entity in entities]
+  return ([location.lat for location in locations],
+          [location.lon for location in locations])
+
+
+def box_mask(lats, lons, bbox):
+  """Tests which of the given coordinates fall inside a bounding box.
+
+  Args:
+    lats: A list of latitudes.
+    lons: A list of longitudes, parallel to lats.
+    bbox: A geotypes.Box to test against. Its edges count as inside.
+
+  Returns:
+    A list of bools, parallel to lats, that are True for points inside bbox.
+  """
+  north, east, south, west = bbox.north, bbox.east, bbox.south, bbox.west
+  return [south <= lat <= north and west <= lon <= east
+          for lat, lon in izip(lats, lons)]
+
+
+def distances(center, lats, lons):
+  """Calculates the great circle distance from a point to many points.
+
+  Uses the haversine formula, which (unlike the law of cosines used by
+  geomath.distance) stays accurate for nearby points.
+
+  Args:
+    center: A geotypes.Point or db.GeoPt to measure from.
+    lats: A list of latitudes.
+    lons: A list of longitudes, parallel to lats.
+
+  Returns:
+    A list of distances in meters, parallel to lats.
+  """
+  radians, sin, cos, asin, sqrt = (math.radians, math.sin, math.cos,
+                                   math.asin, math.sqrt)
+  center_lat = radians(center.lat)
+  center_lon = radians(center.lon)
+  cos_center_lat = cos(center_lat)
+  diameter = 2 * geomath.RADIUS
+
+  result = []
+  append = result.append
+  for lat, lon in izip(lats, lons):
+    lat = radians(lat)
+    sin_half_dlat = sin((lat - center_lat) / 2)
+    sin_half_dlon = sin((radians(lon) - center_lon) / 2)
+    h = (sin_half_dlat * sin_half_dlat +
+         cos_center_lat * cos(lat) * sin_half_dlon * sin_half_dlon)
+    append(diameter * asin(min(1.0, sqrt(h))))
+  return result
+
+
+def compress(items, mask):
+  """Returns the items whose corresponding mask value is True."""
+  return [item for item, keep in izip(items, mask) if keep]
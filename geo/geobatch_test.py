@@ -0,0 +1,65 @@
+#!/usr/bin/python2.5
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for geobatch.py."""
+
+import unittest
+
+import geobatch
+import geomath
+import geotypes
+
+
+class _Located(object):
+  def __init__(self, lat, lon):
+    self.location = geotypes.Point(lat, lon)
+
+
+class GeobatchTests(unittest.TestCase):
+  def test_coordinates(self):
+    lats, lons = geobatch.coordinates([_Located(37, -122), _Located(42, -75)])
+    self.assertEquals([37, 42], lats)
+    self.assertEquals([-122, -75], lons)
+
+    self.assertEquals(([], []), geobatch.coordinates([]))
+
+  def test_box_mask(self):
+    bbox = geotypes.Box(40, -70, 30, -120)
+    lats = [35, 40, 45, 35, 30]
+    lons = [-100, -70, -100, -125, -120]
+    self.assertEquals([True, True, False, False, True],
+                      geobatch.box_mask(lats, lons, bbox))
+
+  def test_compress(self):
+    self.assertEquals(['a', 'c'],
+                      geobatch.compress(['a', 'b', 'c'], [True, False, True]))
+
+  def test_distances(self):
+    center = geotypes.Point(37, -122)
+    lats = [42, 37, 37.001, -33.9]
+    lons = [-75, -122, -122, 151.2]
+    calc_dists = geobatch.distances(center, lats, lons)
+
+    self.assertEquals(4, len(calc_dists))
+    self.assertEquals(0, calc_dists[1])
+    # About 111 meters per thousandth of a degree of latitude.
+    self.assertTrue(abs(calc_dists[2] - 111) < 1)
+    # Should agree with geomath.distance for points that aren't too close.
+    for i in (0, 3):
+      known_dist = geomath.distance(center, geotypes.Point(lats[i], lons[i]))
+      self.assertTrue(abs((calc_dists[i] - known_dist) / known_dist) <= 1e-6)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -67,6 +67,8 @@ region for the geocell.
 
 __author__ = 'api.roman.public@gmail.com (Roman Nurik)'
 
+import collections
+import inspect
 import os.path
 import sys
 
@@ -83,6 +85,9 @@ MAX_GEOCELL_RESOLUTION = 13
 # The maximum number of geocells to consider for a bounding box search.
 MAX_FEASIBLE_BBOX_SEARCH_CELLS = 300
 
+# The maximum number of entries kept in each of the memoized geometry caches.
+_GEOMETRY_CACHE_SIZE = 10000
+
 # Direction enumerations.
 NORTHWEST = (-1, 1)
 NORTH = (0, 1)
@@ -94,6 +99,17 @@ SOUTHWEST = (-1, -1)
 WEST = (-1, 0)
 
 
+def _takes_cells_argument(cost_function):
+  """Returns whether the cost function can be passed a cells argument."""
+  try:
+    args, varargs, varkw, defaults = inspect.getargspec(cost_function)
+  except TypeError:
+    # Not a plain function or method (a callable object, say); assume the
+    # original two-argument contract.
+    return False
+  return ('cells' in args) or (varkw is not None)
+
+
 def best_bbox_search_cells(bbox, cost_function):
   """Returns an efficient set of geocells to search in a bounding box query.
 
@@ -102,17 +118,19 @@ def best_bbox_search_cells(bbox, cost_function):
 
   Args:
     bbox: A geotypes.Box indicating the bounding box being searched.
-    cost_function: A function that accepts two arguments:
+    cost_function: A function that accepts these keyword arguments:
         * num_cells: the number of cells to search
         * resolution: the resolution of each cell to search
-        and returns the 'cost' of querying against this number of cells
-        at the given resolution.
+        * cells: (only if the function takes a 'cells' or ** argument) the
+          list of geocell strings to search
+        and returns the 'cost' of querying against these cells.
 
   Returns:
     A list of geocell strings that contain the given box.
   """
   cell_ne = compute(bbox.north_east, resolution=MAX_GEOCELL_RESOLUTION)
   cell_sw = compute(bbox.south_west, resolution=MAX_GEOCELL_RESOLUTION)
+  takes_cells = _takes_cells_argument(cost_function)
 
   # The current lowest BBOX-search cost found; start with practical infinity.
   min_cost = 1e10000
@@ -137,7 +155,11 @@ def best_bbox_search_cells(bbox, cost_function):
     cell_set = sorted(interpolate(cur_ne, cur_sw))
     simplified_cells = []
 
-    cost = cost_function(num_cells=len(cell_set), resolution=cur_resolution)
+    if takes_cells:
+      cost = cost_function(num_cells=len(cell_set), resolution=cur_resolution,
+                           cells=cell_set)
+    else:
+      cost = cost_function(num_cells=len(cell_set), resolution=cur_resolution)
 
     # TODO(romannurik): See if this resolution is even possible, as in the
     # future cells at certain resolutions may not be stored.
@@ -188,35 +210,28 @@ def interpolate(cell_ne, cell_sw):
   Generates the set of cells in the grid created by interpolating from the
   given Northeast geocell to the given Southwest geocell.
 
-  Assumes the Northeast geocell is actually Northeast of Southwest geocell.
+  Assumes the Northeast geocell is actually Northeast of Southwest geocell,
+  and that both cells have the same resolution.
 
   Arguments:
     cell_ne: The Northeast geocell string.
     cell_sw: The Southwest geocell string.
 
   Returns:
-    A list of geocell strings in the interpolation.
+    A list of geocell strings in the interpolation, row by row from South to
+    North, each row from West to East.
   """
-  # 2D array, will later be flattened.
-  cell_set = [[cell_sw]]
-
-  # First get adjacent geocells across until Southeast--collinearity with
-  # Northeast in vertical direction (0) means we're at Southeast.
-  while not collinear(cell_set[0][-1], cell_ne, True):
-    cell_tmp = adjacent(cell_set[0][-1], (1, 0))
-    if cell_tmp is None:
-      break
-    cell_set[0].append(cell_tmp)
+  resolution = len(cell_sw)
+  grid_size = 1 << (2 * resolution)
+  ne_x, ne_y = _cell_xy(cell_ne)
+  sw_x, sw_y = _cell_xy(cell_sw)
 
-  # Then get adjacent geocells upwards.
-  while cell_set[-1][-1] != cell_ne:
-    cell_tmp_row = [adjacent(g, (0, 1)) for g in cell_set[-1]]
-    if cell_tmp_row[0] is None:
-      break
-    cell_set.append(cell_tmp_row)
+  # Columns wrap around the antimeridian, rows stop at the pole.
+  num_cols = (ne_x - sw_x) % grid_size + 1
+  rows = range(sw_y, (ne_y if ne_y >= sw_y else grid_size - 1) + 1)
 
-  # Flatten cell_set, since it's currently a 2D array.
-  return [g for inner in cell_set for g in inner]
+  return [_cell_from_xy((sw_x + col) % grid_size, y, resolution)
+          for y in rows for col in range(num_cols)]
 
 
 def interpolation_count(cell_ne, cell_sw):
@@ -276,53 +291,22 @@ def adjacent(cell, dir):
   if cell is None:
     return None
 
-  dx = dir[0]
-  dy = dir[1]
-
-  cell_adj_arr = list(cell)  # Split the geocell string characters into a list.
-  i = len(cell_adj_arr) - 1
-
-  while i >= 0 and (dx != 0 or dy != 0):
-    x, y = _subdiv_xy(cell_adj_arr[i])
-
-    # Horizontal adjacency.
-    if dx == -1:  # Asking for left.
-      if x == 0:  # At left of parent cell.
-        x = _GEOCELL_GRID_SIZE - 1  # Becomes right edge of adjacent parent.
-      else:
-        x -= 1  # Adjacent, same parent.
-        dx = 0  # Done with x.
-    elif dx == 1:  # Asking for right.
-      if x == _GEOCELL_GRID_SIZE - 1:  # At right of parent cell.
-        x = 0  # Becomes left edge of adjacent parent.
-      else:
-        x += 1  # Adjacent, same parent.
-        dx = 0  # Done with x.
-
-    # Vertical adjacency.
-    if dy == 1:  # Asking for above.
-      if y == _GEOCELL_GRID_SIZE - 1:  # At top of parent cell.
-        y = 0  # Becomes bottom edge of adjacent parent.
-      else:
-        y += 1  # Adjacent, same parent.
-        dy = 0  # Done with y.
-    elif dy == -1:  # Asking for below.
-      if y == 0:  # At bottom of parent cell.
-        y = _GEOCELL_GRID_SIZE - 1  # Becomes top edge of adjacent parent.
-      else:
-        y -= 1  # Adjacent, same parent.
-        dy = 0  # Done with y.
-
-    cell_adj_arr[i] = _subdiv_char((x,y))
-    i -= 1
-
-  # If we're not done with y then it's trying to wrap vertically,
-  # which is a failure.
-  if dy != 0:
-    return None
+  cache_key = (cell, tuple(dir))
+  cell_adj = _adjacent_cache.get(cache_key, _MISSING)
+  if cell_adj is _MISSING:
+    resolution = len(cell)
+    grid_size = 1 << (2 * resolution)
+    x, y = _cell_xy(cell)
+    y += dir[1]
+
+    if 0 <= y < grid_size:
+      # Horizontal wrapping is allowed, vertical wrapping is a failure.
+      cell_adj = _cell_from_xy((x + dir[0]) % grid_size, y, resolution)
+    else:
+      cell_adj = None
+    _adjacent_cache.set(cache_key, cell_adj)
 
-  # At this point, horizontal wrapping is done inherently.
-  return ''.join(cell_adj_arr)
+  return cell_adj
 
 
 def contains_point(cell, point):
@@ -370,7 +354,8 @@ def point_distance(cell, point):
 def compute(point, resolution=MAX_GEOCELL_RESOLUTION):
   """Computes the geocell containing the given point to the given resolution.
 
-  This is a simple 16-tree lookup to an arbitrary depth (resolution).
+  Rather than walking the 16-tree one level at a time, this finds the point's
+  column and row at the requested resolution directly and interleaves them.
 
   Args:
     point: The geotypes.Point to compute the cell for.
@@ -379,30 +364,13 @@ def compute(point, resolution=MAX_GEOCELL_RESOLUTION):
   Returns:
     The geocell string containing the given point, of length <resolution>.
   """
-  north = 90.0
-  south = -90.0
-  east = 180.0
-  west = -180.0
-
-  cell = ''
-  while len(cell) < resolution:
-    subcell_lon_span = (east - west) / _GEOCELL_GRID_SIZE
-    subcell_lat_span = (north - south) / _GEOCELL_GRID_SIZE
-
-    x = min(int(_GEOCELL_GRID_SIZE * (point.lon - west) / (east - west)),
-            _GEOCELL_GRID_SIZE - 1)
-    y = min(int(_GEOCELL_GRID_SIZE * (point.lat - south) / (north - south)),
-            _GEOCELL_GRID_SIZE - 1)
+  # The point's column and row in the grid of all cells at this resolution,
+  # whose bits interleave to form the cell.
+  grid_size = 1 << (2 * resolution)
+  x = min(int(grid_size * (point.lon + 180.0) / 360.0), grid_size - 1)
+  y = min(int(grid_size * (point.lat + 90.0) / 180.0), grid_size - 1)
 
-    cell += _subdiv_char((x,y))
-
-    south += subcell_lat_span * y
-    north = south + subcell_lat_span
-
-    west += subcell_lon_span * x
-    east = west + subcell_lon_span
-
-  return cell
+  return _cell_from_xy(x, y, resolution)
 
 
 def compute_box(cell):
@@ -417,22 +385,21 @@ def compute_box(cell):
   if cell is None:
     return None
 
-  bbox = geotypes.Box(90.0, 180.0, -90.0, -180.0)
-
-  while len(cell) > 0:
-    subcell_lon_span = (bbox.east - bbox.west) / _GEOCELL_GRID_SIZE
-    subcell_lat_span = (bbox.north - bbox.south) / _GEOCELL_GRID_SIZE
-
-    x, y = _subdiv_xy(cell[0])
+  bounds = _box_cache.get(cell)
+  if bounds is None:
+    grid_size = 1 << (2 * len(cell))
+    lat_span = 180.0 / grid_size
+    lon_span = 360.0 / grid_size
+    x, y = _cell_xy(cell)
 
-    bbox = geotypes.Box(bbox.south + subcell_lat_span * (y + 1),
-                        bbox.west  + subcell_lon_span * (x + 1),
-                        bbox.south + subcell_lat_span * y,
-                        bbox.west  + subcell_lon_span * x)
+    bounds = (-90.0 + lat_span * (y + 1),
+              -180.0 + lon_span * (x + 1),
+              -90.0 + lat_span * y,
+              -180.0 + lon_span * x)
+    _box_cache.set(cell, bounds)
 
-    cell = cell[1:]
-
-  return bbox
+  # Boxes are mutable, so don't hand out the same one twice.
+  return geotypes.Box(*bounds)
 
 
 def is_valid(cell):
@@ -465,3 +432,88 @@ def _subdiv_char(pos):
       (pos[0] & 2) << 1 |
       (pos[1] & 1) << 1 |
       (pos[0] & 1) << 0]
+
+
+def _spread_bits(byte):
+  """Spreads the 8 bits of the given int out over the even bits of 16."""
+  return reduce(lambda spread, bit: spread | ((byte >> bit) & 1) << (2 * bit),
+                range(8), 0)
+
+
+_SPREAD_BITS = [_spread_bits(byte) for byte in range(256)]
+_UNSPREAD_BITS = dict((spread, byte) for byte, spread
+                      in enumerate(_SPREAD_BITS))
+
+
+def _cell_from_xy(x, y, resolution):
+  """Returns the geocell at column x, row y of the grid at the resolution.
+
+  A geocell's hexadecimal digits, read as a single number, are the bits of x
+  and y interleaved (x in the even bits, y in the odd bits). See _subdiv_char.
+  """
+  if not resolution:
+    return ''
+
+  code = 0
+  shift = 0
+  while x or y:
+    code |= (_SPREAD_BITS[x & 0xff] | _SPREAD_BITS[y & 0xff] << 1) << shift
+    x >>= 8
+    y >>= 8
+    shift += 16
+
+  return '%0*x' % (resolution, code)
+
+
+def _cell_xy(cell):
+  """Returns the (x, y) column and row of the geocell in the grid of all cells
+  at its resolution. The inverse of _cell_from_xy."""
+  code = int(cell, 16) if cell else 0
+
+  x = y = 0
+  shift = 0
+  while code:
+    x |= _UNSPREAD_BITS[code & 0x5555] << shift
+    y |= _UNSPREAD_BITS[(code >> 1) & 0x5555] << shift
+    code >>= 16
+    shift += 8
+
+  return x, y
+
+
+class _LRUCache(object):
+  """A dict-like cache holding at most max_size of the most recently used
+  entries."""
+
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._entries = collections.OrderedDict()
+
+  def get(self, key, default=None):
+    try:
+      value = self._entries.pop(key)
+    except KeyError:
+      return default
+    self._entries[key] = value
+    return value
+
+  def set(self, key, value):
+    self._entries.pop(key, None)
+    self._entries[key] = value
+    if len(self._entries) > self._max_size:
+      self._entries.popitem(last=False)
+
+  def clear(self):
+    self._entries.clear()
+
+  def __len__(self):
+    return len(self._entries)
+
+
+# Memoized geometry: cell -> (north, east, south, west) bounds, and
+# (cell, direction) -> adjacent cell.
+_box_cache = _LRUCache(_GEOMETRY_CACHE_SIZE)
+_adjacent_cache = _LRUCache(_GEOMETRY_CACHE_SIZE)
+
+# Marks a cache miss where None is a legitimate cached value.
+_MISSING = object()
@@ -18,12 +18,123 @@
 
 __author__ = 'api.roman.public@gmail.com (Roman Nurik)'
 
+import random
 import unittest
 
 import geocell
 import geotypes
 
 
+# The original, level-by-level implementations of the geocell geometry, which
+# the closed-form ones should agree with exactly.
+
+def _reference_compute(point, resolution):
+  north, south, east, west = 90.0, -90.0, 180.0, -180.0
+
+  cell = ''
+  while len(cell) < resolution:
+    subcell_lon_span = (east - west) / 4
+    subcell_lat_span = (north - south) / 4
+
+    x = min(int(4 * (point.lon - west) / (east - west)), 3)
+    y = min(int(4 * (point.lat - south) / (north - south)), 3)
+
+    cell += geocell._subdiv_char((x, y))
+
+    south += subcell_lat_span * y
+    north = south + subcell_lat_span
+
+    west += subcell_lon_span * x
+    east = west + subcell_lon_span
+
+  return cell
+
+
+def _reference_compute_box(cell):
+  bbox = geotypes.Box(90.0, 180.0, -90.0, -180.0)
+
+  while len(cell) > 0:
+    subcell_lon_span = (bbox.east - bbox.west) / 4
+    subcell_lat_span = (bbox.north - bbox.south) / 4
+
+    x, y = geocell._subdiv_xy(cell[0])
+
+    bbox = geotypes.Box(bbox.south + subcell_lat_span * (y + 1),
+                        bbox.west  + subcell_lon_span * (x + 1),
+                        bbox.south + subcell_lat_span * y,
+                        bbox.west  + subcell_lon_span * x)
+
+    cell = cell[1:]
+
+  return bbox
+
+
+def _reference_adjacent(cell, dir):
+  dx, dy = dir
+  cell_adj_arr = list(cell)
+  i = len(cell_adj_arr) - 1
+
+  while i >= 0 and (dx != 0 or dy != 0):
+    x, y = geocell._subdiv_xy(cell_adj_arr[i])
+
+    if dx == -1:
+      if x == 0:
+        x = 3
+      else:
+        x -= 1
+        dx = 0
+    elif dx == 1:
+      if x == 3:
+        x = 0
+      else:
+        x += 1
+        dx = 0
+
+    if dy == 1:
+      if y == 3:
+        y = 0
+      else:
+        y += 1
+        dy = 0
+    elif dy == -1:
+      if y == 0:
+        y = 3
+      else:
+        y -= 1
+        dy = 0
+
+    cell_adj_arr[i] = geocell._subdiv_char((x, y))
+    i -= 1
+
+  if dy != 0:
+    return None
+
+  return ''.join(cell_adj_arr)
+
+
+def _reference_interpolate(cell_ne, cell_sw):
+  cell_set = [[cell_sw]]
+
+  while not geocell.collinear(cell_set[0][-1], cell_ne, True):
+    cell_set[0].append(_reference_adjacent(cell_set[0][-1], (1, 0)))
+
+  while cell_set[-1][-1] != cell_ne:
+    cell_tmp_row = [_reference_adjacent(g, (0, 1)) for g in cell_set[-1]]
+    if cell_tmp_row[0] is None:
+      break
+    cell_set.append(cell_tmp_row)
+
+  return [g for inner in cell_set for g in inner]
+
+
+def _random_points(count):
+  rand = random.Random(1234)
+  points = [geotypes.Point(rand.uniform(-90, 90), rand.uniform(-180, 180))
+            for i in range(count)]
+  return points + [geotypes.Point(90, 180), geotypes.Point(-90, -180),
+                   geotypes.Point(0, 0), geotypes.Point(45, -90)]
+
+
 class GeocellTests(unittest.TestCase):
   def test_compute(self):
     # a valid geocell
@@ -92,6 +203,69 @@ class GeocellTests(unittest.TestCase):
     self.assertEquals(9, len(geocell.interpolate(cell, sw_adjacent2)))
     self.assertEquals(9, geocell.interpolation_count(cell, sw_adjacent2))
 
+  def test_best_bbox_search_cells_cost_functions(self):
+    bbox = geotypes.Box(37.8, -122.2, 37.7, -122.5)
+
+    # Cost functions written for the original contract take no cells...
+    def two_argument_cost(num_cells, resolution):
+      return 1e10000 if num_cells > 16 else 0
+    cells = geocell.best_bbox_search_cells(bbox, two_argument_cost)
+    self.assertTrue(0 < len(cells) <= 16)
+
+    # ...while those that ask for them get the cells being costed.
+    seen = []
+    def cells_cost(num_cells, resolution, cells=None):
+      seen.append((num_cells, cells))
+      return two_argument_cost(num_cells, resolution)
+    self.assertEquals(cells, geocell.best_bbox_search_cells(bbox, cells_cost))
+    self.assertTrue(all(num_cells == len(cells) for num_cells, cells in seen))
+
+  def test_matches_reference(self):
+    directions = [geocell.NORTHWEST, geocell.NORTH, geocell.NORTHEAST,
+                  geocell.EAST, geocell.SOUTHEAST, geocell.SOUTH,
+                  geocell.SOUTHWEST, geocell.WEST, (0, 0)]
+
+    for point in _random_points(200):
+      for resolution in (0, 1, 2, 5, 13, 16):
+        cell = geocell.compute(point, resolution)
+        self.assertEquals(_reference_compute(point, resolution), cell)
+        self.assertEquals(_reference_compute_box(cell),
+                          geocell.compute_box(cell))
+        for dir in directions:
+          self.assertEquals(_reference_adjacent(cell, dir),
+                            geocell.adjacent(cell, dir))
+
+  def test_interpolation_matches_reference(self):
+    points = _random_points(20)
+    for point_ne, point_sw in zip(points, reversed(points)):
+      for resolution in (1, 2, 3):
+        cell_ne = geocell.compute(point_ne, resolution)
+        cell_sw = geocell.compute(point_sw, resolution)
+        self.assertEquals(_reference_interpolate(cell_ne, cell_sw),
+                          geocell.interpolate(cell_ne, cell_sw))
+
+  def test_compute_box_cache(self):
+    cell = geocell.compute(geotypes.Point(37, -122), 14)
+    box = geocell.compute_box(cell)
+    box.west = -123
+
+    # Changing a returned box shouldn't change the cached one.
+    self.assertNotEqual(box, geocell.compute_box(cell))
+    self.assertEquals(_reference_compute_box(cell), geocell.compute_box(cell))
+
+  def test_lru_cache(self):
+    cache = geocell._LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    self.assertEquals(1, cache.get('a'))
+
+    # 'b' is now the least recently used, so it gets evicted.
+    cache.set('c', 3)
+    self.assertEquals(2, len(cache))
+    self.assertEquals(None, cache.get('b'))
+    self.assertEquals(1, cache.get('a'))
+    self.assertEquals(3, cache.get('c'))
+
 
 if __name__ == '__main__':
   unittest.main()
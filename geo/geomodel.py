@@ -23,25 +23,63 @@ TODO(romannurik): document how bounding box and proximity queries work.
 __author__ = 'api.roman.public@gmail.com (Roman Nurik)'
 
 import copy
+import itertools
 import logging
 import math
 import sys
 
 from google.appengine.ext import db
 
+import geobatch
 import geocell
-import geomath
 import geotypes
 import util
 
 DEBUG = False
 
 
-def default_cost_function(num_cells, resolution):
+def default_cost_function(num_cells, resolution, **kwargs):
   """The default cost function, used if none is provided by the developer."""
   return 1e10000 if num_cells > pow(geocell._GEOCELL_GRID_SIZE, 2) else 0
 
 
+def _run_per_geocell(query, cells, limit, batch_size=None):
+  """Starts a copy of the given query against each of the given geocells.
+
+  db.Query.run() sends its first RPC without waiting for the results, so
+  starting every cell's query before reading any of them lets the datastore
+  work on all of the cells at once.
+
+  Args:
+    query: A db.Query on GeoModel entities.
+    cells: A list of geocell strings to search.
+    limit: The maximum number of entities to fetch from each cell.
+    batch_size: How many entities each cell's first (concurrent) RPC, and
+        any later ones, should fetch. Defaults to limit.
+
+  Returns:
+    A list of iterators over the results in each cell, parallel to cells.
+  """
+  return [copy.deepcopy(query)
+          .filter('location_geocells =', cell)
+          .run(limit=limit, batch_size=batch_size or limit)
+          for cell in cells]
+
+
+def _fetch_from_geocells(query, cells, limit):
+  """Fetches at most limit entities in all from the given geocells, like a
+  single IN query would.
+
+  Each cell's first batch is a share of the limit, fetched concurrently;
+  further batches are only fetched while fewer than limit entities have been
+  read, so about limit entities are read however many cells there are.
+  """
+  batch_size = -(-limit // max(len(cells), 1))
+  return list(itertools.islice(
+      itertools.chain(*_run_per_geocell(query, cells, limit, batch_size)),
+      limit))
+
+
 class GeoModel(db.Model):
   """A base model class for single-point geographically located entities.
 
@@ -81,11 +119,12 @@ class GeoModel(db.Model):
       bbox: A geotypes.Box indicating the bounding box to filter entities by.
       max_results: An optional int indicating the maximum number of desired
           results.
-      cost_function: An optional function that accepts two arguments:
+      cost_function: An optional function that accepts three keyword
+          arguments:
           * num_cells: the number of cells to search
           * resolution: the resolution of each cell to search
-          and returns the 'cost' of querying against this number of cells
-          at the given resolution.
+          * cells: the list of geocell strings to search
+          and returns the 'cost' of querying against these cells.
 
     Returns:
       The fetched entities.
@@ -103,24 +142,20 @@ class GeoModel(db.Model):
     if query_geocells:
       if query._Query__orderings:
         # NOTE(romannurik): since 'IN' queries seem boken in App Engine,
-        # manually search each geocell and then merge results in-place
-        cell_results = [copy.deepcopy(query)
-            .filter('location_geocells =', search_cell)
-            .fetch(max_results) for search_cell in query_geocells]
+        # manually search each geocell and then merge the results.
+        # The cells are all searched concurrently and merged lazily.
+        cell_results = _run_per_geocell(query, query_geocells, max_results)
 
-        # Manual in-memory sort on the query's defined ordering.
+        # Manual in-memory merge on the query's defined ordering.
         query_orderings = query._Query__orderings or []
-        def _ordering_fn(ent1, ent2):
-          for prop, direction in query_orderings:
-            prop_cmp = cmp(getattr(ent1, prop), getattr(ent2, prop))
-            if prop_cmp != 0:
-              return prop_cmp if direction == 1 else -prop_cmp
-
-          return -1  # Default ent1 < ent2.
-
-        # Duplicates aren't possible so don't provide a dup_fn.
-        util.merge_in_place(cmp_fn=_ordering_fn, *cell_results)
-        results = cell_results[0][:max_results]
+        def _ordering_key(entity):
+          return tuple([getattr(entity, prop) if direction == 1
+                        else util.Descending(getattr(entity, prop))
+                        for prop, direction in query_orderings])
+
+        # Duplicates aren't possible so don't provide a dup_key.
+        results = list(util.merge_sorted(cell_results, key=_ordering_key,
+                                         max_results=max_results))
       else:
         # NOTE: We can't pass in max_results because of non-uniformity of the
         # search.
@@ -134,11 +169,8 @@ class GeoModel(db.Model):
       logging.info('bbox query looked in %d geocells' % len(query_geocells))
 
     # In-memory filter.
-    return [entity for entity in results if
-        entity.location.lat >= bbox.south and
-        entity.location.lat <= bbox.north and
-        entity.location.lon >= bbox.west and
-        entity.location.lon <= bbox.east]
+    lats, lons = geobatch.coordinates(results)
+    return geobatch.compress(results, geobatch.box_mask(lats, lons, bbox))
 
   @staticmethod
   def proximity_fetch(query, center, max_results=10, max_distance=0):
@@ -189,12 +221,12 @@ class GeoModel(db.Model):
     closest_possible_next_result_dist = 0
 
     # Assumes both a and b are lists of (entity, dist) tuples, *sorted by dist*.
-    # NOTE: This is an in-place merge, and there are guaranteed
-    # no duplicates in the resulting list.
-    def _merge_results_in_place(a, b):
-      util.merge_in_place(a, b,
-                        cmp_fn=lambda x, y: cmp(x[1], y[1]),
-                        dup_fn=lambda x, y: x[0].key() == y[0].key())
+    # NOTE: There are guaranteed no duplicates in the resulting list.
+    def _merge_results(a, b):
+      return list(util.merge_sorted([a, b],
+                                    key=lambda x: x[1],
+                                    dup_key=lambda x: x[0].key(),
+                                    max_results=max_results))
 
     sorted_edges = [(0,0)]
     sorted_edge_distances = [0]
@@ -206,13 +238,11 @@ class GeoModel(db.Model):
 
       cur_geocells_unique = list(set(cur_geocells).difference(searched_cells))
 
-      # Run query on the next set of geocells.
+      # Run query on the next set of geocells, searching them concurrently.
       cur_resolution = len(cur_geocells[0])
-      temp_query = copy.deepcopy(query)  # TODO(romannurik): is this safe?
-      temp_query.filter('location_geocells IN', cur_geocells_unique)
+      new_results = _fetch_from_geocells(query, cur_geocells_unique, 1000)
 
       # Update results and sort.
-      new_results = temp_query.fetch(1000)
       if DEBUG:
         logging.info('fetch complete for %s' % (','.join(cur_geocells_unique),))
 
@@ -220,20 +250,12 @@ class GeoModel(db.Model):
 
       # Begin storing distance from the search result entity to the
       # search center along with the search result itself, in a tuple.
-      new_results = [(entity, geomath.distance(center, entity.location))
-                     for entity in new_results]
-      new_results = sorted(new_results, lambda dr1, dr2: cmp(dr1[1], dr2[1]))
-      new_results = new_results[:max_results]
-
-      # Merge new_results into results or the other way around, depending on
-      # which is larger.
-      if len(results) > len(new_results):
-        _merge_results_in_place(results, new_results)
-      else:
-        _merge_results_in_place(new_results, results)
-        results = new_results
+      lats, lons = geobatch.coordinates(new_results)
+      new_results = zip(new_results,
+                        geobatch.distances(center, lats, lons))
+      new_results.sort(key=lambda dr: dr[1])
 
-      results = results[:max_results]
+      results = _merge_results(results, new_results)
 
       sorted_edges, sorted_edge_distances = \
           util.distance_sorted_edges(cur_geocells, center)
@@ -281,8 +303,7 @@ class GeoModel(db.Model):
 
       # If the currently max_results'th closest item is closer than any
       # of the next test geocells, we're done searching.
-      current_farthest_returnable_result_dist = \
-          geomath.distance(center, results[max_results - 1][0].location)
+      current_farthest_returnable_result_dist = results[max_results - 1][1]
       if (closest_possible_next_result_dist >=
           current_farthest_returnable_result_dist):
         if DEBUG:
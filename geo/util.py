@@ -18,16 +18,88 @@
 
 __author__ = 'api.roman.public@gmail.com (Roman Nurik)'
 
+import functools
+import heapq
+
 import geocell
 import geomath
 import geotypes
 
 
+class Descending(object):
+  """Wraps a value so that it sorts in the reverse of its natural order.
+
+  Useful for building sort keys over several properties, only some of which
+  should be descending.
+  """
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __cmp__(self, other):
+    return cmp(other.value, self.value)
+
+  def __repr__(self):
+    return 'Descending(%r)' % (self.value,)
+
+
+def merge_sorted(iterables, key=None, dup_key=None, max_results=None):
+  """Lazily merges an arbitrary number of pre-sorted iterables.
+
+  Keeps a heap of the current head of each iterable, so producing each merged
+  item costs O(log k) comparisons for k iterables, and no more of any iterable
+  is consumed than is needed to produce the requested results. Ties are
+  broken in favor of the iterable that was given first.
+
+  Args:
+    iterables: A sequence of iterables, each sorted by key.
+    key: An optional function that returns the sort key of an item. Defaults
+        to the item itself.
+    dup_key: An optional function that returns an identity for an item. Items
+        whose identity has already been produced are skipped.
+    max_results: An optional maximum number of items to produce.
+
+  Returns:
+    A generator over the merged items, in sorted order.
+  """
+  heap = []
+  for index, iterable in enumerate(iterables):
+    iterator = iter(iterable)
+    for item in iterator:
+      heap.append((key(item) if key else item, index, item, iterator))
+      break
+  heapq.heapify(heap)
+
+  seen = set()
+  produced = 0
+  while heap and (max_results is None or produced < max_results):
+    unused_item_key, index, item, iterator = heap[0]
+    for next_item in iterator:
+      heapq.heapreplace(heap, (key(next_item) if key else next_item, index,
+                               next_item, iterator))
+      break
+    else:
+      heapq.heappop(heap)
+
+    if dup_key:
+      identity = dup_key(item)
+      if identity in seen:
+        continue
+      seen.add(identity)
+
+    yield item
+    produced += 1
+
+
 def merge_in_place(*lists, **kwargs):
   """Merges an arbitrary number of pre-sorted lists in-place, into the first
   list, possibly pruning out duplicates. Source lists must not have
   duplicates.
 
+  This is a wrapper around merge_sorted() for callers using comparison
+  functions; new code should use merge_sorted() with key functions directly.
+
   Args:
     list1: The first, sorted list into which the other lists should be merged.
     list2: A subsequent, sorted list to merge into the first.
@@ -37,7 +109,8 @@ def merge_in_place(*lists, **kwargs):
         lists and determines the merged list's sort order.
     dup_fn: An optional binary comparison function that should return True if
         the given objects are equivalent and one of them can be pruned from the
-        resulting merged list.
+        resulting merged list. Only objects that compare equal under cmp_fn
+        are tested against each other.
 
   Returns:
     list1, in-placed merged wit the other lists, or an empty list if no lists
@@ -49,36 +122,18 @@ def merge_in_place(*lists, **kwargs):
   if not lists:
     return []
 
-  reverse_indices = [len(arr) for arr in lists]
-  aggregate_reverse_index = sum(reverse_indices)
-
-  while aggregate_reverse_index > 0:
-    pull_arr_index = None
-    pull_val = None
-
-    for i in range(len(lists)):
-      if reverse_indices[i] == 0:
-        # Reached the end of this list.
-        pass
-      elif (pull_arr_index is not None and
-            dup_fn and dup_fn(lists[i][-reverse_indices[i]], pull_val)):
-        # Found a duplicate, advance the index of the list in which the
-        # duplicate was found.
-        reverse_indices[i] -= 1
-        aggregate_reverse_index -= 1
-      elif (pull_arr_index is None or
-            cmp_fn(lists[i][-reverse_indices[i]], pull_val) < 0):
-        # Found a lower value.
-        pull_arr_index = i
-        pull_val = lists[i][-reverse_indices[i]]
-
-    if pull_arr_index != 0:
-      # Add the lowest found value in place into the first array.
-      lists[0].insert(len(lists[0]) - reverse_indices[0], pull_val)
-
-    aggregate_reverse_index -= 1
-    reverse_indices[pull_arr_index] -= 1
-
+  merged = []
+  equal_run = []
+  for item in merge_sorted(lists, key=functools.cmp_to_key(cmp_fn)):
+    if dup_fn:
+      if equal_run and cmp_fn(equal_run[0], item) != 0:
+        equal_run = []
+      if [other for other in equal_run if dup_fn(item, other)]:
+        continue
+      equal_run.append(item)
+    merged.append(item)
+
+  lists[0][:] = merged
   return lists[0]
 
 
@@ -42,6 +42,66 @@ class MergeInPlaceTests(unittest.TestCase):
         [-1, 0, 1, 2, 3, 4, 5, 6, 8, 9, 10, 11, 15, 16, 17, 19, 20],
         list1)
 
+  def test_merge_in_place_cmp_fn(self):
+    list1 = [(5, 'a'), (3, 'b'), (1, 'c')]
+    list2 = [(4, 'd'), (3, 'b'), (2, 'e')]
+
+    util.merge_in_place(list1, list2,
+        cmp_fn=lambda x, y: -cmp(x[0], y[0]),
+        dup_fn=lambda x, y: x[1] == y[1])
+
+    self.assertEquals(
+        [(5, 'a'), (4, 'd'), (3, 'b'), (2, 'e'), (1, 'c')],
+        list1)
+
+
+class MergeSortedTests(unittest.TestCase):
+  def test_merge_sorted(self):
+    self.assertEquals([], list(util.merge_sorted([])))
+    self.assertEquals([], list(util.merge_sorted([[], []])))
+
+    self.assertEquals(
+        [-1, 0, 0, 1, 2, 5, 5, 8],
+        list(util.merge_sorted([[0, 1, 5], [0, 2, 5, 8], [-1]])))
+
+  def test_merge_sorted_key(self):
+    list1 = [('a', 3), ('b', 1)]
+    list2 = [('c', 2), ('d', 0)]
+    self.assertEquals(
+        ['a', 'c', 'b', 'd'],
+        [x[0] for x in util.merge_sorted([list1, list2],
+                                         key=lambda x: util.Descending(x[1]))])
+
+    # Mixed ascending and descending sort keys.
+    list1 = [(1, 'b'), (2, 'b')]
+    list2 = [(1, 'c'), (1, 'a'), (2, 'a')]
+    self.assertEquals(
+        [(1, 'c'), (1, 'b'), (1, 'a'), (2, 'b'), (2, 'a')],
+        list(util.merge_sorted([list1, list2],
+                               key=lambda x: (x[0], util.Descending(x[1])))))
+
+  def test_merge_sorted_dup_key(self):
+    list1 = [(0, 'a'), (1, 'b'), (2, 'c')]
+    list2 = [(1, 'b'), (2, 'd')]
+    self.assertEquals(
+        [(0, 'a'), (1, 'b'), (2, 'c'), (2, 'd')],
+        list(util.merge_sorted([list1, list2],
+                               key=lambda x: x[0], dup_key=lambda x: x[1])))
+
+  def test_merge_sorted_max_results(self):
+    def _iterate(items, consumed):
+      for item in items:
+        consumed.append(item)
+        yield item
+
+    consumed = []
+    self.assertEquals(
+        [0, 1, 1],
+        list(util.merge_sorted([_iterate([0, 1, 4, 5, 6], consumed), [1, 2]],
+                               max_results=3)))
+    # Shouldn't have pulled more than one item past the last result.
+    self.assertEquals([0, 1, 4], consumed)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -57,6 +57,12 @@ MEMCACHE_PAGE_SECONDS = MEMCACHE_DEFAULT_SECONDS
 MEMCACHE_API_SECONDS = 24 * 60 * 60
 MEMCACHE_SCREENSHOT_SECONDS = MEMCACHE_DEFAULT_SECONDS
 MEMCACHE_SCREENSHOT_MAX_SIZE = 65536 # empirically, 64kb is a good max size for caching screen shots. This covers all the gallery page and home page screen shots.
+MEMCACHE_STALE_SECONDS = 10 * 60 # how long cached views may keep serving a stale response while one request renders a new one
+MEMCACHE_REFRESH_LOCK_SECONDS = 30 # how long that one request has before another may try
+MEMCACHE_CHUNK_BYTES = 1000 * 1000 - 4096 # values bigger than memcache's 1MB item limit (less some room for the key) are split into pieces of this size
+CACHED_RESPONSE_COMPRESS_BYTES = 16 * 1024 # cached response bodies bigger than this are compressed
+LOCAL_VIEW_CACHE_SECONDS = 60 # how long an instance may serve a cached view response from its own memory, without asking memcache
+LOCAL_VIEW_CACHE_MAX_ENTRIES = 100
 
 DEFAULT_TRANSIT_APP_IMAGE_URL = "/images/default-transit-app.png"
 DEFAULT_TRANSIT_APP_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), 'citygoround/images/'))
@@ -81,8 +87,24 @@ TRANSIT_APP_IMAGE_HEIGHT = 180
 #override in local_settings.py, not here
 GOOGLE_API_KEY='ABQIAAAAOtgwyX124IX2Zpe7gGhBsxScRvQHjv9UbfX2QLoR8lJzqlEEMhQOYVWJMRvlY9Hz-bSACEukjIPCWA'
 
+COUNTER_SHARD_COUNT = 20 # how many entities each sharded counter is spread over; raise it for busier counters, but never lower it (see models/sharded_counter.py)
+COUNTER_CACHE_SECONDS = 5 # how long a sharded counter's total may lag its increments
+RATING_VOTE_BATCH_SIZE = 500 # how many queued rating votes to lease and apply at once (see utils/ratings.py)
+RATING_VOTE_LEASE_SECONDS = 60 # how long a batch of rating votes may take before another worker may lease it again
+RATING_VOTE_APPLIED_NAMES_KEPT = 2000 # how many applied votes each app remembers, so that a vote leased again after a failure isn't counted twice; must exceed the votes one app gets in a few minutes
+BAYESIAN_AVERAGE_EPSILON = 0.001 # how far an app's bayesian average must move before a refresh saves it
+BAYESIAN_REFRESH_BATCH_SIZE = 200
+BAYESIAN_REFRESH_SECONDS = 60 # how long a bayesian average refresh runs before queueing a task to carry on
+GENERATION_CHECK_SECONDS = 5 # how long an instance may go on using cached data after an edit elsewhere (see utils/generation.py)
+
 BBOX_SIDE_IN_MILES = 50.0 #like a search radius of 25 miles
 NEARBY_AGENCIES_BBOX_SIDE_IN_MILES = 50.0 #like a search radius of 25 miles
+APPS_SEARCH_GEOCELL_RESOLUTION = 5 # /api/apps/search/ answers searches from inside the same geocell (roughly 20km by 30km at this resolution) alike
+API_DEFAULT_PAGE_SIZE = 100 # how many results a page of API results has, when the client doesn't say
+API_MAX_PAGE_SIZE = 1000
+GEOCELL_HISTOGRAM_CHECK_SECONDS = 60 * 60 # how stale an instance's copy of a geocell histogram may get after a rebuild
+GEOCELL_HISTOGRAM_BATCH_SIZE = 500 # how many entities each geocell histogram rebuild task counts
+MIGRATION_BATCH_SIZE = 200 # how many entities each data migration task (see models/migration.py) updates
 
 if DEBUG:
     PROGRESS_DEBUG_MAGIC = "DEBUG"
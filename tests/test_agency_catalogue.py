@@ -0,0 +1,82 @@
+import unittest
+from datetime import datetime
+from google.appengine.ext import db
+from citygoround.models import Agency
+
+class TestAgencyCatalogue(unittest.TestCase):
+    def setUp(self):
+        self.muni = Agency(name="Muni", city="San Francisco", state="CA", country="US", location = db.GeoPt(37.7749295, -122.4194155), date_opened = datetime.fromtimestamp(0))
+        self.muni.put()
+        self.bart = Agency(name="BART", city="Oakland", state="CA", country="US", location = db.GeoPt(37.8043637, -122.2711137))
+        self.bart.put()
+        self.king_county = Agency(name="King County Metro", city="Seattle", state="WA", country="US", location = db.GeoPt(47.6062095, -122.3320708))
+        self.king_county.put()
+
+    def tearDown(self):
+        self.muni.delete()
+        self.bart.delete()
+        self.king_county.delete()
+
+    def test_fetch_for_slugs(self):
+        self.assertEqual(sorted([agency.name for agency in Agency.fetch_for_slugs(stateslug = "ca")]), ["BART", "Muni"])
+        self.assertEqual([agency.name for agency in Agency.fetch_for_slugs("us", "ca", "san-francisco")], ["Muni"])
+        self.assertEqual(Agency.fetch_for_slugs("us", "ny"), [])
+
+    def test_state_and_country_lists(self):
+        self.assertEqual(Agency.get_state_list(), [("us", "ca"), ("us", "wa")])
+        self.assertEqual(Agency.get_country_list(), ["us"])
+
+    def test_fetch_agencies_near(self):
+        agencies = Agency.fetch_agencies_near(37.7749295, -122.4194155, bbox_side_in_miles = 50.0)
+        self.assertEqual(sorted([agency.name for agency in agencies]), ["BART", "Muni"])
+        self.assertEqual(sorted([agency.key() for agency in agencies]), sorted([self.muni.key(), self.bart.key()]))
+
+    def test_catalogue_follows_edits(self):
+        self.bart.state = "NV"
+        self.bart.update_slugs()
+        self.bart.put()
+        self.assertEqual([agency.name for agency in Agency.fetch_for_slugs(stateslug = "ca")], ["Muni"])
+        self.assertEqual([agency.name for agency in Agency.fetch_for_slugs(stateslug = "nv")], ["BART"])
+
+    def test_json_fragments(self):
+        from django.utils import simplejson as json
+        self.assertEqual(json.loads(self.muni.to_json()), json.loads(json.dumps(self.muni.to_jsonable())))
+        fragments = Agency.fetch_all_agencies_as_json_fragments()
+        self.assertEqual(sorted([json.loads(fragment)["name"] for fragment in fragments]), ["BART", "King County Metro", "Muni"])
+
+    def test_edited_agency_json_is_current(self):
+        from django.utils import simplejson as json
+        Agency.catalogue()
+        self.muni.name = "SFMTA"
+        self.assertEqual(json.loads(self.muni.to_json())["name"], "SFMTA")
+
+    def test_json_field_projection(self):
+        from django.utils import simplejson as json
+        fields = ("has_real_time_data", "key_encoded", "latitude", "longitude", "name")
+        self.assertEqual(sorted(self.muni.to_jsonable(fields).keys()), list(fields))
+        jsonable = json.loads(self.muni.to_json(fields))
+        self.assertEqual(sorted(jsonable.keys()), list(fields))
+        self.assertEqual(jsonable["name"], "Muni")
+        self.assertEqual(len(json.loads(self.muni.to_json()).keys()), len(Agency.JSONABLE_FIELDS))
+
+    def test_record_keeps_only_full_json(self):
+        from django.utils import simplejson as json
+        record = Agency.catalogue().for_urlslug(self.muni.urlslug)
+        self.assertEqual(json.loads(record.to_json(("name",))), {"name": "Muni"})
+        self.assertEqual(record._json, None)
+        self.assertTrue(record.to_json() is record.to_json())
+
+    def test_columns(self):
+        import gzip
+        from StringIO import StringIO
+        from django.utils import simplejson as json
+        catalogue = Agency.catalogue()
+        columns = catalogue.to_columns(("name", "state"))
+        self.assertEqual(columns["count"], 3)
+        self.assertEqual(columns["tables"], {"state": ["CA", "WA"]})
+        states = [columns["tables"]["state"][i] for i in columns["columns"]["state"]]
+        self.assertEqual(sorted(zip(columns["columns"]["name"], states)), [("BART", "CA"), ("King County Metro", "WA"), ("Muni", "CA")])
+        self.assertEqual(json.loads(catalogue.to_columns_json(("name", "state"))), json.loads(json.dumps(columns)))
+        self.assertEqual(gzip.GzipFile(fileobj = StringIO(catalogue.to_columns_gzip())).read(), catalogue.to_columns_json())
+        # Those of every field are built with the catalogue, rather than on first use.
+        self.assertTrue(catalogue.to_columns_gzip() is catalogue.to_columns_gzip())
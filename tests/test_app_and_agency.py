@@ -2,7 +2,10 @@ import unittest
 import logging
 from copy import copy
 from google.appengine.ext import db
-from citygoround.models import Agency, TransitApp
+from google.appengine.api import memcache
+from django.conf import settings
+from geo import geocell, geotypes
+from citygoround.models import Agency, TransitApp, TransitAppLocation, Migration
 from citygoround.utils.slug import slugify
 from citygoround.utils.places import CityInfo, CitiesAndCountries, CountryInfo
 from datetime import datetime
@@ -209,6 +212,16 @@ class TestAppAndAgency(unittest.TestCase):
         app_titles = [app.title for app in apps]
         self.assertListsContainSameItems(app_titles, ["app_pub", "app_p2_p3", "app_pub_p1_p3", "app_pub_pub2_pub3_p1_p2"])
 
+    def test_find_list_of_apps_given_agency_keys(self):
+        apps = TransitApp.fetch_for_agencies([self.private_agency_2.key(), self.public_agency_1.key(), self.private_agency_2.key()])
+        app_titles = [app.title for app in apps]
+        self.assertListsContainSameItems(app_titles, ["app_pub", "app_p2_p3", "app_pub_p1_p3", "app_pub_pub2_pub3_p1_p2"])
+
+    def test_find_list_of_apps_given_private_agencies_only(self):
+        apps = TransitApp.fetch_for_agencies([self.private_agency_1, self.private_agency_2])
+        app_titles = [app.title for app in apps]
+        self.assertListsContainSameItems(app_titles, ["app_p1", "app_p2_p3", "app_pub_p1_p3", "app_pub_pub2_pub3_p1_p2"])
+
     def test_find_list_of_apps_given_agencies_with_uniquify_off(self):
         apps = TransitApp.fetch_for_agencies([self.public_agency_1, self.private_agency_3], uniquify = False)
         app_titles = [app.title for app in apps]
@@ -243,3 +256,92 @@ class TestAppAndAgency(unittest.TestCase):
         apps = TransitApp.fetch_for_location_and_country_code(self.grants_pass.latitude, self.grants_pass.longitude, self.grants_pass.country_code, bbox_side_in_miles = 1000.0)
         app_titles = [app.title for app in apps]
         self.assertListsContainSameItems(app_titles, ["app_pub", "app_pub_p1_p3", "app_pub_pub2_pub3_p1_p2", "app_for_portland", "app_for_us", "app_for_entire_world"])
+
+    def test_search_leaves_out_hidden_apps(self):
+        self.app_for_philadelphia.is_hidden = True
+        self.app_for_philadelphia.put()
+        self.assertEqual([location.is_hidden for location in self.app_for_philadelphia.explicitly_supported_locations], [True])
+        apps = TransitApp.fetch_transit_apps_near(self.philadelphia.latitude, self.philadelphia.longitude, bbox_side_in_miles = 1.0)
+        self.assertListsContainSameItems([app.title for app in apps], [])
+        apps = TransitApp.fetch_transit_apps_near(self.philadelphia.latitude, self.philadelphia.longitude, bbox_side_in_miles = 1.0, visible_only = False)
+        self.assertListsContainSameItems([app.title for app in apps], ["app_for_philadelphia"])
+
+        self.app_for_philadelphia.is_hidden = False
+        self.app_for_philadelphia.put()
+        self.assertEqual([location.is_hidden for location in self.app_for_philadelphia.explicitly_supported_locations], [False])
+
+    def test_location_is_hidden_backfill(self):
+        location = self.app_for_philadelphia.explicitly_supported_locations.get()
+        location.is_hidden = True
+        db.put(location)
+        self.assertEqual(TransitAppLocation.backfill_is_hidden_batch(), None)
+        self.assertEqual(TransitAppLocation.get(location.key()).is_hidden, False)
+        self.assertTrue(Migration.is_done(TransitAppLocation.IS_HIDDEN_MIGRATION))
+        apps = TransitApp.fetch_transit_apps_near(self.philadelphia.latitude, self.philadelphia.longitude, bbox_side_in_miles = 1.0)
+        self.assertListsContainSameItems([app.title for app in apps], ["app_for_philadelphia"])
+
+    def test_search_by_geocell(self):
+        memcache.flush_all()
+        cell = geocell.compute(geotypes.Point(self.philadelphia.latitude, self.philadelphia.longitude), settings.APPS_SEARCH_GEOCELL_RESOLUTION)
+        box = geocell.compute_box(cell)
+        expected_apps = TransitApp.fetch_for_location_and_country_code((box.north + box.south) / 2.0, (box.east + box.west) / 2.0, self.philadelphia.country_code)
+        apps = TransitApp.fetch_for_geocell_and_country_code(self.philadelphia.latitude, self.philadelphia.longitude, self.philadelphia.country_code)
+        self.assertListsContainSameItems([app.title for app in apps], [app.title for app in expected_apps])
+        self.assertEqual(TransitApp.keys_for_geocell_and_country_code(cell, self.philadelphia.country_code), [app.key() for app in apps])
+        
+        # Cached answers leave out apps hidden since.
+        self.app_for_philadelphia.is_hidden = True
+        self.app_for_philadelphia.put()
+        apps = TransitApp.fetch_for_geocell_and_country_code(self.philadelphia.latitude, self.philadelphia.longitude, self.philadelphia.country_code)
+        self.assertTrue("app_for_philadelphia" not in [app.title for app in apps])
+
+
+    #--------------------------------------------------------------------------------
+    # Agency support index
+    #--------------------------------------------------------------------------------
+
+    def test_agency_app_counts(self):
+        counts = TransitApp.agency_app_counts()
+        self.assertEqual(counts[str(self.public_agency_1.key())], 3)
+        self.assertEqual(counts[str(self.public_agency_2.key())], 3)
+        self.assertEqual(counts[str(self.private_agency_1.key())], 3)
+        self.assertEqual(counts[str(self.private_agency_2.key())], 2)
+        self.assertEqual(counts[str(self.private_agency_3.key())], 2)
+
+    def test_agency_support_index_follows_explicit_agency_changes(self):
+        self.app_p1.remove_explicitly_supported_agency(self.private_agency_1)
+        self.app_p1.add_explicitly_supported_agency(self.private_agency_2)
+        self.app_p1.put()
+        apps = TransitApp.fetch_for_agency(self.private_agency_1)
+        self.assertListsContainSameItems([app.title for app in apps], ["app_pub_p1_p3", "app_pub_pub2_pub3_p1_p2"])
+        apps = TransitApp.fetch_for_agency(self.private_agency_2)
+        self.assertListsContainSameItems([app.title for app in apps], ["app_p1", "app_p2_p3", "app_pub_pub2_pub3_p1_p2"])
+
+    def test_agency_support_index_follows_visibility(self):
+        self.app_pub.is_hidden = True
+        self.app_pub.put()
+        apps = TransitApp.fetch_for_agency(self.public_agency_1)
+        self.assertListsContainSameItems([app.title for app in apps], ["app_pub_p1_p3", "app_pub_pub2_pub3_p1_p2"])
+        apps = TransitApp.fetch_for_agency(self.public_agency_1, visible_only = False)
+        self.assertListsContainSameItems([app.title for app in apps], ["app_pub", "app_pub_p1_p3", "app_pub_pub2_pub3_p1_p2"])
+
+    def test_agencies_lookup_reads_the_support_index(self):
+        self.app_p1.remove_explicitly_supported_agency(self.private_agency_1)
+        self.app_p1.put()
+        apps = TransitApp.fetch_for_agencies([self.private_agency_1, self.private_agency_3])
+        self.assertListsContainSameItems([app.title for app in apps], ["app_p2_p3", "app_pub_p1_p3", "app_pub_pub2_pub3_p1_p2"])
+
+    def test_json_fragments_follow_edits(self):
+        from django.utils import simplejson as json
+        fragments = TransitApp.json_fragments([self.app_pub, self.app_p1])
+        self.assertEqual([json.loads(fragment)["title"] for fragment in fragments], ["app_pub", "app_p1"])
+        self.app_pub.title = "app_pub_renamed"
+        self.app_pub.put()
+        self.assertEqual(json.loads(TransitApp.json_fragments([self.app_pub])[0])["title"], "app_pub_renamed")
+        self.assertTrue("is_hidden" in json.loads(TransitApp.json_fragments([self.app_pub], include_visibility = True)[0]))
+
+    def test_json_fragment_projection(self):
+        from django.utils import simplejson as json
+        self.assertEqual(json.loads(TransitApp.json_fragments([self.app_pub], ("slug", "title"))[0]), {"slug": "app_pub", "title": "app_pub"})
+        self.assertEqual(json.loads(TransitApp.json_fragments([self.app_pub], ("is_hidden",))[0]), {})
+        self.assertEqual(json.loads(TransitApp.json_fragments([self.app_pub], ("is_hidden",), include_visibility = True)[0]), {"is_hidden": False})
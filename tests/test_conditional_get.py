@@ -0,0 +1,85 @@
+import time
+import unittest
+from google.appengine.ext import db
+from django.http import HttpRequest, HttpResponse
+from django.utils.http import http_date
+from google.appengine.api import memcache
+from citygoround.decorators import conditional_view_response
+from citygoround.models import Agency
+from citygoround.utils.generation import bump_generation, _modified_memcache_key
+
+class ConditionalGetTestCase(unittest.TestCase):
+    def setUp(self):
+        memcache.flush_all()
+        self.calls = 0
+        def view(request):
+            self.calls += 1
+            return HttpResponse("hello")
+        self.view = conditional_view_response(time = 60, kinds = ("Agency",))(view)
+
+    def make_request(self, **meta):
+        request = HttpRequest()
+        request.method = "GET"
+        request.path = "/api/hello/"
+        request.META.update(meta)
+        return request
+        
+    def backdate_agencies(self, modified):
+        memcache.set(_modified_memcache_key("Agency"), modified)
+
+class TestConditionalGet(ConditionalGetTestCase):
+    def test_etag_match_skips_view(self):
+        response = self.view(self.make_request())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], "max-age=60")
+        response = self.view(self.make_request(HTTP_IF_NONE_MATCH = response["ETag"]))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.calls, 1)
+
+    def test_generation_bump_changes_etag(self):
+        etag = self.view(self.make_request())["ETag"]
+        bump_generation("Agency")
+        response = self.view(self.make_request(HTTP_IF_NONE_MATCH = etag))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_if_modified_since(self):
+        self.backdate_agencies(1262303999.5)
+        self.assertEqual(self.view(self.make_request()).get("Last-Modified"), http_date(1262304000))
+        self.assertEqual(self.view(self.make_request(HTTP_IF_MODIFIED_SINCE = http_date(1262304000))).status_code, 304)
+        self.assertEqual(self.view(self.make_request(HTTP_IF_MODIFIED_SINCE = http_date(1262303999))).status_code, 200)
+
+    def test_other_kinds_leave_last_modified_alone(self):
+        self.backdate_agencies(1262303999.5)
+        bump_generation("TransitApp")
+        self.assertEqual(self.view(self.make_request(HTTP_IF_MODIFIED_SINCE = http_date(1262304000))).status_code, 304)
+
+    def test_no_last_modified_within_the_second_of_a_change(self):
+        bump_generation("Agency")
+        response = self.view(self.make_request(HTTP_IF_MODIFIED_SINCE = http_date(time.time())))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("Last-Modified"))
+
+class TestConditionalGetAfterEdits(ConditionalGetTestCase):
+    def setUp(self):
+        ConditionalGetTestCase.setUp(self)
+        self.agency = Agency(name="Muni", city="San Francisco", state="CA", country="US", location = db.GeoPt(37.7749295, -122.4194155))
+        self.agency.put()
+        self.backdate_agencies(time.time() - 60)
+        self.last_modified = self.view(self.make_request())["Last-Modified"]
+        self.assertEqual(self.view(self.make_request(HTTP_IF_MODIFIED_SINCE = self.last_modified)).status_code, 304)
+
+    def tearDown(self):
+        for agency in Agency.all():
+            agency.delete()
+
+    def test_deletion_is_modified(self):
+        self.agency.delete()
+        self.assertEqual(self.view(self.make_request(HTTP_IF_MODIFIED_SINCE = self.last_modified)).status_code, 200)
+
+    def test_edit_leaving_updated_alone_is_modified(self):
+        updated = self.agency.updated
+        self.agency.name = "San Francisco Muni"
+        self.agency.put()
+        self.assertEqual(self.agency.updated, updated)
+        self.assertEqual(self.view(self.make_request(HTTP_IF_MODIFIED_SINCE = self.last_modified)).status_code, 200)
@@ -0,0 +1,43 @@
+import unittest
+from datetime import datetime
+from citygoround.models import Agency, TransitApp, EntityCount
+
+class TestEntityCount(unittest.TestCase):
+    def setUp(self):
+        EntityCount.reconcile({})
+        self.agency = Agency(name = "Muni", city = "San Francisco", state = "CA")
+        self.agency.put()
+        self.transit_app = TransitApp(title = "Biking App", categories = ["Biking"])
+        self.transit_app.put()
+
+    def tearDown(self):
+        self.agency.delete()
+        self.transit_app.delete()
+
+    def counts(self):
+        return EntityCount.get_values([EntityCount.AGENCIES, EntityCount.PUBLIC_AGENCIES, EntityCount.VISIBLE_TRANSIT_APPS, EntityCount.name_for_category("Biking")])
+
+    def test_put_and_delete_adjust_counts(self):
+        self.assertEqual(self.counts(), {EntityCount.AGENCIES: 1, EntityCount.PUBLIC_AGENCIES: 0, EntityCount.VISIBLE_TRANSIT_APPS: 1, EntityCount.name_for_category("Biking"): 1})
+        self.agency.date_opened = datetime.now()
+        self.agency.put()
+        self.transit_app.is_hidden = True
+        self.transit_app.put()
+        self.assertEqual(self.counts(), {EntityCount.AGENCIES: 1, EntityCount.PUBLIC_AGENCIES: 1, EntityCount.VISIBLE_TRANSIT_APPS: 0, EntityCount.name_for_category("Biking"): 0})
+        self.agency.delete()
+        self.assertEqual(EntityCount.get_value(EntityCount.AGENCIES), 0)
+        self.assertEqual(EntityCount.get_value(EntityCount.PUBLIC_AGENCIES), 0)
+
+    def test_count_apps_in_category(self):
+        self.assertEqual(TransitApp.count_apps_in_category("Biking"), 1)
+        self.transit_app.categories = ["Walking"]
+        self.transit_app.put()
+        self.assertEqual(TransitApp.count_apps_in_category("Biking"), 0)
+        self.assertEqual(TransitApp.count_apps_in_category("Walking"), 1)
+
+    def test_reconcile(self):
+        EntityCount.adjust({EntityCount.AGENCIES: 5})
+        counts = Agency.recount()
+        counts.update(TransitApp.recount())
+        EntityCount.reconcile(counts)
+        self.assertEqual(self.counts(), {EntityCount.AGENCIES: 1, EntityCount.PUBLIC_AGENCIES: 0, EntityCount.VISIBLE_TRANSIT_APPS: 1, EntityCount.name_for_category("Biking"): 1})
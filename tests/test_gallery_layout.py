@@ -0,0 +1,36 @@
+import unittest
+from google.appengine.api import memcache
+from citygoround.models import TransitApp, GalleryLayout
+
+class TestGalleryLayout(unittest.TestCase):
+    def setUp(self):
+        memcache.flush_all()
+        self.transit_apps = []
+        for i in range(6):
+            transit_app = TransitApp(title = "App %d" % i, categories = ["Biking", "Walking"] if i % 2 else ["Driving"], bayesian_average = float(i), is_featured = (i == 0))
+            transit_app.put()
+            self.transit_apps.append(transit_app)
+
+    def tearDown(self):
+        for transit_app in self.transit_apps:
+            transit_app.delete()
+
+    def test_build(self):
+        layout = GalleryLayout.build()
+        self.assert_(layout.is_current)
+        recent, featured, categorized = layout.fetch_transit_apps()
+        self.assertEqual([transit_app.title for transit_app in recent], ["App 5", "App 4", "App 3"])
+        self.assertEqual([transit_app.title for transit_app in featured], ["App 0"])
+        self.assertEqual([transit_app.title for transit_app in categorized["Biking"]], ["App 1"])
+        self.assertEqual([transit_app.title for transit_app in categorized["Walking"]], ["App 1"])
+        self.assertEqual([transit_app.title for transit_app in categorized["Driving"]], ["App 2"])
+        self.assertEqual(categorized["Public Transit"], [])
+
+    def test_app_changes_make_layout_stale(self):
+        layout = GalleryLayout.build()
+        self.transit_apps[2].is_hidden = True
+        self.transit_apps[2].put()
+        layout = GalleryLayout.get_layout()
+        self.failIf(layout.is_current)
+        recent, featured, categorized = layout.fetch_transit_apps()
+        self.assertEqual(categorized["Driving"], [])
@@ -0,0 +1,30 @@
+import unittest
+from google.appengine.api import memcache
+from citygoround.models import FeedReference
+from citygoround.utils.generation import current_generation, bump_generation, generations_key
+
+class TestGeneration(unittest.TestCase):
+    def setUp(self):
+        memcache.flush_all()
+
+    def test_bump_changes_only_its_kind(self):
+        agency_generation = current_generation("Agency")
+        transit_app_generation = current_generation("TransitApp")
+        bump_generation("Agency")
+        self.assertNotEqual(current_generation("Agency"), agency_generation)
+        self.assertEqual(current_generation("TransitApp"), transit_app_generation)
+
+    def test_generations_key_follows_bumps(self):
+        key = generations_key()
+        self.assertEqual(generations_key(), key)
+        bump_generation("TransitApp")
+        self.assertNotEqual(generations_key(), key)
+
+    def test_put_and_delete_bump(self):
+        generation = current_generation("FeedReference")
+        feed_reference = FeedReference(name = "Muni")
+        feed_reference.put()
+        put_generation = current_generation("FeedReference")
+        self.assertNotEqual(put_generation, generation)
+        feed_reference.delete()
+        self.assertNotEqual(current_generation("FeedReference"), put_generation)
@@ -0,0 +1,73 @@
+import unittest
+from google.appengine.ext import db
+from geo import geocell
+from geo.geomodel import default_cost_function
+from citygoround.models import Agency, GeocellHistogram, GeocellHistogramShard
+from citygoround.models import geocell_histogram
+
+class TestGeocellHistogram(unittest.TestCase):
+    def setUp(self):
+        self.agencies = []
+        for name, city, location in [("Muni", "San Francisco", db.GeoPt(37.7749295, -122.4194155)),
+                                     ("SamTrans", "San Carlos", db.GeoPt(37.5071591, -122.2605222)),
+                                     ("BART", "Oakland", db.GeoPt(37.8043637, -122.2711137))]:
+            agency = Agency(name = name, city = city, state = "CA", country = "US", location = location)
+            agency.update_location()
+            agency.put()
+            self.agencies.append(agency)
+
+    def tearDown(self):
+        for agency in self.agencies:
+            agency.delete()
+        db.delete(GeocellHistogramShard.all(keys_only = True).fetch(1000))
+        for histogram in GeocellHistogram.all():
+            histogram.delete()
+        geocell_histogram._loaded_histograms.clear()
+
+    def test_no_histogram(self):
+        self.assertEqual(GeocellHistogram.cost_function_for(Agency), default_cost_function)
+
+    def test_rebuild(self):
+        histogram = GeocellHistogram.rebuild(Agency)
+        self.assertEqual(histogram.entity_count, 3)
+
+        muni_cell = self.agencies[0].location_geocells[GeocellHistogram.MAX_RESOLUTION - 1]
+        self.assertEqual(histogram.expected_count(muni_cell[:2]), 3)
+        self.assertEqual(histogram.expected_count(muni_cell), 1)
+        self.assertEqual(histogram.expected_count(muni_cell + "0"), 1.0 / 16)
+
+        reloaded = GeocellHistogram.get_by_key_name(Agency.kind())
+        self.assertEqual(reloaded.counts, histogram.counts)
+
+    def test_rebuild_in_batches(self):
+        from django.conf import settings
+        batch_size = settings.GEOCELL_HISTOGRAM_BATCH_SIZE
+        settings.GEOCELL_HISTOGRAM_BATCH_SIZE = 2
+        try:
+            first = GeocellHistogram.rebuild(Agency)
+            histogram = GeocellHistogram.rebuild(Agency)
+        finally:
+            settings.GEOCELL_HISTOGRAM_BATCH_SIZE = batch_size
+        self.assertEqual(histogram.entity_count, 3)
+        muni_cell = self.agencies[0].location_geocells[GeocellHistogram.MAX_RESOLUTION - 1]
+        self.assertEqual(histogram.expected_count(muni_cell[:2]), 3)
+        # The first build's shards are gone.
+        self.assertEqual([shard for shard in GeocellHistogramShard.get_for_build(Agency.kind(), first.build_id) if shard is not None], [])
+
+    def test_cost(self):
+        histogram = GeocellHistogram.rebuild(Agency)
+        cost_function = GeocellHistogram.cost_function_for(Agency)
+        cell = self.agencies[0].location_geocells[3]
+
+        # Fetching the same entities with more queries costs more...
+        one_cell = cost_function(num_cells = 1, resolution = 4, cells = [cell])
+        many_cells = cost_function(num_cells = 16, resolution = 5, cells = geocell.children(cell))
+        self.assertTrue(one_cell < many_cells)
+
+        # ...and so does fetching more entities with the same number of queries.
+        empty_cell = geocell.adjacent(geocell.adjacent(cell, geocell.NORTH), geocell.NORTH)
+        self.assertTrue(cost_function(num_cells = 1, resolution = 4, cells = [empty_cell]) < one_cell)
+
+        # Too many cells for a single IN query.
+        too_many = GeocellHistogram.MAX_CELLS + 1
+        self.assertTrue(cost_function(num_cells = too_many, resolution = 6, cells = [cell] * too_many) > 1e100)
@@ -0,0 +1,28 @@
+import unittest
+from citygoround.utils.localcache import LocalCache
+
+class TestLocalCache(unittest.TestCase):
+    def test_get_and_set(self):
+        cache = LocalCache(max_entries = 10)
+        self.assertEqual(cache.get("a"), None)
+        cache.set("a", 1, 60)
+        self.assertEqual(cache.get("a"), 1)
+        cache.delete("a")
+        self.assertEqual(cache.get("a"), None)
+
+    def test_expiry(self):
+        cache = LocalCache(max_entries = 10)
+        cache.set("a", 1, -1)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LocalCache(max_entries = 2)
+        cache.set("a", 1, 60)
+        cache.set("b", 2, 60)
+        cache.get("a")
+        cache.set("c", 3, 60)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
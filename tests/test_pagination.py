@@ -0,0 +1,82 @@
+import unittest
+from django.http import HttpRequest
+from django.utils import simplejson as json
+from citygoround.models import Agency, TransitApp
+from citygoround.utils.pagination import page_parameters, paginate_query, paginate_by_key, paginate_keys, InvalidPageParameters
+from citygoround.utils.view import render_json_for_keys
+
+class TestPagination(unittest.TestCase):
+    def setUp(self):
+        self.agencies = [Agency(name = "Agency %d" % i, city = "Seattle", state = "WA") for i in range(5)]
+        for agency in self.agencies:
+            agency.put()
+        self.transit_apps = [TransitApp(title = "App %d" % i) for i in range(5)]
+        for transit_app in self.transit_apps:
+            transit_app.put()
+
+    def tearDown(self):
+        for agency in self.agencies:
+            agency.delete()
+        for transit_app in self.transit_apps:
+            transit_app.delete()
+
+    def make_request(self, **params):
+        request = HttpRequest()
+        request.method = "GET"
+        request.GET.update(params)
+        return request
+
+    def test_page_parameters(self):
+        self.assertEqual(page_parameters(self.make_request(limit = "2", cursor = "abc")), (2, "abc"))
+        self.assertRaises(InvalidPageParameters, page_parameters, self.make_request(limit = "0"))
+        self.assertRaises(InvalidPageParameters, page_parameters, self.make_request(limit = "many"))
+
+    def test_paginate_by_key(self):
+        page, cursor = paginate_by_key(self.agencies, 2)
+        self.assertEqual(len(page), 2)
+        seen = list(page)
+        while cursor is not None:
+            page, cursor = paginate_by_key(self.agencies, 2, cursor)
+            seen.extend(page)
+        self.assertEqual(sorted([agency.key() for agency in seen]), sorted([agency.key() for agency in self.agencies]))
+        self.assertRaises(InvalidPageParameters, paginate_by_key, self.agencies, 2, "not a key")
+
+    def test_paginate_by_key_is_stable_under_deletes(self):
+        agencies = sorted(self.agencies, key = lambda agency: agency.key())
+        page, cursor = paginate_by_key(agencies, 2)
+        page, cursor = paginate_by_key(agencies[1:], 2, cursor)
+        self.assertEqual([agency.key() for agency in page], [agencies[2].key(), agencies[3].key()])
+
+    def test_paginate_keys(self):
+        keys = [transit_app.key() for transit_app in self.transit_apps]
+        page, cursor = paginate_keys(keys, 2)
+        seen = list(page)
+        while cursor is not None:
+            page, cursor = paginate_keys(keys, 2, cursor)
+            seen.extend(page)
+        self.assertEqual(sorted(seen), sorted(keys))
+
+    def test_render_json_for_keys_gets_just_the_page(self):
+        fetched = []
+        def fetch_by_keys(keys):
+            fetched.extend(keys)
+            return TransitApp.fetch_by_keys(keys)
+        json_fragments = lambda transit_apps, fields: [json.dumps(transit_app.title) for transit_app in transit_apps]
+        keys = [transit_app.key() for transit_app in self.transit_apps]
+        page = json.loads(render_json_for_keys(self.make_request(limit = "2"), keys, fetch_by_keys, json_fragments).content)
+        self.assertEqual(len(page["results"]), 2)
+        self.assertEqual(len(fetched), 2)
+        self.assertNotEqual(page["cursor"], None)
+
+    def test_paginate_query(self):
+        page, cursor = paginate_query(TransitApp.all(), 3)
+        self.assertEqual(len(page), 3)
+        page, cursor = paginate_query(TransitApp.all(), 3, cursor)
+        self.assertEqual(len(page), 2)
+        self.assertEqual(cursor, None)
+
+    def test_fields_parameter(self):
+        from citygoround.utils.view import fields_parameter
+        self.assertEqual(fields_parameter(self.make_request(), Agency.JSONABLE_FIELD_NAMES), None)
+        self.assertEqual(fields_parameter(self.make_request(fields = "name, latitude,name"), Agency.JSONABLE_FIELD_NAMES), ("latitude", "name"))
+        self.assertRaises(ValueError, fields_parameter, self.make_request(fields = "name,password"), Agency.JSONABLE_FIELD_NAMES)
@@ -0,0 +1,67 @@
+import unittest
+from google.appengine.ext import db
+from google.appengine.api import memcache
+from citygoround.models import TransitApp, CounterShard
+from citygoround.utils.ratings import rating_deltas, enqueue_rating_vote, fold_rating_votes, refresh_bayesian_averages, _fold_votes_into_app, FOLD_TRANSACTION_OPTIONS
+
+class TestRatingVotes(unittest.TestCase):
+    def setUp(self):
+        memcache.flush_all()
+        CounterShard.set_value("all_rating_sum", 0)
+        CounterShard.set_value("all_rating_count", 0)
+        self.transit_app = TransitApp(title = "Rated App")
+        self.transit_app.put()
+
+    def tearDown(self):
+        self.transit_app.delete()
+
+    def test_rating_deltas(self):
+        self.assertEqual(rating_deltas(None, 4), (4, 1))
+        self.assertEqual(rating_deltas(4, 2), (-2, 0))
+        self.assertEqual(rating_deltas(2, None), (-2, -1))
+
+    def test_votes_are_applied_when_folded(self):
+        enqueue_rating_vote(self.transit_app, None, 4)
+        enqueue_rating_vote(self.transit_app, None, 5)
+        enqueue_rating_vote(self.transit_app, 5, 3)
+        self.assertEqual((self.transit_app.rating_sum, self.transit_app.rating_count), (7.0, 2))
+        self.assertEqual(TransitApp.get(self.transit_app.key()).rating_count, 0)
+        
+        self.assertEqual(fold_rating_votes(), 3)
+        transit_app = TransitApp.get(self.transit_app.key())
+        self.assertEqual((transit_app.rating_sum, transit_app.rating_count), (7.0, 2))
+        self.assertEqual(transit_app.bayesian_average, (7.0 + 7.0) / (2 + 2))
+        self.assertEqual(fold_rating_votes(), 0)
+
+    def test_votes_leased_again_count_once(self):
+        # As if a fold applied the votes, but failed before removing them from the queue.
+        votes = [("vote-1", 4, 1), ("vote-2", 5, 1)]
+        db.run_in_transaction_options(FOLD_TRANSACTION_OPTIONS, _fold_votes_into_app, self.transit_app.key(), votes, 9.0, 2)
+        db.run_in_transaction_options(FOLD_TRANSACTION_OPTIONS, _fold_votes_into_app, self.transit_app.key(), votes + [("vote-3", 1, 1)], 10.0, 3)
+        transit_app = TransitApp.get(self.transit_app.key())
+        self.assertEqual((transit_app.rating_sum, transit_app.rating_count), (10.0, 3))
+        memcache.flush_all()
+        self.assertEqual((CounterShard.get_value("all_rating_sum"), CounterShard.get_value("all_rating_count")), (10.0, 3.0))
+
+class TestRefreshBayesianAverages(unittest.TestCase):
+    def setUp(self):
+        memcache.flush_all()
+        CounterShard.set_value("all_rating_sum", 10)
+        CounterShard.set_value("all_rating_count", 4)
+        self.transit_apps = [TransitApp(title = "App %d" % i, rating_sum = 4.0, rating_count = 1) for i in range(3)]
+        for transit_app in self.transit_apps:
+            transit_app.refresh_bayesian_average()
+            transit_app.put()
+
+    def tearDown(self):
+        for transit_app in self.transit_apps:
+            transit_app.delete()
+
+    def test_only_moved_averages_are_saved(self):
+        self.assertEqual(refresh_bayesian_averages()[1], 0)
+        CounterShard.set_value("all_rating_sum", 20)
+        self.assertEqual(refresh_bayesian_averages(dry_run = True)[1], 3)
+        self.assertEqual(TransitApp.get(self.transit_apps[0].key()).bayesian_average, 14.0 / 5)
+        self.assertEqual(refresh_bayesian_averages()[1], 3)
+        self.assertEqual(TransitApp.get(self.transit_apps[0].key()).bayesian_average, 24.0 / 5)
+        self.assertEqual(refresh_bayesian_averages()[1], 0)
@@ -0,0 +1,12 @@
+import unittest
+from citygoround.utils.view import render_json_fragments, render_csv_rows
+
+class TestRenderHelpers(unittest.TestCase):
+    def test_json_fragments_from_iterator(self):
+        self.assertEqual(render_json_fragments(iter([])).content, "[]")
+        self.assertEqual(render_json_fragments(str(i) for i in range(250)).content, "[%s]" % ", ".join([str(i) for i in range(250)]))
+
+    def test_csv_rows_from_iterator(self):
+        response = render_csv_rows(iter([["a", "b"], ["1", "2,3"]]))
+        self.assertEqual(response.content, 'a,b\r\n1,"2,3"\r\n')
+        self.assertEqual(response["Content-Type"], "text/csv")
@@ -0,0 +1,52 @@
+import unittest
+from google.appengine.api import memcache
+from citygoround.models import CounterShard, NamedStat
+
+class TestShardedCounter(unittest.TestCase):
+    def setUp(self):
+        memcache.flush_all()
+        CounterShard.set_value("test-counter", 0)
+
+    def test_increment(self):
+        for i in range(30):
+            CounterShard.increment("test-counter")
+        CounterShard.increment("test-counter", 2.5)
+        CounterShard.increment("test-counter", -1)
+        memcache.flush_all()
+        self.assertEqual(CounterShard.get_value("test-counter"), 31.5)
+
+    def test_value_is_cached(self):
+        self.assertEqual(CounterShard.get_value("test-counter"), 0.0)
+        CounterShard.increment("test-counter")
+        self.assertEqual(CounterShard.get_value("test-counter"), 0.0)
+        CounterShard.set_value("test-counter", 7)
+        self.assertEqual(CounterShard.get_value("test-counter"), 7.0)
+
+    def test_seed_once_without_losing_increments(self):
+        CounterShard.increment("test-seeded-counter", 2)
+        self.assertTrue(CounterShard.seed("test-seeded-counter", 10))
+        self.assertFalse(CounterShard.seed("test-seeded-counter", 10))
+        CounterShard.increment("test-seeded-counter", 3)
+        memcache.flush_all()
+        self.assertEqual(CounterShard.get_value("test-seeded-counter"), 15.0)
+
+    def test_missing_counter(self):
+        self.assertEqual(CounterShard.get_value("no-such-counter"), 0.0)
+        self.assertEqual(CounterShard.get_value("no-such-counter", missing = None), None)
+
+class TestStatsOnShardedCounters(unittest.TestCase):
+    def setUp(self):
+        memcache.flush_all()
+
+    def test_named_stat_seeded_from_legacy_entity(self):
+        legacy_stat = NamedStat(name = "test-legacy-stat", value = 12.0)
+        legacy_stat.put()
+        try:
+            CounterShard.increment("test-legacy-stat", 1)
+            self.assertEqual(NamedStat.increment("test-legacy-stat", 2), 15.0)
+            memcache.flush_all()
+            self.assertEqual(NamedStat.get_value("test-legacy-stat"), 15.0)
+            self.assert_({"name": "test-legacy-stat", "value": 15.0} in NamedStat.all_stats())
+        finally:
+            legacy_stat.delete()
+            CounterShard.set_value("test-legacy-stat", 0)
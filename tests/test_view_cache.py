@@ -0,0 +1,107 @@
+import unittest
+from django.conf import settings
+from django.http import HttpResponse
+from google.appengine.api import memcache
+from django.http import HttpRequest
+from citygoround.decorators import memcache_parameterized_view_response
+from citygoround.utils.generation import bump_generation
+from citygoround.utils.memcache import local_view_cache, key_for_request, set_with_staleness, get_with_staleness, is_fresh, mark_stale, acquire_refresh_lock, release_refresh_lock, response_to_record, response_from_record
+
+class TestViewCache(unittest.TestCase):
+    def setUp(self):
+        memcache.flush_all()
+
+    def test_fresh_then_stale(self):
+        set_with_staleness("key", "value", time = 60, stale_time = 60)
+        value, fresh_until = get_with_staleness("key")
+        self.assertEqual(value, "value")
+        self.assertTrue(is_fresh(fresh_until))
+
+        mark_stale("key")
+        value, fresh_until = get_with_staleness("key")
+        self.assertEqual(value, "value")
+        self.assertFalse(is_fresh(fresh_until))
+
+    def test_never_stale(self):
+        set_with_staleness("key", "value")
+        value, fresh_until = get_with_staleness("key")
+        self.assertEqual(value, "value")
+        self.assertTrue(is_fresh(fresh_until))
+
+    def test_missing(self):
+        self.assertEqual(get_with_staleness("missing"), (None, None))
+        mark_stale("missing")
+        self.assertEqual(get_with_staleness("missing"), (None, None))
+
+    def test_refresh_lock(self):
+        self.assertTrue(acquire_refresh_lock("key"))
+        self.assertFalse(acquire_refresh_lock("key"))
+        release_refresh_lock("key")
+        self.assertTrue(acquire_refresh_lock("key"))
+
+    def test_chunked_value(self):
+        value = "x" * (settings.MEMCACHE_CHUNK_BYTES * 2 + 1)
+        set_with_staleness("key", value, time = 60)
+        self.assertEqual(get_with_staleness("key")[0], value)
+
+    def test_chunked_value_missing_a_chunk(self):
+        value = "x" * (settings.MEMCACHE_CHUNK_BYTES + 1)
+        set_with_staleness("key", value, time = 60)
+        chunked_value = memcache.get("key")[2]
+        memcache.delete(chunked_value.chunk_keys("key")[-1])
+        self.assertEqual(get_with_staleness("key"), (None, None))
+
+    def test_response_record(self):
+        response = HttpResponse("body " * settings.CACHED_RESPONSE_COMPRESS_BYTES, content_type = "text/csv", status = 201)
+        response["Content-Disposition"] = "attachment; filename=apps.csv"
+        response["X-Not-Cached"] = "1"
+        response.set_cookie("session", "secret")
+        generation, rebuilt = response_from_record(response_to_record(response, "Agency.1"))
+        self.assertEqual(generation, "Agency.1")
+        self.assertEqual(rebuilt.content, response.content)
+        self.assertEqual(rebuilt.status_code, 201)
+        self.assertEqual(rebuilt["Content-Type"], "text/csv")
+        self.assertEqual(rebuilt["Content-Disposition"], "attachment; filename=apps.csv")
+        self.assertFalse(rebuilt.has_header("X-Not-Cached"))
+        self.assertEqual(len(rebuilt.cookies), 0)
+
+    def test_response_record_rejects_old_values(self):
+        self.assertEqual(response_from_record(HttpResponse("pickled")), (None, None))
+
+class TestCachedViewGenerations(unittest.TestCase):
+    def setUp(self):
+        memcache.flush_all()
+        local_view_cache.clear()
+        self.calls = 0
+        def view(request):
+            self.calls += 1
+            return HttpResponse("call %d" % self.calls)
+        self.view = memcache_parameterized_view_response(time = 60, kinds = ("TransitApp",))(view)
+        self.old_local_server = settings.RUNNING_APP_ENGINE_LOCAL_SERVER
+        settings.RUNNING_APP_ENGINE_LOCAL_SERVER = False
+
+    def tearDown(self):
+        settings.RUNNING_APP_ENGINE_LOCAL_SERVER = self.old_local_server
+
+    def make_request(self):
+        request = HttpRequest()
+        request.method = "GET"
+        request.path = "/api/apps/"
+        return request
+
+    def test_other_kinds_leave_view_alone(self):
+        self.assertEqual(self.view(self.make_request()).content, "call 1")
+        bump_generation("Agency")
+        self.assertEqual(self.view(self.make_request()).content, "call 1")
+
+    def test_bump_serves_stale_copy_while_one_request_renders(self):
+        self.assertEqual(self.view(self.make_request()).content, "call 1")
+        bump_generation("TransitApp")
+        self.assertTrue(acquire_refresh_lock(self.view_key()))
+        self.assertEqual(self.view(self.make_request()).content, "call 1")
+        release_refresh_lock(self.view_key())
+        self.assertEqual(self.view(self.make_request()).content, "call 2")
+        self.assertEqual(self.view(self.make_request()).content, "call 2")
+
+    def view_key(self):
+        return key_for_request(self.make_request())